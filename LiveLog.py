@@ -0,0 +1,129 @@
+import threading
+import queue
+import json
+import csv
+import os
+import time
+
+ACTIVITY_FIELDS = ['datetime', 'count', 'price', 'unit', 'value', 'cash', 'posi_value', 'posi_price']
+
+
+class Journal(object):
+    '''
+    Non-blocking logging for the live strategy.
+
+    The strategy thread only puts records on a bounded queue. A writer thread
+    formats them and writes them in batches to:
+      - `logpath`: the text log (access.log)
+      - `csvpath`: the activity CSV (OandaActivity.csv)
+      - `jsonpath`: a JSON lines journal with every record, see replay()
+
+    Params Note:
+      - `fsync`: None (leave it to the OS), 'batch' (fsync after every
+        written batch) or a number of seconds between fsyncs
+      - `maxsize`: queue bound; when it is full the record is dropped and
+        counted in `dropped` instead of blocking the strategy
+      - `csvmode`: 'a' keeps the activity history of earlier runs (the
+        header is only written to a new file), 'w' starts a new file
+    '''
+    def __init__(self, logpath='access.log', csvpath='OandaActivity.csv', jsonpath='journal.jsonl',
+                 csvmode='a', maxsize=100000, batch=512, flush_interval=0.2, fsync=None):
+        self.queue = queue.Queue(maxsize)
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.dropped = 0
+        self.written = 0
+
+        self.logfile = open(logpath, 'a') if logpath else None
+        self.csvfile = None
+        self.csvwriter = None
+        if csvpath:
+            exists = os.path.exists(csvpath) and os.path.getsize(csvpath) > 0
+            self.csvfile = open(csvpath, csvmode, newline='')
+            self.csvwriter = csv.writer(self.csvfile)
+            if csvmode == 'w' or not exists:
+                self.csvwriter.writerow(ACTIVITY_FIELDS)
+        self.jsonfile = open(jsonpath, 'a') if jsonpath else None
+        self.files = [f for f in (self.logfile, self.csvfile, self.jsonfile) if f]
+
+        self._last_fsync = time.time()
+        self._thread = threading.Thread(target=self._run, name='Journal', daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def log(self, dt, txt, *args):
+        '''Text log line, `txt % args` is formatted by the writer thread'''
+        self.put(('log', dt, txt, args))
+
+    def activity(self, dt, count, price, unit, value, cash, posi_size, posi_price):
+        self.put(('activity', dt, count, price, unit, value, cash, posi_size, posi_price))
+
+    def close(self, timeout=5.0):
+        self.queue.put(None)  # blocking on purpose: everything queued gets written
+        self._thread.join(timeout)
+        for f in self.files:
+            f.close()
+
+    def _run(self):
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get(timeout=self.flush_interval))
+                while len(records) < self.batch:
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            stop = None in records
+            self._write([r for r in records if r is not None])
+            records = []
+            if stop:
+                return
+
+    def _write(self, records):
+        if not records:
+            return
+        for record in records:
+            kind, dt = record[0], record[1]
+            dtstr = dt.strftime('%Y-%m-%d %H:%M:%S')
+            if kind == 'log':
+                txt, args = record[2], record[3]
+                msg = txt % args if args else txt
+                if self.logfile:
+                    self.logfile.write('%s, %s\n' % (dtstr, msg))
+                entry = dict(kind=kind, dt=dtstr, msg=msg)
+            else:
+                count, price, unit, value, cash, posi_size, posi_price = record[2:]
+                if self.csvwriter:
+                    self.csvwriter.writerow([dtstr, '%d' % count, '%.4f' % price, '%d' % unit,
+                                             '%.2f' % value, '%.2f' % cash, '%d' % posi_size,
+                                             '%.4f' % posi_price])
+                entry = dict(kind=kind, dt=dtstr, count=count, price=price, unit=unit,
+                             value=value, cash=cash, posi_size=posi_size, posi_price=posi_price)
+            if self.jsonfile:
+                self.jsonfile.write(json.dumps(entry) + '\n')
+        self.written += len(records)
+
+        for f in self.files:
+            f.flush()
+        if self.fsync == 'batch' or (self.fsync and self.fsync != 'batch' and
+                                     time.time() - self._last_fsync >= float(self.fsync)):
+            for f in self.files:
+                os.fsync(f.fileno())
+            self._last_fsync = time.time()
+
+
+def replay(jsonpath, kinds=None):
+    '''Yield the records of a journal file as dicts, optionally only some kinds'''
+    with open(jsonpath) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break  # partially written last record
+            entry = json.loads(line)
+            if kinds is None or entry['kind'] in kinds:
+                yield entry
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import functools
+import time
+
+
+class LatencyHistogram(object):
+    '''
+    O(1) latency recorder in microseconds: count, sum, min, max and
+    power-of-two buckets for percentiles. Bucket k holds [2^(k-1), 2^k) us,
+    bucket 0 everything below 1 us.
+    '''
+    BUCKETS = 40
+
+    def __init__(self, name=''):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * self.BUCKETS
+
+    def record(self, us):
+        self.count += 1
+        self.total += us
+        if us < self.min:
+            self.min = us
+        if us > self.max:
+            self.max = us
+        self.buckets[min(int(us).bit_length(), self.BUCKETS - 1)] += 1
+
+    def record_since(self, start_ns):
+        '''Record the time elapsed since a time.perf_counter_ns() stamp'''
+        self.record((time.perf_counter_ns() - start_ns) / 1000.0)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        '''Upper bound (us) of the bucket holding the q-th percentile'''
+        if not self.count:
+            return 0.0
+        rank = q / 100.0 * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(float(1 << k), self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(name=self.name, count=self.count, mean=self.mean,
+                    min=self.min if self.count else 0.0, max=self.max,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99))
+
+    def summary(self):
+        s = self.snapshot()
+        return ('%s: count: %d, mean: %.1fus, min: %.1fus, p50<=%.0fus, p90<=%.0fus, '
+                'p99<=%.0fus, max: %.1fus' % (s['name'], s['count'], s['mean'], s['min'],
+                                               s['p50'], s['p90'], s['p99'], s['max']))
+
+
+class CallProfiler(object):
+    '''
+    Opt-in call instrumentation: wrap() replaces methods of an object (a
+    strategy, the broker, the journal) by the same call timed into a
+    LatencyHistogram per method. The wrappers are instance attributes, the
+    classes are untouched and an object is only wrapped once, so one
+    profiler can be shared by all strategies of a process.
+
+    counters() can be read from any thread while the run is going on.
+    '''
+    def __init__(self):
+        self.histograms = OrderedDict()
+        self.dumped = False
+        self._wrapped = set()
+
+    def wrap(self, obj, names, prefix):
+        for name in names:
+            if (id(obj), name) in self._wrapped or not hasattr(obj, name):
+                continue
+            self._wrapped.add((id(obj), name))
+            key = '%s.%s' % (prefix, name)
+            histogram = self.histograms.setdefault(key, LatencyHistogram(key))
+            setattr(obj, name, self._timed(getattr(obj, name), histogram))
+
+    @staticmethod
+    def _timed(func, histogram):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.record_since(start)
+        return timed
+
+    def counters(self):
+        '''{name: (calls, total us)} of every wrapped method'''
+        return dict((name, (h.count, h.total)) for name, h in list(self.histograms.items()))
+
+    def summary(self):
+        '''One line per method, the most total time first'''
+        histograms = sorted(self.histograms.values(), key=lambda h: h.total, reverse=True)
+        return ['%s, total: %.1fms' % (h.summary(), h.total / 1000.0) for h in histograms if h.count]
+
+    def dump(self):
+        '''summary() the first time, [] after: each strategy's stop() can call it'''
+        if self.dumped:
+            return []
+        self.dumped = True
+        return self.summary()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import backtrader as bt
+import argparse
+import struct
+import threading
+import json
+import time
+
+import LiveMetrics
+import LiveRisk
+from LiveVolatility import SeizeVolatilityStrategy, TickStamp, AccountRisk, load_instruments
+
+# binary session journal: a 16 byte header, then fixed size 64 byte records
+#   kind (u1), instrument id (u2), wall clock ns (i8), 6 float64 values
+#   NAME:     instrument name (utf-8, 48 bytes) in place of the values
+#   TICK:     datetime (bt date number), open, high, low, close, volume
+#   ORDER:    ref, status, size, price, executed size, executed price
+#   POSITION: size, price, cash (at strategy start)
+MAGIC = b'LVRJ'
+VERSION = 1
+HEADER = struct.Struct('<4sI8x')
+RECORD = struct.Struct('<BxH4xq6d')
+NAME, TICK, ORDER, POSITION = 0, 1, 2, 3
+
+
+class Recorder(object):
+    '''
+    Writes the raw feed and the order events of a live session to a binary
+    journal for LiveReplay. Records are buffered and flushed every
+    `flush_interval` seconds (and at close).
+    '''
+    def __init__(self, path, flush_interval=1.0):
+        self.file = open(path, 'wb', buffering=1 << 20)
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.flush_interval = flush_interval
+        self.ids = {}
+        self.records = 0
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    def _write(self, kind, name, *values):
+        with self._lock:
+            iid = self.ids.get(name)
+            if iid is None:
+                iid = self.ids[name] = len(self.ids)
+                self.file.write(struct.pack('<BxH4xq48s', NAME, iid, 0, name.encode()))
+            self.file.write(RECORD.pack(kind, iid, time.time_ns(), *values))
+            self.records += 1
+            now = time.monotonic()
+            if now - self._flushed >= self.flush_interval:
+                self.file.flush()
+                self._flushed = now
+
+    def tick(self, data):
+        self._write(TICK, data._name, data.lines.datetime[0], data.lines.open[0], data.lines.high[0],
+                    data.lines.low[0], data.lines.close[0], data.lines.volume[0])
+
+    def order(self, name, order):
+        self._write(ORDER, name, order.ref, order.status, order.created.size, order.created.price or 0.0,
+                    order.executed.size, order.executed.price or 0.0)
+
+    def position(self, name, size, price, cash):
+        self._write(POSITION, name, size, price, cash, 0.0, 0.0, 0.0)
+
+    def flush(self):
+        with self._lock:
+            self.file.flush()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+class Session(object):
+    '''
+    A recorded journal in memory:
+      - `ticks`: {name: [(wall_ns, datetime, open, high, low, close, volume)]}
+      - `orders`: [(name, wall_ns, ref, status, size, price, executed size, executed price)]
+      - `positions`: {name: (size, price, cash)}
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        magic, version = HEADER.unpack_from(raw)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a session journal' % path)
+        end = HEADER.size + (len(raw) - HEADER.size) // RECORD.size * RECORD.size  # partial last record
+        names = {}
+        self.ticks = {}
+        self.orders = []
+        self.positions = {}
+        for offset in range(HEADER.size, end, RECORD.size):
+            kind, iid, wall_ns = RECORD.unpack_from(raw, offset)[:3]
+            if kind == NAME:
+                name = raw[offset + 16:offset + RECORD.size].rstrip(b'\0').decode()
+                names[iid] = name
+                self.ticks[name] = []
+                continue
+            values = RECORD.unpack_from(raw, offset)[3:]
+            name = names[iid]
+            if kind == TICK:
+                self.ticks[name].append((wall_ns,) + values)
+            elif kind == ORDER:
+                self.orders.append((name, wall_ns) + values)
+            elif kind == POSITION:
+                self.positions.setdefault(name, values[:3])  # first strategy start
+        self.names = [n for n in self.ticks if self.ticks[n]]
+
+    def order_events(self, status=bt.Order.Submitted):
+        '''(name, size) of the orders, in session order'''
+        return [(o[0], o[4]) for o in self.orders if int(o[3]) == status]
+
+
+class SessionData(bt.feed.DataBase):
+    '''
+    Feed of one instrument of a Session.
+      - `speed`: 0 replays at max speed, otherwise at `speed` times the
+        recorded pace (1.0: real time)
+    '''
+    params = (('session', None),
+              ('speed', 0.0))
+
+    def start(self):
+        super(SessionData, self).start()
+        self._ticks = self.p.session.ticks[self.p.dataname]
+        self._idx = 0
+        self._t0 = None
+
+    def _load(self):
+        i = self._idx
+        if i >= len(self._ticks):
+            return False
+        self._idx = i + 1
+        tick = self._ticks[i]
+        if self.p.speed:
+            if self._t0 is None:
+                self._t0 = (time.perf_counter_ns(), tick[0])
+            wait = self._t0[0] + (tick[0] - self._t0[1]) / self.p.speed - time.perf_counter_ns()
+            if wait > 0:
+                time.sleep(wait / 1e9)
+        (self.lines.datetime[0], self.lines.open[0], self.lines.high[0], self.lines.low[0],
+         self.lines.close[0], self.lines.volume[0]) = tick[1:]
+        self.lines.openinterest[0] = 0.0
+        return True
+
+
+class ReplayData(TickStamp, SessionData):
+    '''SessionData stamped (and re-recorded) like the live Oanda feed'''
+    pass
+
+
+class ReplayBroker(bt.brokers.BackBroker):
+    '''
+    Local stand-in for the Oanda broker: market orders fill at the price of
+    the tick they were sent on, the position recorded at strategy start is
+    restored and getserverposition() answers from the local book.
+    '''
+    params = (('coc', True),)
+
+    def __init__(self):
+        super(ReplayBroker, self).__init__()
+        self.seeds = {}
+
+    def seed(self, data, size, price):
+        self.seeds[data] = (size, price)
+
+    def start(self):
+        super(ReplayBroker, self).start()
+        for data, (size, price) in self.seeds.items():
+            self.positions[data].set(size, price)
+
+    def getserverposition(self, data, update_latest=False):
+        return self.getposition(data)
+
+
+def run_replay(session, config, speed=0.0, recorder=None, prefix='replay', margin=0.02, profiler=None,
+               monitor=None):
+    '''Run SeizeVolatilityStrategy of config.json on a recorded Session'''
+    cerebro = bt.Cerebro(stdstats=False)
+    broker = ReplayBroker()
+    cerebro.setbroker(broker)
+    feed = config.get("feed", {})
+    timeframe = getattr(bt.TimeFrame, feed.get("timeframe", "Minutes"))
+
+    instruments = load_instruments(config)
+    risk = AccountRisk(**config.get("risk", {}))
+    cash = None
+    for name in session.names:
+        data = ReplayData(dataname=name, session=session, speed=speed, timeframe=timeframe)
+        data.recorder = recorder
+        cerebro.adddata(data, name=name)
+        if name in session.positions:
+            size, price, cash = session.positions[name]
+            broker.seed(data, size, price)
+        log = dict(logpath='%s_%s.log' % (prefix, name), csvpath='%s_%s.csv' % (prefix, name),
+                   jsonpath=None, csvmode='w')
+        cerebro.addstrategy(SeizeVolatilityStrategy, instrument=name, risk=risk, log=log,
+                            recorder=recorder, profiler=profiler, monitor=monitor,
+                            **dict(config.get("orders", {}), **instruments.get(name, {})))
+    broker.setcash(cash if cash is not None else broker.getcash())
+    broker.setcommission(margin=margin)
+    return cerebro.run(preload=False, runonce=False)
+
+
+def compare(recorded, replayed):
+    '''Differences between the orders sent in two sessions, [] if identical'''
+    a, b = recorded.order_events(), replayed.order_events()
+    diffs = ['%d: %s != %s' % (i, x, y) for i, (x, y) in enumerate(zip(a, b)) if x != y]
+    if len(a) != len(b):
+        diffs.append('order count: %d != %d' % (len(a), len(b)))
+    return diffs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded live session offline')
+    parser.add_argument('journal', help='session journal written with "record" in config.json')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--speed', type=float, default=0.0, help='0: max speed, 1.0: real time')
+    parser.add_argument('--record', default='replay.rec', help='journal of the replay, compared with the recording')
+    parser.add_argument('--profile', action='store_true', help='time the strategy callbacks and broker calls')
+    parser.add_argument('--monitor', action='store_true', help='run the risk monitor of "monitor" in the config')
+    args = parser.parse_args()
+
+    with open(args.config, "r") as file:
+        config = json.load(file)
+    session = Session(args.journal)
+    print('%s: %s, %d ticks, %d order events' % (args.journal, ', '.join(session.names),
+                                                  sum(len(t) for t in session.ticks.values()),
+                                                  len(session.orders)))
+    recorder = Recorder(args.record)
+    start = time.perf_counter()
+    profiler = LiveMetrics.CallProfiler() if args.profile else None
+    monitor = LiveRisk.RiskMonitor(**config.get("monitor") or {}) if args.monitor else None
+    strategies = run_replay(session, config, speed=args.speed, recorder=recorder, profiler=profiler,
+                            monitor=monitor)
+    elapsed = time.perf_counter() - start
+    recorder.close()
+    if monitor:
+        monitor.stop()
+        print(monitor.summary())
+
+    ticks = sum(len(t) for t in session.ticks.values())
+    print('Replayed in %.2fs, %.0f ticks/s' % (elapsed, ticks / elapsed if elapsed else 0.0))
+    for s in strategies:
+        print(s.latency.summary())
+    diffs = compare(session, Session(args.record))
+    print('Orders identical to the recording' if not diffs else 'Orders differ:\n  ' + '\n  '.join(diffs[:20]))
@@ -0,0 +1,164 @@
+import collections
+import threading
+import time
+
+OK, HALT, FLATTEN = 0, 1, 2
+LEVELS = ('ok', 'halt', 'flatten')
+PRICE, FILL, POSITION = 0, 1, 2
+
+
+class RiskMonitor(object):
+    '''
+    Account risk watched off the strategy thread. The strategies append
+    price updates and fills to a deque (no lock, no wait) and a monitor
+    thread drains it every `interval` seconds. Per instrument it keeps
+    size, average price and last price, and from them, in O(1) per record:
+      - exposure: sum of |size| * price (notional)
+      - unrealized: sum of size * (price - average price)
+      - equity: account value at start + the P&L marked to market since
+      - margin ratio: exposure * margin_rate / equity (Oanda closes out at 1.0)
+      - drawdown: equity below its peak, a fraction of the peak
+    `level` is all the strategies read before an order:
+      - HALT: while a halt_ threshold is crossed, no order that increases
+        a position
+      - FLATTEN: a flatten_ threshold was crossed, every position gets
+        closed and the grid stays halted until restart
+
+    Params Note:
+      - thresholds of None are off
+      - P&L is in the quote currency of each instrument: exact for the
+        *_USD instruments of a USD account
+    '''
+    def __init__(self, margin_rate=0.02, halt_margin=None, flatten_margin=None, halt_drawdown=None,
+                 flatten_drawdown=None, interval=0.05):
+        self.margin_rate = margin_rate
+        self.halt_margin = halt_margin
+        self.flatten_margin = flatten_margin
+        self.halt_drawdown = halt_drawdown
+        self.flatten_drawdown = flatten_drawdown
+        self.interval = interval
+        self.level = OK
+        self.reason = ''
+        self.events = []  # (wall time, level, reason) of the level changes
+        self.updates = 0
+
+        self.positions = {}  # name -> (size, average price, last price)
+        self._opening = {}  # name -> (size, average price) at start, until its first price
+        self.value0 = None
+        self.pnl = 0.0
+        self.exposure = 0.0
+        self.unrealized = 0.0
+        self.equity = None
+        self.peak = None
+        self.margin_ratio = 0.0
+        self.drawdown = 0.0
+        self.max_margin_ratio = 0.0
+        self.max_drawdown = 0.0
+
+        self._updates = collections.deque()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='RiskMonitor', daemon=True)
+
+    # strategy thread side: one deque append per call
+    def price(self, name, price):
+        self._updates.append((PRICE, name, price))
+
+    def fill(self, name, size, price):
+        self._updates.append((FILL, name, size, price))
+
+    def position(self, name, size, price):
+        '''Position of `name` at strategy start'''
+        self._updates.append((POSITION, name, size, price))
+
+    def allow(self, units, diff_units):
+        '''An order from `units` to `units + diff_units` is allowed at the current level'''
+        return not self.level or abs(units + diff_units) < abs(units)
+
+    def start(self, value):
+        '''Starts watching with the account value as the equity base, once for all strategies'''
+        if self.value0 is None:
+            self.value0 = self.equity = self.peak = value
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        if self.value0 is not None:
+            self._drain()
+
+    # monitor thread side
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._drain()
+
+    def _drain(self):
+        updates = self._updates
+        while updates:
+            record = updates.popleft()
+            kind, name = record[0], record[1]
+            self.updates += 1
+            if kind == POSITION:
+                self._opening[name] = record[2:]
+                continue
+            price = record[2] if kind == PRICE else record[3]
+            if name not in self.positions:
+                # first price: the base of the P&L, the value at start has the unrealized part
+                size, avg = self._opening.pop(name, (0.0, 0.0))
+                self._set(name, size, avg, price)
+            size, avg, last = self.positions[name]
+            self._set(name, size, avg, price)
+            if kind == FILL:
+                self._set(name, *self._filled(size, avg, record[2], price))
+            self._check()
+
+    @staticmethod
+    def _filled(size, avg, fill_size, fill_price):
+        new = size + fill_size
+        if not new:
+            return 0.0, 0.0, fill_price
+        if not size or (size > 0) == (fill_size > 0):
+            return new, (size * avg + fill_size * fill_price) / new, fill_price
+        if (size > 0) == (new > 0):
+            return new, avg, fill_price  # reduced
+        return new, fill_price, fill_price  # reversed
+
+    def _set(self, name, size, avg, last):
+        old = self.positions.get(name)
+        if old is not None:
+            self.exposure -= abs(old[0]) * old[2]
+            self.unrealized -= old[0] * (old[2] - old[1])
+            self.pnl += old[0] * (last - old[2])
+        self.positions[name] = (size, avg, last)
+        self.exposure += abs(size) * last
+        self.unrealized += size * (last - avg)
+
+    def _check(self):
+        self.equity = equity = self.value0 + self.pnl
+        self.peak = max(self.peak, equity)
+        self.margin_ratio = self.exposure * self.margin_rate / equity if equity > 0 else float('inf')
+        self.drawdown = 1.0 - equity / self.peak if self.peak > 0 else 0.0
+        self.max_margin_ratio = max(self.max_margin_ratio, self.margin_ratio)
+        self.max_drawdown = max(self.max_drawdown, self.drawdown)
+        if self.level == FLATTEN:
+            return
+
+        level, reason = OK, 'below the thresholds'
+        for threshold, value, name, to in ((self.flatten_margin, self.margin_ratio, 'margin ratio', FLATTEN),
+                                           (self.flatten_drawdown, self.drawdown, 'drawdown', FLATTEN),
+                                           (self.halt_margin, self.margin_ratio, 'margin ratio', HALT),
+                                           (self.halt_drawdown, self.drawdown, 'drawdown', HALT)):
+            if threshold is not None and value >= threshold:
+                level, reason = to, '%s %.3f >= %.3f' % (name, value, threshold)
+                break
+        if level != self.level:
+            self.reason = reason
+            self.level = level
+            self.events.append((time.time(), level, reason))
+
+    def summary(self):
+        return ('risk monitor: %s, equity: %.2f, exposure: %.2f, unrealized: %.2f, margin ratio: %.3f '
+                '(max %.3f), drawdown: %.3f (max %.3f), updates: %d, level changes: %d' % (
+                    LEVELS[self.level], self.equity or 0.0, self.exposure, self.unrealized,
+                    self.margin_ratio, self.max_margin_ratio, self.drawdown, self.max_drawdown,
+                    self.updates, len(self.events)))
@@ -0,0 +1,99 @@
+import math
+import os
+import struct
+import threading
+import time
+import zlib
+
+# state snapshot of one strategy: a single 140 byte record (RECORD.size + CRC.size), crc32 last
+#   magic, version, instrument (utf-8, 32 bytes), saved at (wall clock ns),
+#   units, new_units, count, pending order ref (0: none), pending target units,
+#   prev_close (nan: none), position size and price, grid params (base, unit, value unit)
+MAGIC = b'LVST'
+VERSION = 1
+RECORD = struct.Struct('<4sH2x32sqqqqqqdddddd')
+CRC = struct.Struct('<I')
+FIELDS = ('instrument', 'saved_ns', 'units', 'new_units', 'count', 'pending_ref', 'pending_units',
+          'prev_close', 'position_size', 'position_price', 'price_base', 'price_unit', 'value_unit')
+
+
+class Snapshot(object):
+    '''
+    Atomic checkpoint of the live strategy state in a small binary file.
+    save() only packs the record; a writer thread writes it to a temporary
+    file and renames that over the snapshot, so a crash leaves either the
+    previous or the new state, never a mix. With `fsync` the data is on
+    disk before the rename. Records saved while a write is in progress
+    coalesce, only the latest one is written; close() writes the last.
+    '''
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.saves = 0
+        self.writes = 0
+        self._pending = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Snapshot', daemon=True)
+        self._thread.start()
+
+    def save(self, **state):
+        state = dict(state, saved_ns=time.time_ns())
+        prev_close = state['prev_close']
+        values = [state[f] for f in FIELDS]
+        values[0] = state['instrument'].encode()
+        values[FIELDS.index('prev_close')] = float('nan') if prev_close is None else prev_close
+        payload = RECORD.pack(MAGIC, VERSION, *values)
+        with self._lock:
+            self._pending = payload + CRC.pack(zlib.crc32(payload))
+        self._wake.set()
+        self.saves += 1
+
+    def close(self, timeout=5.0):
+        '''Write the last saved record and stop the writer thread'''
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                record, self._pending = self._pending, None
+            if record is not None:
+                self._write(record)
+            if self._closed and self._pending is None:
+                return
+
+    def _write(self, record):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(record)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.writes += 1
+
+    def load(self):
+        '''The saved state as a dict, None if there is no (valid) snapshot'''
+        try:
+            with open(self.path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if len(raw) != RECORD.size + CRC.size:
+            return None
+        payload = raw[:RECORD.size]
+        if CRC.unpack(raw[RECORD.size:])[0] != zlib.crc32(payload):
+            return None
+        values = RECORD.unpack(payload)
+        if values[0] != MAGIC or values[1] != VERSION:
+            return None
+        state = dict(zip(FIELDS, values[2:]))
+        state['instrument'] = state['instrument'].rstrip(b'\0').decode()
+        if math.isnan(state['prev_close']):
+            state['prev_close'] = None
+        return state
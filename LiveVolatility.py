@@ -1,28 +1,48 @@
 #!/usr/bin/env python3
 import backtrader as bt
-import btoandav20
 from datetime import datetime
 import json
-import csv
+import time
+
+import LiveLog
+import LiveMetrics
+import LiveRisk
+import LiveState
+import OrderTracker
 
 class SeizeVolatilityStrategy(bt.Strategy):
     params = (('price_base', 1.0300),
               ('price_unit', 0.0020),
               ('value_unit', 600),
-              ('max_unit', 35))
+              ('max_unit', 35),
+              ('log', dict()),  # LiveLog.Journal kwargs
+              ('instrument', None),  # data name, None: data0
+              ('risk', None),  # shared AccountRisk
+              ('order_timeout', 0.5),  # seconds without order progress before cancel
+              ('reconcile_interval', 5.0),  # seconds between server position checks, 0: off
+              ('recorder', None),  # LiveReplay.Recorder of the session
+              ('profiler', None),  # shared LiveMetrics.CallProfiler, None: off
+              ('state', None),  # path of the LiveState snapshot, None: off
+              ('log_level', 2),  # 1: no price change lines and order dumps in the text log
+              ('monitor', None))  # shared LiveRisk.RiskMonitor, None: off
     
-    def log(self, txt, dt=None):
-        dt = dt or self.data0.datetime.datetime()
-        dtstr = dt.strftime('%Y-%m-%d %H:%M:%S')
-        self.logfile.write('%s, %s\n' % (dtstr, txt))
-        self.logfile.flush()
+    def log(self, txt, *args, dt=None):
+        # formatting and file I/O happen on the journal writer thread
+        dt = dt or self.d.datetime.datetime()
+        self.journal.log(dt, txt, *args)
     
     def __init__(self):
-        self.logfile = None
-        self.csvfile = None
-        self.csvwriter = None
-        self.order = None
-        self.order_time = None
+        self.d = self.getdatabyname(self.p.instrument) if self.p.instrument else self.data0
+        self.last_len = 0
+        self.risk_skipped = 0
+        self.risk_level = LiveRisk.OK  # level of the monitor last seen
+        self.latency = LiveMetrics.LatencyHistogram('tick->order %s' % (self.p.instrument or self.d._name))
+        self.journal = None
+        self.orders = None
+        self.reconciler = None
+        self.unsure = None  # reconciler.checks when an order was given up
+        self.snapshot = None
+        self.saved = None  # state key of the last checkpoint
         self.units = 0
         self.new_units = 0
         self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
@@ -30,119 +50,387 @@ class SeizeVolatilityStrategy(bt.Strategy):
         self.prev_close = None
 
     def notify_order(self, order):
-        order_info = '\n----------ORDER BEGIN----------\n%s\n----------ORDER END----------' % order
-        self.log(order_info)
-        if order.status in [order.Submitted, order.Accepted]:
+        if self.p.log_level > 1:
+            # the notified order is a clone, str() of it can wait for the writer thread
+            self.log('\n----------ORDER BEGIN----------\n%s\n----------ORDER END----------', order)
+        self.orders.update(order)
+        if self.p.monitor:
+            for bit in order.executed.iterpending():  # fills since the last notification
+                self.p.monitor.fill(self.d._name, bit.size, bit.price)
+        if self.p.recorder:
+            self.p.recorder.order(self.d._name, order)
+        if order.status in [order.Submitted, order.Accepted, order.Partial]:
             return
 
         if order.status in [order.Completed]:
             self.units = self.new_units
             self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
-            position = self.broker.getposition(self.data0)            
+            position = self.broker.getposition(self.d)            
             if order.isbuy():
                 self.log(
-                    'BUY EXECUTED, Price: %.4f, Cost: %.4f, Position: %.4f' %
-                    (order.executed.price,
-                     order.executed.value,
-                     position.size))
+                    'BUY EXECUTED, Price: %.4f, Cost: %.4f, Position: %.4f',
+                    order.executed.price,
+                    order.executed.value,
+                    position.size)
 
             else:  # Sell
-                self.log('SELL EXECUTED, Price: %.4f, Cost: %.4f, Position: %.4f' %
-                         (order.executed.price,
-                          order.executed.value,
-                          position.size))
+                self.log('SELL EXECUTED, Price: %.4f, Cost: %.4f, Position: %.4f',
+                         order.executed.price,
+                         order.executed.value,
+                         position.size)
 
-        elif order.status in [order.Canceled, order.Margin, order.Rejected]:
+        elif order.status in [order.Canceled, order.Margin, order.Rejected, order.Expired]:
             self.log('Order Canceled/Margin/Rejected')
+            if order.executed.size:  # partially filled before it ended
+                self.resync()
+        self.checkpoint()
+
+    def resync(self):
+        '''The real position is unknown: wait for a reconciliation check'''
+        if self.reconciler:
+            self.unsure = self.reconciler.checks
+            self.reconciler.request()
+        else:
+            # cheat as order.completed
+            self.units = self.new_units
+            self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
+            self.checkpoint()
+
+    def reconcile(self, size):
+        units = int(size / self.p.value_unit)
+        self.log('Reconciled, Position: %d, units: %d -> %d', size, self.units, units)
+        self.units = self.new_units = units
+        self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
+        self.checkpoint()
+
+    def checkpoint(self, force=False):
+        '''Save the state to the snapshot if it changed since the last save'''
+        if not self.snapshot:
+            return
+        pending = self.orders.pending()
+        key = (self.units, self.new_units, self.count, pending.ref if pending else 0)
+        if key == self.saved and not force:
+            return  # prev_close alone only dedups the price log lines, it goes with the next save
+        position = self.broker.getposition(self.d)
+        self.snapshot.save(instrument=self.d._name, units=self.units, new_units=self.new_units,
+                           count=self.count, pending_ref=key[3],
+                           pending_units=pending.target_units if pending else 0,
+                           prev_close=self.prev_close, position_size=position.size,
+                           position_price=position.price, price_base=self.p.price_base,
+                           price_unit=self.p.price_unit, value_unit=self.p.value_unit)
+        self.saved = key
 
-        # Write down: no pending order
-        self.order = None
+    def restore(self, position):
+        '''
+        Units to start with: the snapshot's, checked against the broker
+        position. An order pending at the snapshot counts as filled when the
+        position is its target; any other mismatch goes with the broker.
+        '''
+        broker_units = int(position.size / self.p.value_unit)
+        state = self.snapshot.load() if self.snapshot else None
+        if state is None:
+            return broker_units
+        if (state['instrument'] != self.d._name or state['price_base'] != self.p.price_base or
+                state['price_unit'] != self.p.price_unit or state['value_unit'] != self.p.value_unit):
+            self.log('State snapshot of another instrument or grid ignored', dt=datetime.now())
+            return broker_units
+        self.count = state['count']
+        self.prev_close = state['prev_close']
+        units = state['units']
+        if state['pending_ref'] and broker_units == state['pending_units']:
+            units = broker_units  # filled while we were down
+        if units != broker_units:
+            self.log('State snapshot units: %d, broker position units: %d, the broker wins',
+                     units, broker_units, dt=datetime.now())
+            units = broker_units
+        self.log('State restored, saved: %s, count: %d, units: %d, pending order: %d',
+                 datetime.fromtimestamp(state['saved_ns'] / 1e9), self.count, units,
+                 state['pending_ref'], dt=datetime.now())
+        return units
 
     def next(self):
-        if self.order:
-            if (datetime.now() - self.order_time).total_seconds() > 60: # order time out
-                self.log('Order Timeout')
-                position = self.broker.getserverposition(self.data0, update_latest=True)
-                # position = self.broker.getposition(self.data0)
-                self.log('Position size: %d, price: %.4f' % (position.size, position.price))
-                self.order = None
-                # cheat as order.completed
-                self.units = self.new_units
-                self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
+        # with several instruments next() runs when any of the datas ticks
+        if len(self.d) == self.last_len:
+            return
+        self.last_len = len(self.d)
+        if self.p.monitor:
+            self.p.monitor.price(self.d._name, self.d.close[0])
+            if self.p.monitor.level != self.risk_level:
+                self.risk_level = self.p.monitor.level
+                self.log('Risk monitor: %s, %s', LiveRisk.LEVELS[self.risk_level], self.p.monitor.reason)
+
+        if self.orders.pending():
+            # timed out orders are canceled, a canceled order is replaced by
+            # the next evaluation at the then current price
+            for tracked in self.orders.check():
+                self.log('Order Timeout, ref: %d, no cancel confirmation', tracked.ref)
+                self.resync()
+            return
+        if self.unsure is not None:
+            if self.reconciler.checks == self.unsure:
+                return
+            self.unsure = None
+        correction = self.reconciler.take() if self.reconciler else None
+        if correction:
+            self.reconcile(correction[0])
+        if self.risk_level == LiveRisk.FLATTEN:
+            if self.units:
+                self.flatten()
             return
         
-        self.order_time = datetime.now()
-            
-        str_close = '%.4f' % (self.data0.close[0])
-        if str_close != self.prev_close:
-            self.log('%s --- %d' % (str_close, self.new_units))
-            self.prev_close = str_close
-        diff_units = -1 * int((self.data0.close[0] - self.price_position)/self.p.price_unit)
+        close = self.d.close[0]
+        close4 = round(close, 4)  # same value as the old '%.4f' string, without formatting every tick
+        if close4 != self.prev_close:
+            if self.p.log_level > 1:
+                self.log('%.4f --- %d', close4, self.new_units)
+            self.prev_close = close4
+        diff_units = -1 * int((close - self.price_position)/self.p.price_unit)
         if diff_units != 0 and abs(self.units+diff_units) <= self.p.max_unit:
+            if ((self.p.risk and not self.p.risk.allow(self, diff_units)) or
+                    (self.p.monitor and not self.p.monitor.allow(self.units, diff_units))):
+                if diff_units != self.risk_skipped:
+                    self.log('Risk check: %d units skipped', diff_units)
+                    self.risk_skipped = diff_units
+                return
+            self.risk_skipped = 0
             self.count += 1
             self.new_units = self.units + diff_units
-            position = self.broker.getposition(self.data0)
-            value = self.broker.getvalue()
-            cash = self.broker.getcash()
-            self.log('count: %d, price: %.4f, unit: %d, value: %.2f, cash: %.2f, posi_size: %d, posi_price: %.4f' % \
-                     (self.count, self.data0.close[0], diff_units, value, cash, position.size, position.price))
-            self.csvwriter.writerow([self.datetime.datetime().strftime('%Y-%m-%d %H:%M:%S'), \
-                                   '%d' % self.count, \
-                                   '%.4f' % self.data0.close[0], \
-                                   '%d' % diff_units, \
-                                   '%.2f' % value, \
-                                   '%.2f' % cash, \
-                                   '%d' % position.size, \
-                                    '%.4f' % position.price])
-            self.csvfile.flush()
             if diff_units < 0:
-                self.order = self.sell(size=self.p.value_unit*abs(diff_units), price=self.data0.close[0])
+                order = self.sell(data=self.d, size=self.p.value_unit*abs(diff_units), price=close)
             else:
-                self.order = self.buy(size=self.p.value_unit*abs(diff_units), price=self.data0.close[0])
+                order = self.buy(data=self.d, size=self.p.value_unit*abs(diff_units), price=close)
+            self.orders.track(order, self.new_units)
+            # receive -> submit latency, only feeds with TickStamp provide recv_ns
+            recv_ns = getattr(self.d, 'recv_ns', None)
+            if recv_ns:
+                self.latency.record_since(recv_ns)
+
+            # account snapshot for the log, read after the order is on its way
+            position = self.broker.getposition(self.d)
+            value = self.broker.getvalue()
+            cash = self.broker.getcash()
+            self.log('count: %d, price: %.4f, unit: %d, value: %.2f, cash: %.2f, posi_size: %d, posi_price: %.4f',
+                     self.count, close, diff_units, value, cash, position.size, position.price)
+            self.journal.activity(self.d.datetime.datetime(), self.count, close, diff_units,
+                                  value, cash, position.size, position.price)
+            self.checkpoint()
+
+    def flatten(self):
+        '''Close the position on the risk monitor's request, the grid stays halted'''
+        self.log('Risk monitor: flatten %d units', self.units)
+        # sized from the units, the broker position may be a snapshot from before the last fill
+        size = self.p.value_unit * abs(self.units)
+        self.count += 1
+        self.new_units = 0
+        if self.units > 0:
+            order = self.sell(data=self.d, size=size, price=self.d.close[0])
+        else:
+            order = self.buy(data=self.d, size=size, price=self.d.close[0])
+        self.orders.track(order, self.new_units)
+        self.checkpoint()
 
     def start(self):
-        self.logfile = open('access.log', 'a')
-        self.csvfile = open('OandaActivity.csv', 'w')
-        self.csvwriter = csv.writer(self.csvfile)
-        self.csvwriter.writerow((['datetime', 'count', 'price', 'unit', 'value', 'cash', 'posi_value', 'posi_price']))
+        self.journal = LiveLog.Journal(**self.p.log)
+        if self.p.profiler:
+            name = self.d._name
+            self.p.profiler.wrap(self, ('next', 'notify_order', 'log'), name)
+            self.p.profiler.wrap(self.journal, ('log', 'activity'), '%s.journal' % name)
+            self.p.profiler.wrap(self.broker, ('getposition', 'getvalue', 'getcash', 'buy', 'sell',
+                                               'cancel'), 'broker')
+        self.orders = OrderTracker.OrderTracker(self.broker, timeout=self.p.order_timeout)
+        if self.p.reconcile_interval and hasattr(self.broker, 'getserverposition'):
+            self.reconciler = OrderTracker.Reconciler(
+                self.broker, self.d, self.orders,
+                lambda size: int(size / self.p.value_unit) == self.units,
+                interval=self.p.reconcile_interval)
+            self.reconciler.start()
+        if self.p.risk:
+            self.p.risk.register(self)
         self.done = False
-        position = self.broker.getposition(self.data0)
-        self.units = int(position.size / self.p.value_unit)
+        position = self.broker.getposition(self.d)
+        if self.p.state:
+            self.snapshot = LiveState.Snapshot(self.p.state)
+        self.units = self.restore(position)
         self.new_units = self.units
         self.price_position = self.p.price_base - self.p.price_unit * self.units # <0: sell
-        self.log('Initialization, Position: %d, %.4f, uints: %d' % (position.size, position.price, self.units), 
+        if self.p.recorder:
+            self.p.recorder.position(self.d._name, position.size, position.price, self.broker.getcash())
+        if self.p.monitor:
+            self.p.monitor.position(self.d._name, position.size, position.price)
+            self.p.monitor.start(self.broker.getvalue())
+        self.log('Initialization, Position: %d, %.4f, uints: %d', position.size, position.price, self.units,
                  dt=datetime.now())
+        self.checkpoint(force=True)
+
+    def stop(self):
+        if self.reconciler:
+            self.reconciler.stop()
+        if self.latency.count:
+            self.log(self.latency.summary(), dt=datetime.now())
+            print(self.latency.summary())
+        if self.p.profiler:
+            for line in self.p.profiler.dump():
+                self.log(line, dt=datetime.now())
+                print(line)
+        self.checkpoint(force=True)
+        if self.snapshot:
+            self.snapshot.close()
+        self.journal.close()
+        if self.p.recorder:
+            self.p.recorder.flush()
+        if self.journal.dropped:
+            print('Journal dropped %d records' % self.journal.dropped)
+
+class TickStamp(object):
+    '''
+    Mixin for a live data feed: stamps time.perf_counter_ns() when a tick (or
+    bar) is handed to the system, the start of the tick->order latency.
+    With a `recorder` (LiveReplay.Recorder) every tick is also recorded.
+    '''
+    recv_ns = None
+    recorder = None
+
+    def _load(self):
+        ret = super(TickStamp, self)._load()
+        if ret:
+            self.recv_ns = time.perf_counter_ns()
+            if self.recorder:
+                self.recorder.tick(self)
+        return ret
+
+
+class AccountRisk(object):
+    '''
+    Account level check shared by the strategies of all instruments.
+      - `max_exposure`: limit of the summed absolute target position sizes
+      - `min_cash`: cash (free margin) the account must keep before an order
+    '''
+    def __init__(self, max_exposure=None, min_cash=0.0):
+        self.max_exposure = max_exposure
+        self.min_cash = min_cash
+        self.strategies = []
+
+    def register(self, strategy):
+        self.strategies.append(strategy)
+
+    def exposure(self, strategy=None, diff_units=0):
+        total = 0
+        for s in self.strategies:
+            units = s.units + diff_units if s is strategy else max(abs(s.units), abs(s.new_units))
+            total += abs(units) * s.p.value_unit
+        return total
+
+    def allow(self, strategy, diff_units):
+        if self.min_cash and strategy.broker.getcash() < self.min_cash:
+            return False
+        if self.max_exposure and self.exposure(strategy, diff_units) > self.max_exposure:
+            return False
+        return True
+
+
+def load_instruments(config):
+    '''
+    {name: strategy params} from the "instruments" block of config.json.
+    Without it the original single EUR_USD setup is used.
+    '''
+    instruments = config.get("instruments")
+    if not instruments:
+        return {"EUR_USD": {}}
+    return dict((name, dict(params)) for name, params in instruments.items())
+
+
+if __name__ == '__main__':
+    import btoandav20  # only the live run needs it, LiveReplay works offline
+    import LiveReplay
+    import OandaClient
+    import os
+    import signal
+
+    cerebro = bt.Cerebro()
+
+    with open("config.json", "r") as file:
+        config = json.load(file)
+
+    storekwargs = dict(
+        token=config["oanda"]["token"],
+        account=config["oanda"]["account"],
+        practice=config["oanda"]["practice"],
+    )
+    # one store (one account connection) for all instruments
+    store = btoandav20.stores.OandaV20Store(**storekwargs)
+
+    datakwargs = dict(
+        timeframe=bt.TimeFrame.Minutes,
+        compression=1,
+        qcheck=1.0,
+        historical=False,
+        fromdate=None,
+        bidask=None,
+        useask=None,
+        backfill_start=False,
+        backfill=False,
+        tz='America/New_York',
+    )
+    # "feed": {"timeframe": "Ticks", "qcheck": 0.05} evaluates the grid on every streaming price
+    feed = dict(config.get("feed", {}))
+    if "timeframe" in feed:
+        feed["timeframe"] = getattr(bt.TimeFrame, feed["timeframe"])
+    datakwargs.update(feed)
+
+    class StampedOandaV20Data(TickStamp, btoandav20.feeds.OandaV20Data):
+        pass
+
+    # "record": "session.rec" writes the feed and the orders for LiveReplay.py
+    recorder = LiveReplay.Recorder(config["record"]) if config.get("record") else None
+
+    # "profile": true times the strategy callbacks, journal writes and broker
+    # calls, kill -USR1 <pid> prints the counters while running
+    profiler = LiveMetrics.CallProfiler() if config.get("profile") else None
+    if profiler:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print('\n'.join(profiler.summary())))
+
+    instruments = load_instruments(config)
+    risk = AccountRisk(**config.get("risk", {}))
+    # "monitor": margin ratio / drawdown thresholds of the LiveRisk.RiskMonitor thread, null: off
+    monitor = LiveRisk.RiskMonitor(**config["monitor"]) if config.get("monitor") else None
+    for name, params in instruments.items():
+        data = StampedOandaV20Data(dataname=name, **datakwargs)
+        data.recorder = recorder
+        cerebro.adddata(data, name=name)
+
+        log = dict(config.get("log", {}))
+        # "state": "state.bin" checkpoints the strategy state for a warm restart
+        state = config.get("state")
+        if len(instruments) > 1:
+            log.update(logpath='access_%s.log' % name, csvpath='OandaActivity_%s.csv' % name,
+                       jsonpath='journal_%s.jsonl' % name)
+            if state:
+                state = '%s_%s%s' % (os.path.splitext(state)[0], name, os.path.splitext(state)[1])
+        cerebro.addstrategy(SeizeVolatilityStrategy, instrument=name, risk=risk, log=log,
+                            recorder=recorder, profiler=profiler, state=state, monitor=monitor,
+                            **dict(config.get("orders", {}), **params))
+    # "client": {"ttl": 1.0, "pool": 4} answers getcash/getvalue/getposition/getserverposition
+    # from account snapshots cached by OandaClient.py instead of a REST call per use
+    client = None
+    if config.get("client"):
+        class CachedOandaV20Broker(OandaClient.CachedAccount, btoandav20.brokers.OandaV20Broker):
+            pass
+
+        client = OandaClient.OandaClient(**dict(storekwargs, **config["client"]))
+        broker = CachedOandaV20Broker()  # same singleton store as store.getbroker()
+        broker.client = client
+        cerebro.setbroker(broker)
+    else:
+        cerebro.setbroker(store.getbroker())
 
-cerebro = bt.Cerebro()
-
-with open("config.json", "r") as file:
-    config = json.load(file)
-
-storekwargs = dict(
-    token=config["oanda"]["token"],
-    account=config["oanda"]["account"],
-    practice=config["oanda"]["practice"],
-)
-store = btoandav20.stores.OandaV20Store(**storekwargs)
-
-datakwargs = dict(
-    timeframe=bt.TimeFrame.Minutes,
-    compression=1,
-    qcheck=1.0,
-    historical=False,
-    fromdate=None,
-    bidask=None,
-    useask=None,
-    backfill_start=False,
-    backfill=False,
-    tz='America/New_York',
-)
-
-data = store.getdata(dataname="EUR_USD", **datakwargs)
-cerebro.adddata(data)
-cerebro.setbroker(store.getbroker())
-
-cerebro.addstrategy(SeizeVolatilityStrategy)
-
-print('LiveVolatility start...')
-cerebro.run()
\ No newline at end of file
+    print('LiveVolatility start: %s' % ', '.join(instruments))
+    try:
+        cerebro.run()
+    finally:
+        if recorder:
+            recorder.close()
+        if client:
+            client.close()
+        if monitor:
+            monitor.stop()
+            print(monitor.summary())
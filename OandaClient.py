@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+import backtrader as bt
+import argparse
+import asyncio
+import json
+import ssl as _ssl
+import threading
+import time
+
+HOSTS = dict(practice='api-fxpractice.oanda.com', live='api-fxtrade.oanda.com')
+# snapshot name -> REST path of the account
+PATHS = dict(account='/v3/accounts/%s/summary', positions='/v3/accounts/%s/openPositions')
+ACCOUNT_FIELDS = ('balance', 'NAV', 'marginAvailable', 'marginUsed', 'unrealizedPL')
+
+
+class OandaError(Exception):
+    '''An Oanda REST request answered with an error status'''
+    pass
+
+
+def parse_account(data):
+    '''Account summary response -> {ACCOUNT_FIELDS: float}'''
+    account = data['account']
+    return dict((k, float(account[k])) for k in ACCOUNT_FIELDS if k in account)
+
+
+def parse_positions(data):
+    '''Open positions response -> {instrument: (units, average price)}, short units < 0'''
+    positions = {}
+    for p in data.get('positions', []):
+        long, short = p.get('long', {}), p.get('short', {})
+        long_units, short_units = float(long.get('units', 0)), float(short.get('units', 0))
+        side = long if long_units else short
+        positions[p['instrument']] = (long_units + short_units, float(side.get('averagePrice', 0.0)))
+    return positions
+
+
+PARSE = dict(account=parse_account, positions=parse_positions)
+
+
+class HTTPPool(object):
+    '''
+    Keep-alive HTTP/1.1 connections to one host on asyncio streams, at most
+    `size` requests in flight. Idle connections are reused; a request on a
+    reused connection the server has closed meanwhile is sent again on a
+    new one.
+    '''
+    def __init__(self, host, port=443, ssl=True, size=4, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.ssl = _ssl.create_default_context() if ssl is True else (ssl or None)
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.connects = 0
+        self.requests = 0
+        self._slots = None  # asyncio.Semaphore, created on the loop
+
+    async def request(self, method, path, headers=None, body=None):
+        '''(status, body bytes)'''
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        async with self._slots:
+            return await asyncio.wait_for(self._request(method, path, headers or {}, body), self.timeout)
+
+    async def _request(self, method, path, headers, body):
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+                self.connects += 1
+            try:
+                status, keep, payload = await self._exchange(reader, writer, method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:  # timeout or cancel in the middle of a response
+                writer.close()
+                raise
+            if keep:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            self.requests += 1
+            return status, payload
+
+    async def _exchange(self, reader, writer, method, path, headers, body):
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.host]
+        lines += ['%s: %s' % kv for kv in headers.items()]
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by %s' % self.host)
+        version, status = status_line.decode('latin-1').split(' ', 2)[:2]
+        fields = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            fields[name.strip().lower()] = value.strip()
+        keep = version == 'HTTP/1.1' and fields.get('connection', '').lower() != 'close'
+        if 'content-length' in fields:
+            payload = await reader.readexactly(int(fields['content-length']))
+        elif fields.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            payload = b''.join(chunks)
+        else:
+            payload = await reader.read()
+            keep = False
+        return int(status), keep, payload
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+class OandaClient(object):
+    '''
+    Oanda v20 REST client on its own asyncio loop (a daemon thread), for
+    the synchronous strategy callbacks:
+      - one HTTPPool of keep-alive connections for every request
+      - account summary and open positions snapshots, cached `ttl` seconds
+      - concurrent requests of the same snapshot share one round trip
+      - a stale snapshot (up to `max_stale` seconds) is served right away
+        while a background refresh runs, unless it was requested before the
+        last invalidate(), see snapshot()
+    '''
+    def __init__(self, token, account, practice=True, host=None, port=443, ssl=True, ttl=1.0,
+                 max_stale=30.0, pool=4, timeout=5.0):
+        self.account = account
+        self.headers = {'Authorization': 'Bearer %s' % token, 'Accept': 'application/json'}
+        self.pool = HTTPPool(host or HOSTS['practice' if practice else 'live'], port, ssl, pool, timeout)
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.snapshots = {}  # name -> (monotonic time the request started, value)
+        self.invalidated = -float('inf')  # monotonic time of the last invalidate()
+        self.hits = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.last_error = None
+        self._inflight = {}  # name -> (start time, asyncio.Task) shared by the concurrent requests
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='OandaClient', daemon=True)
+        self._thread.start()
+
+    async def fetch(self, name, after=-float('inf')):
+        '''
+        Fresh snapshot `name`, one request for all the concurrent callers. A
+        request in flight is only shared if it started after `after`.
+        '''
+        started, task = self._inflight.get(name, (None, None))
+        if task is None or started <= after:
+            started = time.monotonic()
+            task = self.loop.create_task(self._fetch(name, started))
+            self._inflight[name] = (started, task)
+            task.add_done_callback(lambda t: self._inflight.get(name, (None, None))[1] is t and
+                                   self._inflight.pop(name))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, name, started):
+        status, payload = await self.pool.request('GET', PATHS[name] % self.account, self.headers)
+        data = json.loads(payload) if payload else {}
+        if status != 200:
+            raise OandaError('%s: HTTP %d %s' % (name, status, data.get('errorMessage', '')))
+        value = PARSE[name](data)
+        if started > self.snapshots.get(name, (-float('inf'),))[0]:  # an older request may end last
+            self.snapshots[name] = (started, value)
+        self.refreshes += 1
+        return value
+
+    def _background(self, name):
+        if name in self._inflight and self._inflight[name][0] > self.invalidated:
+            return
+        task = self.loop.create_task(self.fetch(name, self.invalidated))
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            self.last_error = task.exception()
+
+    def snapshot(self, name, refresh=False):
+        '''
+        Snapshot `name` ('account' or 'positions') from any thread. Within
+        `ttl` it is the cached one. When older, refresh=True waits for a new
+        one; otherwise the stale one is returned and refreshed in the
+        background, unless there is none (or it is older than max_stale).
+        A snapshot requested before the last invalidate() is never served:
+        the read waits for one requested after it.
+        '''
+        cached = self.snapshots.get(name)
+        invalidated = self.invalidated
+        if cached and cached[0] > invalidated:
+            age = time.monotonic() - cached[0]
+            if age < self.ttl:
+                self.hits += 1
+                return cached[1]
+            if not refresh and age < self.max_stale:
+                self.loop.call_soon_threadsafe(self._background, name)
+                self.hits += 1
+                return cached[1]
+        future = asyncio.run_coroutine_threadsafe(self.fetch(name, invalidated), self.loop)
+        return future.result(self.pool.timeout * 2)
+
+    def fresh(self, name):
+        '''Snapshot `name` was requested after the last invalidate(), without waiting'''
+        cached = self.snapshots.get(name)
+        return cached is not None and cached[0] > self.invalidated
+
+    def prefetch(self, name):
+        '''Refresh snapshot `name` in the background, from any thread'''
+        self.loop.call_soon_threadsafe(self._background, name)
+
+    def invalidate(self):
+        '''
+        The account changed (a fill): the snapshots requested until now are
+        out of date. They are refreshed in the background, and a read before
+        the refresh arrives waits for it.
+        '''
+        self.invalidated = time.monotonic()
+        for name in list(self.snapshots):
+            self.loop.call_soon_threadsafe(self._background, name)
+
+    async def _cancel(self):
+        tasks = [task for _, task in self._inflight.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._cancel(), self.loop).result(1.0)
+        self.pool.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(1.0)
+
+
+class CachedAccount(object):
+    '''
+    Mixin for the live broker (see LiveVolatility.py): getcash, getvalue,
+    getposition and getserverposition are answered from the snapshots of
+    `client` (an OandaClient) instead of a REST round trip in the strategy
+    callbacks. Fills invalidate the snapshots.
+      - getcash: marginAvailable, getvalue: NAV. The first of them after a
+        fill waits for a snapshot requested after it: a REST round trip on
+        the calling thread, the strategy thread in notify_order/checkpoint
+      - getposition(clone=False) is the broker's own Position, updated by
+        the fills; the clones are served from the snapshot, or from the
+        broker's Position until a snapshot newer than the last fill arrives
+      - getserverposition(update_latest=True) waits for a fresh snapshot, it
+        runs on the Reconciler thread
+    '''
+    client = None
+
+    def getcash(self):
+        return self.client.snapshot('account')['marginAvailable']
+
+    def getvalue(self, datas=None):
+        if datas:
+            return super(CachedAccount, self).getvalue(datas)
+        return self.client.snapshot('account')['NAV']
+
+    def _position(self, data, refresh=False):
+        size, price = self.client.snapshot('positions', refresh).get(data._dataname, (0.0, 0.0))
+        return bt.Position(size, price)
+
+    def getposition(self, data, clone=True):
+        if not clone:
+            return super(CachedAccount, self).getposition(data, clone=False)
+        if not self.client.fresh('positions'):
+            self.client.prefetch('positions')
+            return super(CachedAccount, self).getposition(data, clone=clone)
+        return self._position(data)
+
+    def getserverposition(self, data, update_latest=False):
+        return self._position(data, refresh=update_latest)
+
+    def notify(self, order):
+        super(CachedAccount, self).notify(order)
+        if order.status in (order.Partial, order.Completed):
+            self.client.invalidate()
+
+
+class MockOanda(object):
+    '''
+    Local stand-in for the Oanda v20 REST API: account summary and open
+    positions of one account, served by an asyncio server on its own
+    thread. Every response waits `latency` seconds; `status` other than 200
+    makes every request fail.
+    '''
+    def __init__(self, account='101-001-0000000-001', latency=0.0, balance=1000.0):
+        self.account = account
+        self.latency = latency
+        self.status = 200
+        self.summary = dict(balance=balance, NAV=balance, marginAvailable=balance, marginUsed=0.0,
+                            unrealizedPL=0.0)
+        self.positions = {}  # instrument -> (units, average price)
+        self.requests = 0
+        self.connections = 0
+        self.port = None
+        self._writers = set()
+        self._handlers = set()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='MockOanda', daemon=True)
+
+    def start(self, host='127.0.0.1', port=0):
+        self._thread.start()
+        server = asyncio.run_coroutine_threadsafe(asyncio.start_server(self._serve, host, port), self.loop)
+        self.server = server.result()
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(1.0)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(1.0)
+
+    async def _close(self):
+        self.server.close()
+        for writer in self._writers:
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def answer(self, path, headers):
+        if not headers.get('authorization', '').startswith('Bearer '):
+            return 401, dict(errorMessage='Insufficient authorization to perform request.')
+        if self.status != 200:
+            return self.status, dict(errorMessage='Service unavailable')
+        if path == PATHS['account'] % self.account:
+            account = dict((k, '%.4f' % v) for k, v in self.summary.items())
+            return 200, dict(account=dict(account, id=self.account), lastTransactionID='1')
+        if path == PATHS['positions'] % self.account:
+            positions = []
+            for instrument, (units, price) in self.positions.items():
+                side = dict(units='%d' % units, averagePrice='%.5f' % price)
+                flat = dict(units='0')
+                positions.append(dict(instrument=instrument, long=side if units > 0 else flat,
+                                      short=side if units < 0 else flat))
+            return 200, dict(positions=positions, lastTransactionID='1')
+        return 404, dict(errorMessage='The requested URL was not found.')
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                path = line.decode('latin-1').split(' ')[1]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if 'content-length' in headers:
+                    await reader.readexactly(int(headers['content-length']))
+                self.requests += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status, data = self.answer(path, headers)
+                body = json.dumps(data).encode()
+                writer.write(b'HTTP/1.1 %d -\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                             % (status, len(body)) + body)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self._writers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+
+
+def check(latency=0.05, ttl=0.2, callers=50):
+    '''Exercise an OandaClient against a MockOanda, prints what it measured'''
+    mock = MockOanda(latency=latency)
+    port = mock.start()
+    mock.positions['EUR_USD'] = (1200, 1.0812)
+    client = OandaClient('mock-token', mock.account, host='127.0.0.1', port=port, ssl=False, ttl=ttl)
+    try:
+        # concurrent first reads: one request
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.snapshot('account')))
+                   for _ in range(callers)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print('%d concurrent callers: %d request(s), %.1fms, NAV %.2f' % (
+            callers, mock.requests, (time.perf_counter() - start) * 1e3, results[0]['NAV']))
+
+        # cached reads
+        calls = 10000
+        start = time.perf_counter()
+        for _ in range(calls):
+            client.snapshot('account')
+        print('cached: %.2fus per call, %d request(s)' % ((time.perf_counter() - start) / calls * 1e6,
+                                                          mock.requests))
+
+        # stale: served at once, refreshed in the background
+        time.sleep(ttl)
+        mock.summary['NAV'] = 1010.0
+        start = time.perf_counter()
+        stale = client.snapshot('account')['NAV']
+        served = time.perf_counter() - start
+        time.sleep(latency * 3)
+        print('stale read: %.3fms (NAV %.2f), after the refresh: NAV %.2f, %d requests' % (
+            served * 1e3, stale, client.snapshot('account')['NAV'], mock.requests))
+
+        # positions, and a fill invalidating them
+        print('position: %s' % (client.snapshot('positions')['EUR_USD'],))
+        mock.positions['EUR_USD'] = (-600, 1.0820)
+        client.invalidate()
+        start = time.perf_counter()
+        position = client.snapshot('positions')['EUR_USD']
+        print('read right after invalidate: %s in %.1fms, %d requests' % (
+            position, (time.perf_counter() - start) * 1e3, mock.requests))
+
+        # errors: the last snapshot is served until max_stale, a refresh raises
+        mock.status = 503
+        time.sleep(ttl)
+        client.snapshot('account')
+        time.sleep(latency * 3)
+        try:
+            client.snapshot('account', refresh=True)
+            failed = None
+        except OandaError as e:
+            failed = e
+        print('server errors: stale served, %d background error(s), refresh raised: %s' % (
+            client.errors, failed))
+        print('connections: %d opened by the client, %d accepted by the server, %d requests'
+              % (client.pool.connects, mock.connections, mock.requests))
+    finally:
+        client.close()
+        mock.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the cached Oanda client against a local mock server')
+    parser.add_argument('--latency', type=float, default=0.05, help='mock server seconds per response')
+    parser.add_argument('--ttl', type=float, default=0.2)
+    parser.add_argument('--callers', type=int, default=50)
+    args = parser.parse_args()
+    check(args.latency, args.ttl, args.callers)
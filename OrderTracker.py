@@ -0,0 +1,183 @@
+import threading
+import time
+
+# order states
+SUBMITTED = 'Submitted'    # sent by the strategy, not confirmed yet
+ACCEPTED = 'Accepted'      # confirmed by the broker, waiting for the fill
+PARTIAL = 'Partial'
+CANCELING = 'Canceling'    # timed out, cancel requested
+FILLED = 'Filled'
+CANCELED = 'Canceled'
+REJECTED = 'Rejected'      # Margin/Rejected/Expired
+
+FINAL = (FILLED, CANCELED, REJECTED)
+
+# bt.Order status -> state
+_STATES = {
+    'Submitted': SUBMITTED,
+    'Accepted': ACCEPTED,
+    'Partial': PARTIAL,
+    'Completed': FILLED,
+    'Canceled': CANCELED,
+    'Expired': REJECTED,
+    'Margin': REJECTED,
+    'Rejected': REJECTED,
+}
+
+
+class TrackedOrder(object):
+    def __init__(self, order, target_units):
+        self.order = order
+        self.ref = order.ref
+        self.target_units = target_units
+        self.state = SUBMITTED
+        self.sent = time.monotonic()
+        self.changed = self.sent
+        self.filled = 0.0
+
+    @property
+    def final(self):
+        return self.state in FINAL
+
+
+class OrderTracker(object):
+    '''
+    Explicit state machine for the orders of one strategy.
+
+      Submitted -> Accepted -> (Partial) -> Filled
+                                         -> Canceled / Rejected
+      Submitted/Accepted/Partial --timeout--> Canceling -> Canceled / Filled
+
+    `timeout` (seconds, sub-second values are fine) is measured from the
+    last state change. A timed out order is canceled; the strategy sends a
+    replacement on its next evaluation, at the then current price, once the
+    cancel is confirmed. A cancel that is not confirmed within `timeout`
+    is dropped and the position is left to the Reconciler.
+    '''
+    def __init__(self, broker, timeout=0.5):
+        self.broker = broker
+        self.timeout = timeout
+        self.orders = {}
+        self.generation = 0  # bumped on every order event, see Reconciler
+
+    def track(self, order, target_units):
+        tracked = TrackedOrder(order, target_units)
+        self.orders[order.ref] = tracked
+        self.generation += 1
+        return tracked
+
+    def pending(self):
+        return next((o for o in list(self.orders.values()) if not o.final), None)
+
+    def update(self, order):
+        '''Apply a notify_order notification, returns the TrackedOrder (or None)'''
+        tracked = self.orders.get(order.ref)
+        if tracked is None:
+            return None
+        state = _STATES.get(order.getstatusname(), tracked.state)
+        if tracked.state == CANCELING and state in (SUBMITTED, ACCEPTED):
+            state = CANCELING  # late confirmation of an order being canceled
+        tracked.state = state
+        tracked.filled = order.executed.size
+        tracked.changed = time.monotonic()
+        self.generation += 1
+        if tracked.final:
+            del self.orders[order.ref]
+        return tracked
+
+    def check(self, now=None):
+        '''Cancel timed out orders, returns the orders given up on'''
+        now = now or time.monotonic()
+        dropped = []
+        for tracked in list(self.orders.values()):
+            if now - tracked.changed < self.timeout:
+                continue
+            if tracked.state == CANCELING:
+                # no cancel confirmation either: stop waiting, reconcile later
+                del self.orders[tracked.ref]
+                self.generation += 1
+                dropped.append(tracked)
+            else:
+                tracked.state = CANCELING
+                tracked.changed = now
+                self.broker.cancel(tracked.order)
+        return dropped
+
+
+class Reconciler(object):
+    '''
+    Background check of the local position against the broker.
+
+    Every `interval` seconds a thread reads the server position (the REST
+    round trip stays off the strategy thread) and checks it with
+    `matches(size)`. A difference seen twice in a row with no order event in
+    between is published as a correction; the strategy applies it with
+    take() on its next evaluation. request() runs a check right away and
+    trusts a single read (used after an order was given up).
+    '''
+    def __init__(self, broker, data, tracker, matches, interval=5.0):
+        self.broker = broker
+        self.data = data
+        self.tracker = tracker
+        self.matches = matches
+        self.interval = interval
+        self.checks = 0
+        self.corrections = 0
+        self._suspect = None
+        self._correction = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._requested = False
+        self._thread = threading.Thread(target=self._run, name='Reconciler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def request(self):
+        self._requested = True
+        self._wake.set()
+
+    def take(self):
+        '''(server size, generation) correction if one is waiting, else None'''
+        with self._lock:
+            correction, self._correction = self._correction, None
+        if correction and correction[1] != self.tracker.generation:
+            return None  # an order event happened since, the next check decides
+        return correction
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            requested, self._requested = self._requested, False
+            try:
+                self.check(confirm=1 if requested else 2)
+            except Exception as e:  # network errors: try again next interval
+                self._requested = self._requested or requested
+                print('Reconciler: %s' % e)
+
+    def check(self, confirm=2):
+        generation = self.tracker.generation
+        if self.tracker.pending():
+            self._suspect = None
+            return
+        size = self.broker.getserverposition(self.data, update_latest=True).size
+        if self.matches(size) or generation != self.tracker.generation:
+            self._suspect = None
+            self.checks += 1
+            return
+        if confirm == 1 or self._suspect == (size, generation):
+            with self._lock:
+                self._correction = (size, generation)
+            self.corrections += 1
+            self._suspect = None
+        else:
+            self._suspect = (size, generation)
+        self.checks += 1
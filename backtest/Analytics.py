@@ -0,0 +1,143 @@
+import backtrader as bt
+import numpy as np
+import csv
+
+# executions of a run, one row per completed (or partially filled) order
+FILL_DTYPE = np.dtype([('dt', 'f8'),  # bt date number of the execution
+                       ('size', 'f8'),
+                       ('price', 'f8')])
+
+
+class RunRecord(object):
+    '''
+    Arrays of a finished run, read once after cerebro.run() from what
+    backtrader keeps anyway (Broker observer lines, data lines, the
+    strategy's orders and trades), so no analyzer runs per bar:
+      - `dt`, `value`, `cash`, `close`: one entry per bar
+      - `fills`: FILL_DTYPE executions
+      - `pnl`: net PnL of every closed trade
+    '''
+    def __init__(self, strategy):
+        n = len(strategy)
+        broker = next(o for o in strategy.observers if isinstance(o, bt.observers.Broker))
+        data = strategy.data
+        self.dt = np.asarray(data.datetime.array[:n], dtype=np.float64)
+        self.close = np.asarray(data.close.array[:n], dtype=np.float64)
+        self.value = np.asarray(broker.lines.value.array[:n], dtype=np.float64)
+        self.cash = np.asarray(broker.lines.cash.array[:n], dtype=np.float64)
+
+        orders = dict((o.ref, o) for o in strategy._orders)  # last notification of each order
+        executed = [o for o in orders.values() if o.executed.size]
+        self.fills = np.array([(o.executed.dt, o.executed.size, o.executed.price) for o in executed],
+                              dtype=FILL_DTYPE)
+        self.fills.sort(order='dt')
+        self.pnl = np.array([t.pnlcomm for trades in strategy._trades.values()
+                             for tlist in trades.values() for t in tlist if t.isclosed],
+                            dtype=np.float64)
+
+
+def _runs(mask):
+    '''Lengths and start indices of the runs of True in a boolean array'''
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return ends - starts, starts
+
+
+def analyze(record, start_value=None):
+    '''Performance statistics of a RunRecord as a dict'''
+    value, dt = record.value, record.dt
+    n = len(value)
+    stats = {}
+    if n < 2:
+        return stats
+    start_value = start_value or value[0]
+    years = (dt[-1] - dt[0]) / 365.25  # date numbers are days
+    bars_per_year = (n - 1) / years if years > 0 else float('nan')
+
+    returns = np.diff(value) / value[:-1]
+    mean, std = returns.mean(), returns.std(ddof=1)
+    downside = np.sqrt(np.mean(np.minimum(returns, 0.0) ** 2))
+    total = value[-1] / start_value
+
+    peak = np.maximum.accumulate(np.concatenate(([start_value], value)))[1:]
+    drawdown = (peak - value) / peak
+    underwater = value < peak
+    lengths, starts = _runs(underwater)
+    longest = int(np.argmax(lengths)) if len(lengths) else None
+    # the underwater run holding the deepest bar: from the peak to the recovery (or the end)
+    deepest = np.searchsorted(starts, np.argmax(drawdown), side='right') - 1 if drawdown.max() > 0 else None
+
+    # position per bar from the fills, exposure and leverage of the book
+    fills = record.fills
+    bar = np.clip(np.searchsorted(dt, fills['dt'], side='left'), 0, n - 1)
+    position = np.cumsum(np.bincount(bar, weights=fills['size'], minlength=n))
+    notional = np.abs(fills['size'] * fills['price'])
+
+    stats['start_value'] = start_value
+    stats['final_value'] = value[-1]
+    stats['total_return'] = total - 1.0
+    stats['annual_return'] = total ** (1.0 / years) - 1.0 if years > 0 and total > 0 else float('nan')
+    stats['volatility'] = std * np.sqrt(bars_per_year)
+    stats['sharpe'] = mean / std * np.sqrt(bars_per_year) if std > 0 else float('nan')
+    stats['sortino'] = mean / downside * np.sqrt(bars_per_year) if downside > 0 else float('nan')
+    stats['max_drawdown'] = drawdown.max()
+    stats['max_drawdown_bars'] = int(lengths[deepest]) if deepest is not None else 0
+    stats['max_drawdown_days'] = (dt[min(starts[deepest] + lengths[deepest], n - 1)] - dt[starts[deepest]]
+                                  if deepest is not None else 0.0)
+    stats['longest_underwater_bars'] = int(lengths[longest]) if longest is not None else 0
+    stats['longest_underwater_days'] = (dt[min(starts[longest] + lengths[longest], n - 1)] - dt[starts[longest]]
+                                        if longest is not None else 0.0)
+    stats['time_under_water'] = underwater.mean()
+    stats['exposure'] = np.mean(position != 0)
+    stats['avg_leverage'] = np.mean(np.abs(position * record.close) / value)
+    stats['turnover'] = notional.sum() / value.mean() / years if years > 0 else float('nan')
+    stats['fills'] = len(fills)
+    stats['trades'] = len(record.pnl)
+    if len(record.pnl):
+        wins, losses = record.pnl[record.pnl > 0], record.pnl[record.pnl < 0]
+        stats['win_rate'] = len(wins) / len(record.pnl)
+        stats['profit_factor'] = wins.sum() / -losses.sum() if len(losses) else float('inf')
+        stats['avg_trade'] = record.pnl.mean()
+    return stats
+
+
+def grid_stats(record, price_base, price_unit, value_unit):
+    '''
+    Grid level statistics of a SeizeVolatility run: the level of a fill is
+    round((price_base - price) / price_unit), units are sizes / value_unit.
+    '''
+    fills = record.fills
+    stats = {}
+    if not len(fills):
+        return stats
+    levels = np.rint((price_base - fills['price']) / price_unit).astype(np.int64)
+    units = np.cumsum(fills['size']) / value_unit
+    counts = np.bincount(levels - levels.min())
+    stats['grid_levels_visited'] = int(np.count_nonzero(counts))
+    stats['grid_level_low'] = int(levels.min())
+    stats['grid_level_high'] = int(levels.max())
+    stats['grid_busiest_level'] = int(np.argmax(counts) + levels.min())
+    stats['grid_busiest_fills'] = int(counts.max())
+    stats['grid_max_long_units'] = max(0.0, units.max())
+    stats['grid_max_short_units'] = max(0.0, -units.min())
+    stats['grid_avg_units_per_fill'] = np.mean(np.abs(fills['size'])) / value_unit
+    # a fill reversing the previous fill's direction closes a grid round trip
+    stats['grid_round_trips'] = int(np.count_nonzero(np.diff(np.sign(fills['size'])) != 0))
+    return stats
+
+
+def write_report(reports, path):
+    '''One CSV for several runs: a metric per row, a run per column'''
+    names = list(reports)
+    metrics = []
+    for stats in reports.values():
+        metrics.extend(m for m in stats if m not in metrics)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['metric'] + names)
+        for m in metrics:
+            row = [m]
+            for name in names:
+                v = reports[name].get(m, '')
+                row.append(v if isinstance(v, (int, np.integer, str)) else '%.6f' % v)
+            writer.writerow(row)
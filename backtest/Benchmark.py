@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+import argparse
+import contextlib
+import csv
+import json
+import os
+import resource
+import time
+
+import DataCache
+import Harness
+
+STRATEGIES = ('dma', 'turtle', 'donchian', 'volatility')
+SIZES = '1k,10k,100k,1M'  # 10M is supported, it needs several GB of RAM in backtrader
+SEED = 20230301
+BENCH_DIR = 'bench_data'  # not committed: data, run files, results and the per machine baseline
+BASELINE = os.path.join(BENCH_DIR, 'benchmark_baseline.json')
+# below these differences a slower or larger run is noise, not a regression
+MIN_WALL = 0.05
+MIN_RSS_MB = 10.0
+
+RESULT_COLUMNS = ('name', 'bars', 'wall', 'bars_per_sec', 'rss_mb', 'final_value')
+
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = dict(k=10 ** 3, m=10 ** 6).get(text[-1], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def synthetic_csv(bars, seed=SEED, path=None):
+    '''
+    Deterministic M1 export of `bars` bars (same seed and size, same file):
+    a random walk around 1.08 on weekday minutes from 2010-01-04, written
+    in the MT5 format of the demos' data.
+    '''
+    path = path or os.path.join(BENCH_DIR, 'synthetic_%d_%d.csv' % (bars, seed))
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # weekday minutes: 7200 per week of 10080
+    weeks = bars // 7200 + 1
+    minutes = np.arange(weeks * 10080, dtype=np.int64)
+    minutes = minutes[minutes % 10080 < 7200][:bars]
+    ts = np.datetime64('2010-01-04T00:00') + minutes.astype('timedelta64[m]')
+
+    close = 1.08 * np.exp(np.cumsum(rng.normal(0.0, 0.0002, bars)))
+    open_ = np.concatenate(([1.08], close[:-1]))
+    wick = np.abs(rng.normal(0.0, 0.0001, (2, bars)))
+    high = np.maximum(open_, close) + wick[0]
+    low = np.minimum(open_, close) - wick[1]
+    volume = rng.integers(1, 200, bars)
+    df = pd.DataFrame(dict(datetime=pd.DatetimeIndex(ts).strftime('%Y.%m.%d %H:%M'),
+                           open=open_, high=high, low=low, close=close, volume=volume,
+                           spread=0))
+    tmp = path + '.tmp'
+    df.to_csv(tmp, index=False, float_format='%.5f')
+    os.replace(tmp, path)
+    return path
+
+
+def _build_cache(data_spec):
+    Harness.get_cache(data_spec)
+
+
+def datasets(sizes, seed=SEED):
+    '''
+    [(name, data spec)]: the synthetic sizes, then the real exports found on
+    disk. Their binary caches are built here, in a process of their own, so
+    the parse is neither timed nor in the peak RSS of a measure.
+    '''
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    specs = []
+    for size in sizes:
+        path = os.path.abspath(synthetic_csv(parse_size(size), seed))
+        specs.append(('synthetic_%s' % size, dict(Harness.M1, dataname=path, fromdate=None, todate=None)))
+    for name, spec in (('daily', Harness.DAILY), ('m1', Harness.M1)):
+        if os.path.exists(spec['dataname']):
+            specs.append((name, dict(spec, dataname=os.path.abspath(spec['dataname']),
+                                     fromdate=None, todate=None)))
+    with Pool(1, maxtasksperchild=1) as pool:
+        pool.map(_build_cache, [spec for _, spec in specs], chunksize=1)
+    return specs
+
+
+def _measure(task):
+    '''One benchmark in a fresh process: wall time, bars and peak RSS'''
+    strategy, data_spec, workdir = task
+    Harness.get_cache(data_spec)  # maps the binary cache built by datasets()
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)  # log and CSV files of the strategies go there
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if strategy == 'ingest':
+            path = os.path.join(workdir, 'ingest.bin')
+            bars = len(DataCache.MT5Cache(DataCache.build_cache(
+                data_spec['dataname'], path, dtformat=data_spec['dtformat'])))
+            final_value = float('nan')
+        else:
+            result = Harness.run_backtest(Harness.get_strategy(strategy), data_spec,
+                                          params=Harness.FIXED.get(strategy), indicator_cache=False)
+            bars = len(result.strategy.data)
+            final_value = result.final_value
+        wall = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # kB on Linux
+    return dict(bars=bars, wall=wall, bars_per_sec=bars / wall if wall else 0.0, rss_mb=rss,
+                final_value=final_value)
+
+
+def run(strategies, specs, repeat=1, workdir=BENCH_DIR):
+    '''
+    {strategy/dataset: result}, each measure in its own process (one at a
+    time, maxtasksperchild=1) so the RSS peak is the run's own. The
+    fastest of `repeat` runs is kept.
+    '''
+    results = {}
+    workdir = os.path.abspath(workdir)
+    for dataset, spec in specs:
+        for strategy in ('ingest',) + tuple(strategies):
+            name = '%s/%s' % (strategy, dataset)
+            for _ in range(repeat):
+                with Pool(1, maxtasksperchild=1) as pool:
+                    r = pool.apply(_measure, ((strategy, spec, workdir),))
+                if name not in results or r['wall'] < results[name]['wall']:
+                    results[name] = r
+            r = results[name]
+            print('%-32s %9d bars %9.2fs %12.0f bars/s %8.1fMB' % (name, r['bars'], r['wall'],
+                                                                  r['bars_per_sec'], r['rss_mb']))
+    return results
+
+
+def compare(results, baseline, threshold=0.25):
+    '''
+    Regressions against the baseline: wall time or peak RSS more than
+    `threshold` (and MIN_WALL / MIN_RSS_MB) above it, or a different final
+    value (the data is fixed).
+    '''
+    failures = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if r['wall'] > base['wall'] * (1.0 + threshold) and r['wall'] - base['wall'] > MIN_WALL:
+            failures.append('%s: wall %.2fs, baseline %.2fs (+%.0f%%)'
+                            % (name, r['wall'], base['wall'], (r['wall'] / base['wall'] - 1.0) * 100))
+        if r['rss_mb'] > base['rss_mb'] * (1.0 + threshold) and r['rss_mb'] - base['rss_mb'] > MIN_RSS_MB:
+            failures.append('%s: peak RSS %.1fMB, baseline %.1fMB' % (name, r['rss_mb'], base['rss_mb']))
+        if not (np.isnan(r['final_value']) and np.isnan(base['final_value'])) and \
+                abs(r['final_value'] - base['final_value']) > 1e-6:
+            failures.append('%s: final value %.2f, baseline %.2f' % (name, r['final_value'],
+                                                                    base['final_value']))
+    return failures
+
+
+def write_results(results, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_COLUMNS)
+        for name, r in results.items():
+            writer.writerow([name] + [r[c] for c in RESULT_COLUMNS[1:]])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the backtest strategies against a stored baseline')
+    parser.add_argument('strategies', nargs='*', default=list(STRATEGIES),
+                        help='%s (default: all)' % ', '.join(STRATEGIES))
+    parser.add_argument('--sizes', default=SIZES, help='synthetic M1 sizes, e.g. 1k,10k,100k,1M,10M')
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--repeat', type=int, default=1, help='keep the fastest of n runs')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown / RSS growth')
+    parser.add_argument('--out', default=os.path.join(BENCH_DIR, 'Benchmark.csv'))
+    args = parser.parse_args()
+
+    specs = datasets(args.sizes.split(','), args.seed)
+    results = run(args.strategies, specs, args.repeat)
+    write_results(results, args.out)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('Baseline saved: %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.threshold)
+        if failures:
+            print('Regressions (threshold %.0f%%):\n  %s' % (args.threshold * 100, '\n  '.join(failures)))
+            raise SystemExit(1)
+        print('No regression against %s (threshold %.0f%%)' % (args.baseline, args.threshold * 100))
+    else:
+        print('No baseline (%s), run with --save-baseline to store one' % args.baseline)
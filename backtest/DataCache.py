@@ -0,0 +1,372 @@
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import io
+import math
+import os
+import zlib
+
+# header of the cache file, the columns follow it, each with room for
+# `capacity` rows so that new bars are appended in place:
+# datetime (int64 epoch seconds), open, high, low, close, volume (float64)
+HEADER = np.dtype([('magic', 'S4'),
+                   ('version', '<i4'),
+                   ('rows', '<i8'),
+                   ('capacity', '<i8'),
+                   ('src_size', '<i8'),
+                   ('src_mtime', '<i8'),
+                   ('src_offset', '<i8'),  # bytes of the export ingested (complete lines)
+                   ('src_head', '<i8'),    # crc32 of the first TAIL_BYTES bytes
+                   ('src_tail', '<i8'),    # crc32 of the last TAIL_BYTES ingested bytes
+                   ('headers', '<i8'),
+                   ('dtformat', 'S24')])
+HEADER_SIZE = 128
+MAGIC = b'MT5C'
+VERSION = 2
+COLUMNS = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+TAIL_BYTES = 256
+CHUNK_BYTES = 32 << 20  # bytes of the export parsed at once
+GROWTH = 1.25  # capacity of a rewritten cache, in rows of data
+
+
+def cache_path(csvpath):
+    return os.path.splitext(csvpath)[0] + '.bin'
+
+
+def _source_info(csvpath):
+    st = os.stat(csvpath)
+    return st.st_size, st.st_mtime_ns
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        return None
+    header = np.frombuffer(raw[:HEADER.itemsize], dtype=HEADER)[0]
+    if header['magic'] != MAGIC or header['version'] != VERSION:
+        return None
+    return header
+
+
+def _crc(f, start, end):
+    f.seek(start)
+    return zlib.crc32(f.read(end - start))
+
+
+def parse_rows(text, dtformat='%Y.%m.%d %H:%M'):
+    '''COLUMNS arrays of complete lines of an MT5 export (bytes)'''
+    df = pd.read_csv(io.BytesIO(text), header=None, usecols=range(6), names=COLUMNS)
+    # naive datetimes as seconds since 1970-01-01, same wall clock as the file
+    ts = pd.to_datetime(df['datetime'], format=dtformat).values.astype('datetime64[s]').astype(np.int64)
+    columns = dict((name, df[name].values.astype(np.float64)) for name in COLUMNS[1:])
+    columns['datetime'] = ts
+    return columns
+
+
+def ingest(csvpath, path=None, dtformat='%Y.%m.%d %H:%M', headers=True, chunk_bytes=CHUNK_BYTES):
+    '''
+    Bring the cache of an export up to date, parsing only the lines appended
+    since the last ingestion (from the byte offset stored in the cache):
+      - a partial last line (export still being written) is left for the
+        next ingestion
+      - bars at or before the last ingested bar (duplicates, overlapping
+        exports) are skipped
+      - a cache of another format, or an export that was rewritten instead
+        of appended (smaller, other first bytes or other bytes before the
+        offset), is built again from the start
+    Like GenericCSVData (`headers=True`) the first line is skipped. Returns
+    (path, bars added, bars skipped).
+    '''
+    path = path or cache_path(csvpath)
+    header = _read_header(path) if os.path.exists(path) else None
+    src_size, src_mtime = _source_info(csvpath)
+    with open(csvpath, 'rb') as f:
+        if header is not None:
+            done = int(header['src_offset'])
+            if (header['headers'] != int(headers) or header['dtformat'] != dtformat.encode()
+                    or done > src_size or _crc(f, 0, min(done, TAIL_BYTES)) != header['src_head']
+                    or _crc(f, max(0, done - TAIL_BYTES), done) != header['src_tail']):
+                header = None
+        if header is None:
+            f.seek(0)
+            offset = len(f.readline()) if headers else 0
+            last = None
+        else:
+            offset = int(header['src_offset'])
+            last = _last_datetime(path, header)
+
+        f.seek(offset)
+        parts, skipped, pending = [], 0, b''
+        remaining = src_size - offset  # bytes written after the stat are for the next ingestion
+        while remaining > 0:
+            data = f.read(min(chunk_bytes, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            pending += data
+            end = pending.rfind(b'\n') + 1
+            if not end:
+                continue
+            lines, pending = pending[:end], pending[end:]
+            offset += end
+            if not lines.strip():
+                continue
+            columns = parse_rows(lines, dtformat)
+            # keep the bars after every bar before them
+            ts = columns['datetime']
+            before = np.maximum.accumulate(np.concatenate(([np.iinfo(np.int64).min if last is None else last],
+                                                           ts[:-1])))
+            keep = ts > before
+            skipped += int(len(ts) - np.count_nonzero(keep))
+            if np.count_nonzero(keep):
+                parts.append(dict((name, v[keep]) for name, v in columns.items()))
+                last = int(ts[keep][-1])
+        head = _crc(f, 0, min(offset, TAIL_BYTES))
+        tail = _crc(f, max(0, offset - TAIL_BYTES), offset)
+
+    new = dict((name, np.concatenate([p[name] for p in parts]) if parts else
+                np.empty(0, dtype=np.int64 if name == 'datetime' else np.float64)) for name in COLUMNS)
+    src = dict(src_size=src_size, src_mtime=src_mtime, src_offset=offset, src_head=head, src_tail=tail)
+    if header is None:
+        write_cache(path, new, csvpath, dtformat, headers, src=src)
+    else:
+        _append(path, header, new, csvpath, dtformat, headers, src)
+    return path, len(new['datetime']), skipped
+
+
+def _last_datetime(path, header):
+    rows = int(header['rows'])
+    if not rows:
+        return None
+    return int(np.memmap(path, dtype='<i8', mode='r', offset=HEADER_SIZE, shape=(rows,))[-1])
+
+
+def _append(path, header, columns, csvpath, dtformat, headers, src):
+    '''
+    Append COLUMNS arrays to a cache file in place, its header last (readers
+    of the previous rows are not disturbed). A full cache is rewritten with
+    more capacity.
+    '''
+    rows, capacity = int(header['rows']), int(header['capacity'])
+    n = len(columns['datetime'])
+    if rows + n > capacity:
+        old = MT5Cache(path)
+        merged = dict((name, np.concatenate([old.columns[name], columns[name]])) for name in COLUMNS)
+        del old
+        write_cache(path, merged, csvpath, dtformat, headers, src=src)
+        return
+    header = np.array([header], dtype=HEADER)
+    header['rows'] = rows + n
+    for key, value in src.items():
+        header[key] = value
+    with open(path, 'r+b') as f:
+        for i, name in enumerate(COLUMNS):
+            f.seek(HEADER_SIZE + (i * capacity + rows) * 8)
+            f.write(np.ascontiguousarray(columns[name], dtype='<i8' if not i else '<f8').tobytes())
+        f.flush()
+        os.fsync(f.fileno())  # the bars are on disk before the header counts them
+        f.seek(0)
+        f.write(header.tobytes())
+
+
+def build_cache(csvpath, path=None, dtformat='%Y.%m.%d %H:%M', headers=True):
+    '''
+    Parse a whole MT5 export into a new columnar binary file.
+    Like GenericCSVData (`headers=True`) the first line is skipped.
+    '''
+    path = path or cache_path(csvpath)
+    if os.path.exists(path):
+        os.remove(path)
+    return ingest(csvpath, path, dtformat, headers)[0]
+
+
+def write_cache(path, columns, csvpath, dtformat='%Y.%m.%d %H:%M', headers=True, src=None):
+    '''
+    Write `columns` (COLUMNS arrays) as a cache file of the export `csvpath`,
+    the header records the export's size and mtime for is_stale(). With
+    `src` (ingest) it also records the ingested bytes and leaves room to
+    append bars.
+    '''
+    rows = len(columns['datetime'])
+    header = np.zeros(1, dtype=HEADER)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['rows'] = rows
+    header['capacity'] = capacity = max(rows, int(rows * GROWTH)) if src else rows
+    header['src_size'], header['src_mtime'] = _source_info(csvpath)
+    for key, value in (src or {}).items():
+        header[key] = value
+    header['headers'] = int(headers)
+    header['dtformat'] = dtformat.encode()
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+        for i, name in enumerate(COLUMNS):
+            f.write(np.ascontiguousarray(columns[name], dtype='<i8' if not i else '<f8').tobytes())
+            f.write(bytes(8 * (capacity - rows)))
+    os.replace(tmp, path)  # readers never see a half written file
+    return path
+
+
+class MT5Cache(object):
+    '''
+    Zero-copy view of a cache file: every column is a read-only np.memmap.
+    `slice(fromdate, todate)` returns another MT5Cache over the bars in
+    [fromdate, todate], found by binary search on the timestamps.
+    '''
+    def __init__(self, path, columns=None):
+        self.path = path
+        if columns is None:
+            header = _read_header(path)
+            rows, capacity = int(header['rows']), int(header['capacity'])
+            columns = {'datetime': np.memmap(path, dtype='<i8', mode='r',
+                                             offset=HEADER_SIZE, shape=(rows,))}
+            offset = HEADER_SIZE + capacity * 8
+            for name in COLUMNS[1:]:
+                columns[name] = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(rows,))
+                offset += capacity * 8
+        self.columns = columns
+        for name, values in columns.items():
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.datetime)
+
+    def slice(self, fromdate=None, todate=None):
+        lo, hi = 0, len(self)
+        if fromdate is not None:
+            lo = int(np.searchsorted(self.datetime, to_epoch(fromdate), side='left'))
+        if todate is not None:
+            hi = int(np.searchsorted(self.datetime, to_epoch(todate), side='right'))
+        hi = max(lo, hi)
+        return MT5Cache(self.path, dict((k, v[lo:hi]) for k, v in self.columns.items()))
+
+    def datetimes(self):
+        '''Timestamps as datetime64[s] (a view, no copy)'''
+        return np.asarray(self.datetime).view('datetime64[s]')
+
+
+def to_epoch(dt):
+    return int(np.datetime64(dt, 's').astype(np.int64))
+
+
+def is_stale(path, csvpath, dtformat='%Y.%m.%d %H:%M', headers=True):
+    '''True if the cache file is missing or was not built from the current export'''
+    header = _read_header(path) if os.path.exists(path) else None
+    src_size, src_mtime = _source_info(csvpath)
+    return (header is None or header['src_size'] != src_size or header['src_mtime'] != src_mtime
+            or header['headers'] != int(headers) or header['dtformat'] != dtformat.encode())
+
+
+def open_cache(csvpath, path=None, dtformat='%Y.%m.%d %H:%M', headers=True):
+    '''Open the cache of an MT5 export, ingesting what was appended to it (see ingest)'''
+    path = path or cache_path(csvpath)
+    if is_stale(path, csvpath, dtformat, headers):
+        ingest(csvpath, path, dtformat=dtformat, headers=headers)
+    return MT5Cache(path)
+
+
+def bt_datenum(ts, sessionend=None):
+    '''
+    bt.date2num for naive epoch seconds, with the same math.fsum rounding.
+    With `sessionend` (daily bars) the time is moved to the end of session
+    like GenericCSVData does.
+    '''
+    days, secs = np.divmod(np.asarray(ts, dtype=np.int64), 86400)
+    base = (days + 719163).astype(np.float64).tolist()  # datetime(1970, 1, 1).toordinal()
+    secs = secs.tolist()
+    nums = [math.fsum((b, s // 3600 / 24.0, s // 60 % 60 / 1440.0, s % 60 / 86400.0, 0.0))
+            for b, s in zip(base, secs)]
+    if sessionend is not None:
+        eos = (sessionend.hour / 24.0, sessionend.minute / 1440.0,
+               sessionend.second / 86400.0, sessionend.microsecond / 8.64e10)
+        nums = [max(n, math.fsum((b,) + eos)) for b, n in zip(base, nums)]
+    return np.array(nums, dtype=np.float64)
+
+
+class MT5CacheData(bt.feed.DataBase):
+    '''
+    Backtrader feed over the binary cache of an MT5 export. It is a drop-in
+    replacement for the GenericCSVData block of the demos:
+
+      data = MT5CacheData(dataname='dataMT5/EURUSDDaily2010.csv',
+                          dtformat=('%Y.%m.%d'), timeframe=bt.TimeFrame.Days,
+                          fromdate=..., todate=...)
+
+    The CSV is only parsed when the cache is missing or older than it.
+    '''
+    params = (
+        ('dtformat', '%Y.%m.%d %H:%M'),
+        ('headers', True),
+        ('cachepath', None),
+        ('cache', None),  # an already opened MT5Cache of dataname
+    )
+
+    def start(self):
+        super(MT5CacheData, self).start()
+        cache = self.p.cache or open_cache(self.p.dataname, self.p.cachepath,
+                                           dtformat=self.p.dtformat, headers=self.p.headers)
+        self._cache = cache.slice(self.p.fromdate, self.p.todate)
+        eos = self.p.sessionend if self.p.timeframe >= bt.TimeFrame.Days else None
+        self._dtnum = bt_datenum(self._cache.datetime, eos)
+        self._idx = 0
+
+    def preload(self):
+        if self._filters or self._tzinput:
+            return super(MT5CacheData, self).preload()
+
+        # bulk copy the columns into the line buffers instead of calling
+        # load() once per bar, applying the same fromdate/todate checks
+        dtnum = self._dtnum
+        keep = (dtnum >= self.fromdate) & (dtnum <= self.todate)
+        c = self._cache
+        values = dict(datetime=dtnum, open=c.open, high=c.high, low=c.low,
+                      close=c.close, volume=c.volume,
+                      openinterest=np.zeros(len(dtnum)))
+        for name in self.getlinealiases():
+            line = getattr(self.lines, name)
+            column = np.ascontiguousarray(values[name][keep], dtype=np.float64)
+            line.array.frombytes(column.tobytes())
+            line.idx += len(column)
+            line.lencount += len(column)
+        self._idx = len(dtnum)
+
+        self._last()
+        self.home()
+
+    def _load(self):
+        i = self._idx
+        if i >= len(self._dtnum):
+            return False
+        self._idx = i + 1
+        c = self._cache
+        self.lines.datetime[0] = self._dtnum[i]
+        self.lines.open[0] = c.open[i]
+        self.lines.high[0] = c.high[i]
+        self.lines.low[0] = c.low[i]
+        self.lines.close[0] = c.close[i]
+        self.lines.volume[0] = c.volume[i]
+        self.lines.openinterest[0] = 0.0
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Build or update the binary cache of MT5 exports')
+    parser.add_argument('csv', nargs='+')
+    parser.add_argument('--dtformat', default='%Y.%m.%d %H:%M')
+    parser.add_argument('--rebuild', action='store_true', help='parse the whole export again')
+    args = parser.parse_args()
+    for csvpath in args.csv:
+        start = time.perf_counter()
+        if args.rebuild:
+            path, added, skipped = build_cache(csvpath, dtformat=args.dtformat), None, 0
+        else:
+            path, added, skipped = ingest(csvpath, dtformat=args.dtformat)
+        cache = MT5Cache(path)
+        print('%s: %d bars -> %s (%s new, %d duplicates skipped, %.2fs)' % (
+            csvpath, len(cache), cache.path, 'all' if added is None else added, skipped,
+            time.perf_counter() - start))
@@ -1,31 +1,7 @@
 import backtrader as bt
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-plt.rcParams["figure.figsize"] = (15,8)
 
-cerebro = bt.Cerebro(stdstats=False)
-cerebro.addobserver(bt.observers.BuySell)
-cerebro.addobserver(bt.observers.Broker)
-
-data = bt.feeds.GenericCSVData(
-    dataname='dataMT5/EURUSDDaily2010.csv',
-    nullvalue=0.0,
-    timeframe=bt.TimeFrame.Days, 
-    compression=1,
-    fromdate=datetime(2020, 7, 8, 00, 00, 00),
-    todate=datetime(2023, 3, 1, 00, 00, 00),
-    dtformat=('%Y.%m.%d'),
-
-    open=1,
-    high=2,
-    low=3,
-    close=4,
-    volume=5,
-    openinterest=-1
-)
-
-cerebro.adddata(data)
+import Harness
+import Incremental
 
 class DonchianChannels(bt.Indicator):
     '''
@@ -44,6 +20,7 @@ class DonchianChannels(bt.Indicator):
         period_h=20,
         period_l=20,
         lookback=-1,  # consider current bar or not
+        table=None,  # Incremental.IndicatorTable, see WalkForward.py
     )
 
     plotinfo = dict(subplot=False)  # plot along with data
@@ -54,12 +31,17 @@ class DonchianChannels(bt.Indicator):
     )
         
     def __init__(self):
-        hi, lo = self.data.high, self.data.low
-        if self.p.lookback:  # move backwards as needed
-            hi, lo = hi(self.p.lookback), lo(self.p.lookback)
-
-        self.l.dch = bt.ind.Highest(hi, period=self.p.period_h)
-        self.l.dcl = bt.ind.Lowest(lo, period=self.p.period_l)
+        if self.p.table:  # precomputed over the whole history
+            self.l.dch = self.p.table.line(self.data, 'highest', self.p.period_h, self.p.lookback)
+            self.l.dcl = self.p.table.line(self.data, 'lowest', self.p.period_l, self.p.lookback)
+        else:
+            hi, lo = self.data.high, self.data.low
+            if self.p.lookback:  # move backwards as needed
+                hi, lo = hi(self.p.lookback), lo(self.p.lookback)
+
+            # O(1) per bar rolling max/min instead of a scan of the whole window
+            self.l.dch = Incremental.StreamingHighest(hi, period=self.p.period_h)
+            self.l.dcl = Incremental.StreamingLowest(lo, period=self.p.period_l)
         self.l.dcm = (self.l.dch + self.l.dcl) / 2.0  # avg of the above
 
 class DonchianChannelsStrategy(bt.Strategy):
@@ -67,10 +49,12 @@ class DonchianChannelsStrategy(bt.Strategy):
         period_h=20,
         period_l=10,
         stake=100,
+        table=None,  # Incremental.IndicatorTable, see WalkForward.py
     )
 
     def __init__(self):
-        self.dcind = DonchianChannels(period_h=self.p.period_h, period_l=self.p.period_l)
+        self.dcind = DonchianChannels(period_h=self.p.period_h, period_l=self.p.period_l,
+                                      table=self.p.table)
 
     def next(self):
         if self.data[0] > self.dcind.dch[0]:
@@ -78,28 +62,9 @@ class DonchianChannelsStrategy(bt.Strategy):
         elif self.data[0] < self.dcind.dcl[0]:
             self.sell(size=self.p.stake)
 
-cerebro.broker.setcash(1000.0)
-cerebro.broker.setcommission(commission=0.0, margin=0.02)
-cerebro.broker.set_slippage_perc(perc=0.005)
-
-cerebro.addanalyzer(bt.analyzers.AnnualReturn, _name='_AnnualReturn')
-
-cerebro.addstrategy(DonchianChannelsStrategy, period_h=20, period_l=10)
-
-result = cerebro.run()
-strat = result[0]
-print("--------------- AnnualReturn -----------------")
-print(strat.analyzers._AnnualReturn.get_analysis())
-
-AnReturn = strat.analyzers._AnnualReturn.get_analysis()
-df = pd.DataFrame(AnReturn.values(), index=AnReturn.keys()).reset_index()
-df.columns=['Year', 'AnnualReturn']
-df.to_csv('DemoDonchianChannels.csv', index=False)
-
-print(f'Final Portfolio Value: {cerebro.broker.getvalue():.2f}')
-
-figure = cerebro.plot(style='candlestick', volume=False,
-                      barup = '#ff9896', bardown='#98df8a',
-                      tickrotation=10, )[0][0]
-
-figure.savefig('DemoDonchianChannels.png')
\ No newline at end of file
+if __name__ == '__main__':
+    result = Harness.run_backtest(DonchianChannelsStrategy, Harness.DAILY, dict(cash=1000.0),
+                                  dict(period_h=20, period_l=10),
+                                  csv='DemoDonchianChannels.csv', plot='DemoDonchianChannels.png',
+                                  report='DemoDonchianChannels_report.csv')
+    Harness.report(result)
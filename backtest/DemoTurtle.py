@@ -1,39 +1,19 @@
 import backtrader as bt
-from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
-plt.rcParams["figure.figsize"] = (15,8)
 
-cerebro = bt.Cerebro(stdstats=False)
-cerebro.addobserver(bt.observers.BuySell)
-cerebro.addobserver(bt.observers.Broker)
-
-data = bt.feeds.GenericCSVData(
-    dataname='dataMT5/EURUSDDaily2010.csv',
-    nullvalue=0.0,
-    timeframe=bt.TimeFrame.Days, 
-    compression=1,
-    fromdate=datetime(2020, 7, 8, 00, 00, 00),
-    todate=datetime(2023, 3, 1, 00, 00, 00),
-    dtformat=('%Y.%m.%d'),
-
-    open=1,
-    high=2,
-    low=3,
-    close=4,
-    volume=5,
-    openinterest=-1
-)
-
-cerebro.adddata(data)
+import Harness
+import Incremental
 
 class TurtleStrategy(bt.Strategy):
     params = dict(
         N1= 20, # Donchian Channels upper period
         N2=10, # Donchian Channels lower period
         stake = 300,
+        table=None,  # Incremental.IndicatorTable, see WalkForward.py
+        printlog=True,
         )
     def log(self, txt, dt=None):
+        if not self.p.printlog:
+            return
         dt = dt or self.datas[0].datetime.date(0)
         dtstr = dt.strftime('%Y-%m-%d')
         print('%s, %s' % (dtstr, txt))
@@ -42,14 +22,19 @@ class TurtleStrategy(bt.Strategy):
         self.close = self.datas[0].close
         self.high = self.datas[0].high
         self.low = self.datas[0].low
-        self.DonchianH = bt.ind.Highest(self.high(-1), period=self.p.N1, subplot=False)
-        self.DonchianL = bt.ind.Lowest(self.low(-1), period=self.p.N2, subplot=False)
-        self.CrossoverH = bt.ind.CrossOver(self.close(0), self.DonchianH, subplot=True)
-        self.CrossoverL = bt.ind.CrossOver(self.close(0), self.DonchianL, subplot=True)
-        self.TR = bt.ind.Max((self.high(0)-self.low(0)),
-                                    abs(self.high(0)-self.close(-1)),
-                                    abs(self.low(0)-self.close(-1)))
-        self.ATR = bt.ind.SimpleMovingAverage(self.TR, period=self.p.N1, subplot=True)
+        if self.p.table:  # precomputed over the whole history
+            self.DonchianH = self.p.table.line(self.data0, 'highest', self.p.N1, -1, subplot=False)
+            self.DonchianL = self.p.table.line(self.data0, 'lowest', self.p.N2, -1, subplot=False)
+        else:
+            self.DonchianH = Incremental.StreamingHighest(self.high(-1), period=self.p.N1, subplot=False)
+            self.DonchianL = Incremental.StreamingLowest(self.low(-1), period=self.p.N2, subplot=False)
+        self.CrossoverH = Incremental.CrossOver(self.close(0), self.DonchianH, subplot=True)
+        self.CrossoverL = Incremental.CrossOver(self.close(0), self.DonchianL, subplot=True)
+        # SMA of max(h - l, |h - prev c|, |l - prev c|) with a running sum
+        if self.p.table:
+            self.ATR = self.p.table.line(self.data0, 'atr', self.p.N1, subplot=True)
+        else:
+            self.ATR = Incremental.StreamingATR(self.datas[0], period=self.p.N1, subplot=True)
 
         self.order=None
         self.last_price = 0
@@ -96,29 +81,8 @@ class TurtleStrategy(bt.Strategy):
                 self.buy(size=abs(self.position.size))
                 self.log('close sell position: Stop Loss')
 
-
-cerebro.broker.setcash(1000.0)
-cerebro.broker.setcommission(commission=0.0, margin=0.02)
-cerebro.broker.set_slippage_perc(perc=0.005)
-
-cerebro.addanalyzer(bt.analyzers.AnnualReturn, _name='_AnnualReturn')
-
-cerebro.addstrategy(TurtleStrategy)
-
-result = cerebro.run()
-strat = result[0]
-print("--------------- AnnualReturn -----------------")
-print(strat.analyzers._AnnualReturn.get_analysis())
-
-AnReturn = strat.analyzers._AnnualReturn.get_analysis()
-df = pd.DataFrame(AnReturn.values(), index=AnReturn.keys()).reset_index()
-df.columns=['Year', 'AnnualReturn']
-df.to_csv('DemoTurtle.csv', index=False)
-
-print(f'Final Portfolio Value: {cerebro.broker.getvalue():.2f}')
-
-figure = cerebro.plot(style='candlestick', volume=False,
-                      barup = '#ff9896', bardown='#98df8a',
-                      tickrotation=10, )[0][0]
-
-figure.savefig('DemoTurtle.png')
\ No newline at end of file
+if __name__ == '__main__':
+    result = Harness.run_backtest(TurtleStrategy, Harness.DAILY, dict(cash=1000.0),
+                                  csv='DemoTurtle.csv', plot='DemoTurtle.png',
+                                  report='DemoTurtle_report.csv')
+    Harness.report(result)
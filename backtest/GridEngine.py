@@ -0,0 +1,280 @@
+import numpy as np
+from datetime import datetime
+import time
+
+import DataCache
+
+# order status codes, same numbering as bt.Order.Status
+Submitted, Completed, Margin = 1, 4, 7
+
+ORDER_DTYPE = np.dtype([('created', 'i8'),   # bar of the decision in next()
+                        ('executed', 'i8'),  # bar of the fill (-1: none)
+                        ('unit', 'i8'),      # diff_units
+                        ('size', 'f8'),      # signed order size
+                        ('price', 'f8'),     # execution price
+                        ('units', 'i8'),     # strategy units after the order
+                        ('status', 'i1')])
+
+
+class GridResult(object):
+    '''
+    Output of run_grid, all arrays aligned to the input bars:
+      - `orders`: structured array (ORDER_DTYPE), one row per order sent
+      - `fills`: the orders that executed (Completed or partially closed)
+      - `units`: strategy units at the end of every bar
+      - `position`: broker position size at the end of every bar
+      - `cash`, `value`: broker cash/value at the end of every bar
+    '''
+    def __init__(self, orders, units, position, cash, value):
+        self.orders = orders
+        self.fills = orders[orders['executed'] >= 0]
+        self.units = units
+        self.position = position
+        self.cash = cash
+        self.value = value
+
+    @property
+    def final_value(self):
+        return float(self.value[-1]) if len(self.value) else 0.0
+
+
+def _scan(close, start, price_position, units, price_unit, max_unit):
+    '''Find the first bar >= start where next() sends an order'''
+    n = len(close)
+    step = 256
+    while start < n:
+        stop = min(n, start + step)
+        diff = -1 * np.trunc((close[start:stop] - price_position) / price_unit)
+        hit = np.flatnonzero((diff != 0) & (np.abs(units + diff) <= max_unit))
+        if hit.size:
+            return start + hit[0], int(diff[hit[0]])
+        start = stop
+        step = min(step * 2, 1 << 16)  # gallop through quiet stretches
+    return n, 0
+
+
+def _slip(isbuy, price, phigh, plow, slip_perc, slip_open, slip_match, slip_out):
+    '''BackBroker._slip_up/_slip_down for market orders'''
+    if not slip_open or not slip_perc:
+        return price
+    if isbuy:
+        pslip = price * (1 + slip_perc)
+        if pslip <= phigh:
+            return pslip
+        pmax = phigh
+    else:
+        pslip = price * (1 - slip_perc)
+        if pslip >= plow:
+            return pslip
+        pmax = plow
+    if slip_match:
+        return pslip if slip_out else pmax
+    return None  # no price: order stays pending
+
+
+def _split(oldsize, size):
+    '''Position.update: (newsize, opened, closed)'''
+    newsize = oldsize + size
+    if not newsize:
+        return newsize, 0, size
+    if not oldsize or (oldsize > 0) == (size > 0):
+        return newsize, size, 0
+    if (newsize > 0) == (oldsize > 0):
+        return newsize, 0, size
+    return newsize, newsize, -oldsize
+
+
+def run_grid(close, open=None, high=None, low=None,
+             price_base=1.0300, price_unit=0.0020, value_unit=600, max_unit=35,
+             cash=1066.0, margin=0.02, slip_perc=0.005, slip_open=True,
+             slip_match=True, slip_out=False):
+    '''
+    Array-backed replay of SeizeVolatilityStrategy on a BackBroker configured
+    with setcommission(commission=0.0, margin=margin) and
+    set_slippage_perc(slip_perc, slip_open, slip_match=slip_match, slip_out=slip_out).
+
+    Between orders the grid state (units, price_position) is constant, so the
+    next order bar is found with a vectorized scan instead of a per-bar loop.
+    Orders are Market: checked against cash at the creation price, then filled
+    at the next bar open (slipped and clamped to high/low). Without
+    open/high/low the next close is used as the fill price.
+    '''
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    n = len(close)
+    open = close if open is None else np.ascontiguousarray(open, dtype=np.float64)
+    high = open if high is None else np.ascontiguousarray(high, dtype=np.float64)
+    low = open if low is None else np.ascontiguousarray(low, dtype=np.float64)
+
+    orders = []
+    units = 0
+    price_position = price_base - price_unit * units  # <0: sell
+    posi_size = 0
+    adjbase = 0.0
+    cash_arr = np.empty(n)
+    posi_arr = np.zeros(n)
+    seg = 0  # first bar whose cash has not been settled yet
+
+    def settle(stop, cash0):
+        # end of bar cash adjustment of BackBroker.next for bars [seg, stop)
+        if stop <= seg:
+            return
+        if posi_size:
+            inc = posi_size * (close[seg:stop] - np.concatenate(([adjbase0], close[seg:stop - 1])))
+            inc[0] += cash0
+            cash_arr[seg:stop] = np.cumsum(inc)
+        else:
+            cash_arr[seg:stop] = cash0
+        posi_arr[seg:stop] = posi_size
+
+    t = 0
+    adjbase0 = adjbase
+    while t < n:
+        t, diff_units = _scan(close, t, price_position, units, price_unit, max_unit)
+        if t >= n:
+            break
+        settle(t + 1, cash)
+        cash = cash_arr[t]
+        adjbase0 = adjbase = close[t] if posi_size else adjbase
+        seg = t + 1
+
+        new_units = units + diff_units
+        size = float(value_unit * diff_units)
+        order = [t, -1, diff_units, size, 0.0, units, Submitted]
+        orders.append(order)
+
+        # broker.next() of the following bar: pseudo-execution cash check
+        e = t + 1
+        if e >= n:
+            break
+        newsize, opened, closed = _split(posi_size, size)
+        pcash = cash + abs(closed) * margin - abs(opened) * margin
+        if pcash < 0.0:
+            order[6] = Margin
+            t = e
+            continue
+
+        price = _slip(size > 0, open[e], high[e], low[e],
+                      slip_perc, slip_open, slip_match, slip_out)
+        while price is None:
+            # market order waits, next() returns early while self.order is set
+            settle(e + 1, cash)
+            cash = cash_arr[e]
+            adjbase0 = adjbase = close[e] if posi_size else adjbase
+            seg = e = e + 1
+            if e >= n:
+                break
+            price = _slip(size > 0, open[e], high[e], low[e],
+                          slip_perc, slip_open, slip_match, slip_out)
+        if price is None:
+            break
+
+        if closed:
+            cash += abs(closed) * margin
+            cash += -closed * (price - adjbase)
+        executed = closed
+        if opened:
+            ocash = cash - abs(opened) * margin
+            if ocash < 0.0:
+                order[6] = Margin  # only the closing part (if any) went through
+            else:
+                cash = ocash
+                if abs(newsize) > abs(opened):
+                    cash += (newsize - opened) * (price - adjbase)
+                adjbase = price
+                executed += opened
+        if executed:
+            posi_size += executed
+            order[1] = e
+            order[4] = price
+        if order[6] != Margin:
+            order[6] = Completed
+            units = new_units
+            price_position = price_base - price_unit * units  # <0: sell
+        order[5] = units
+
+        # end of the fill bar
+        if posi_size:
+            cash += posi_size * (close[e] - adjbase)
+            adjbase = close[e]
+        cash_arr[e] = cash
+        posi_arr[e] = posi_size
+        adjbase0 = adjbase
+        seg = e + 1
+        t = e
+
+    settle(n, cash if seg == 0 else cash_arr[seg - 1])
+
+    orders = np.array([tuple(o) for o in orders], dtype=ORDER_DTYPE)
+    done = orders[orders['status'] == Completed]
+    units_arr = np.zeros(n, dtype=np.int64)
+    if len(done):
+        # units change when the Completed notification arrives (fill bar)
+        steps = np.zeros(n, dtype=np.int64)
+        np.add.at(steps, done['executed'], done['unit'])
+        units_arr = np.cumsum(steps)
+    value = cash_arr + np.abs(posi_arr) * margin
+    return GridResult(orders, units_arr, posi_arr, cash_arr, value)
+
+
+def load_mt5_csv(path, fromdate=None, todate=None, dtformat='%Y.%m.%d %H:%M',
+                 headers=True):
+    '''
+    Read an MT5 export into (datetime64 index, open, high, low, close).
+    Like GenericCSVData (`headers=True`) the first line is skipped. The
+    arrays are views on the binary cache of the file (see DataCache.py).
+    '''
+    cache = DataCache.open_cache(path, dtformat=dtformat, headers=headers).slice(fromdate, todate)
+    return cache.datetimes(), cache.open, cache.high, cache.low, cache.close
+
+
+def _backtrader_fills(path, fromdate, todate, params):
+    '''Run DemoVolatility.SeizeVolatilityStrategy through cerebro and record its fills'''
+    import Harness
+    from DemoVolatility import SeizeVolatilityStrategy
+
+    fills = []
+
+    class Recorder(SeizeVolatilityStrategy):
+        def notify_order(self, order):
+            if order.status in [order.Completed]:
+                fills.append((len(self.data0), order.executed.size, order.executed.price))
+            super(Recorder, self).notify_order(order)
+
+    data_spec = dict(Harness.M1, dataname=path, fromdate=fromdate, todate=todate)
+    result = Harness.run_backtest(Recorder, data_spec, dict(cash=1066.0), params)
+    return fills, result.final_value
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Vectorized SeizeVolatility grid backtest')
+    parser.add_argument('data', nargs='?', default='dataMT5/EURUSDM1_220301.csv')
+    parser.add_argument('--fromdate', default='2023-03-01 09:45')
+    parser.add_argument('--todate', default='2023-04-22 00:00')
+    parser.add_argument('--check', action='store_true',
+                        help='compare fills and timing against backtrader')
+    args = parser.parse_args()
+
+    fromdate = datetime.fromisoformat(args.fromdate)
+    todate = datetime.fromisoformat(args.todate)
+    dt, o, h, l, c = load_mt5_csv(args.data, fromdate, todate)
+
+    t0 = time.perf_counter()
+    result = run_grid(c, o, h, l)
+    t_engine = time.perf_counter() - t0
+    print('Bars: %d, orders: %d, fills: %d, %.3fs' % (len(c), len(result.orders),
+                                                       len(result.fills), t_engine))
+    print(f'Final Portfolio Value: {result.final_value:.2f}')
+
+    if args.check:
+        t0 = time.perf_counter()
+        bt_fills, bt_value = _backtrader_fills(args.data, fromdate, todate, {})
+        t_bt = time.perf_counter() - t0
+        done = result.orders[result.orders['status'] == Completed]
+        fills = [(int(f['executed']) + 1, f['size'], f['price']) for f in done]
+        same = len(fills) == len(bt_fills) and all(
+            a[0] == b[0] and a[1] == b[1] and abs(a[2] - b[2]) < 1e-12
+            for a, b in zip(fills, bt_fills))
+        print('backtrader: fills: %d, value: %.2f, %.3fs' % (len(bt_fills), bt_value, t_bt))
+        print('Fills match: %s, value diff: %.2e, speedup: %.0fx' % (
+            same, abs(bt_value - result.final_value), t_bt / t_engine))
@@ -0,0 +1,228 @@
+import backtrader as bt
+import pandas as pd
+from datetime import datetime
+import importlib
+import itertools
+import argparse
+
+import Analytics
+import DataCache
+import IndicatorCache
+import Incremental
+import Render
+import Resample
+
+# data specs: GenericCSVData style arguments of the demos
+DAILY = dict(dataname='dataMT5/EURUSDDaily2010.csv',
+             timeframe=bt.TimeFrame.Days,
+             compression=1,
+             fromdate=datetime(2020, 7, 8, 00, 00, 00),
+             todate=datetime(2023, 3, 1, 00, 00, 00),
+             dtformat=('%Y.%m.%d'))
+
+M1 = dict(dataname='dataMT5/EURUSDM1_220301.csv',
+          timeframe=bt.TimeFrame.Minutes,
+          compression=1,
+          fromdate=datetime(2023, 3, 1, 9, 45, 00),
+          todate=datetime(2023, 4, 22, 00, 00, 00),
+          dtformat=('%Y.%m.%d %H:%M'))
+
+DATA = dict(daily=DAILY, m1=M1)
+
+# a data spec with resample='M5', 'M15', 'H1', 'H4' or 'D1' reads that level
+# of the Resample pyramid of its M1 CSV, e.g. dict(M1, resample='H1')
+
+# broker spec: setcash / setcommission / set_slippage_perc of the demos
+BROKER = dict(cash=1000.0, commission=0.0, margin=0.02, slippage=0.005)
+# BROKER overrides of the demos' own runs
+DEMO_BROKER = dict(volatility=dict(cash=1066.0))
+
+STRATEGIES = dict(
+    dma=('DemoDMA', 'DualMovingAverageStrategy'),
+    turtle=('DemoTurtle', 'TurtleStrategy'),
+    donchian=('DemoDonchianChannels', 'DonchianChannelsStrategy'),
+    volatility=('DemoVolatility', 'SeizeVolatilityStrategy'),
+)
+
+# parameter grids of the dma, turtle and donchian searches (WalkForward, SignalEngine)
+GRIDS = dict(
+    dma=dict(period_short=[5, 10, 15, 20, 30], period_long=[50, 100, 150, 200]),
+    turtle=dict(N1=[10, 20, 30, 55], N2=[5, 10, 20]),
+    donchian=dict(period_h=[10, 20, 30, 55], period_l=[5, 10, 20]),
+)
+# fixed params of every run of a search or benchmark
+FIXED = dict(turtle=dict(printlog=False))
+
+
+def param_grid(grid):
+    names = list(grid)
+    for values in itertools.product(*(grid[n] for n in names)):
+        yield dict(zip(names, values))
+
+
+def valid(name, params):
+    return not (name == 'dma' and params['period_short'] >= params['period_long'])
+
+
+# IndicatorCache of the Incremental indicators, shared by all runs (and processes)
+INDICATOR_CACHE = dict(path='indicator_cache', memory_size=64 << 20, disk_size=512 << 20)
+
+# opened caches, shared by all runs of the process
+_caches = {}
+
+
+class BacktestResult(object):
+    def __init__(self, cerebro, strategy):
+        self.cerebro = cerebro
+        self.strategy = strategy
+        self.final_value = cerebro.broker.getvalue()
+        self.annual_return = strategy.analyzers._AnnualReturn.get_analysis()
+
+
+def get_strategy(name):
+    '''Strategy class from a short name (see STRATEGIES) or module:Class'''
+    module, cls = STRATEGIES[name] if name in STRATEGIES else name.split(':')
+    return getattr(importlib.import_module(module), cls)
+
+
+def get_cache(data_spec):
+    '''MT5Cache of the data spec's CSV (or of its resample level), opened once per process'''
+    key = (data_spec['dataname'], data_spec.get('dtformat'), data_spec.get('headers', True),
+           data_spec.get('resample'))
+    if key not in _caches:
+        if key[3]:
+            _caches[key] = Resample.open_level(key[0], key[3], dtformat=key[1], headers=key[2])
+        else:
+            _caches[key] = DataCache.open_cache(key[0], dtformat=key[1], headers=key[2])
+    return _caches[key]
+
+
+def load_data(data_spec):
+    '''New feed over the binary cache of the data spec's CSV'''
+    spec = dict(data_spec)
+    spec.pop('nullvalue', None)
+    level = spec.pop('resample', None)
+    if level:
+        spec['timeframe'], spec['compression'], _ = Resample.LEVELS[level]
+    return DataCache.MT5CacheData(cache=get_cache(data_spec), **spec)
+
+
+def setup_broker(broker, broker_spec=None):
+    spec = dict(BROKER, **(broker_spec or {}))
+    broker.setcash(spec['cash'])
+    broker.setcommission(commission=spec['commission'], margin=spec['margin'])
+    if spec['slippage']:
+        broker.set_slippage_perc(perc=spec['slippage'])
+
+
+def run_backtest(strategy_cls, data_spec=DAILY, broker_spec=None, params=None,
+                 csv=None, plot=None, indicator_cache=True, report=None):
+    '''
+    Run one strategy on one data spec with the demos' broker setup.
+      - `csv`: write the AnnualReturn analysis to this file
+      - `plot`: save a Render chart (candles bucketed to the image width,
+        fills and equity) to this file. Off by default, matplotlib is only
+        loaded when plotting
+      - `indicator_cache`: load the indicator arrays of earlier runs on the
+        same data and params from INDICATOR_CACHE instead of computing them
+      - `report`: write the Analytics statistics of the run to this file
+    '''
+    if indicator_cache and Incremental.cache is None:
+        Incremental.set_cache(IndicatorCache.IndicatorCache(**INDICATOR_CACHE))
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.addobserver(bt.observers.Broker)  # AnnualReturn and Render read its value line
+
+    cerebro.adddata(load_data(data_spec))
+    setup_broker(cerebro.broker, broker_spec)
+    cerebro.addanalyzer(bt.analyzers.AnnualReturn, _name='_AnnualReturn')
+    cerebro.addstrategy(strategy_cls, **(params or {}))
+
+    result = BacktestResult(cerebro, cerebro.run()[0])
+    if csv:
+        write_annual_return(result.annual_return, csv)
+    if report:
+        Analytics.write_report({strategy_cls.__name__: analytics(result)}, report)
+    if plot:
+        Render.render(result.strategy, plot)
+    return result
+
+
+def analytics(result):
+    '''Analytics statistics of a run, with the grid statistics for grid strategies'''
+    record = Analytics.RunRecord(result.strategy)
+    stats = Analytics.analyze(record, result.cerebro.broker.startingcash)
+    p = result.strategy.p
+    if all(hasattr(p, name) for name in ('price_base', 'price_unit', 'value_unit')):
+        stats.update(Analytics.grid_stats(record, p.price_base, p.price_unit, p.value_unit))
+    return stats
+
+
+def write_annual_return(analysis, path):
+    df = pd.DataFrame(analysis.values(), index=analysis.keys()).reset_index()
+    df.columns = ['Year', 'AnnualReturn']
+    df.to_csv(path, index=False)
+
+
+def report(result):
+    print("--------------- AnnualReturn -----------------")
+    print(result.annual_return)
+    print(f'Final Portfolio Value: {result.final_value:.2f}')
+
+
+def parse_params(items):
+    '''key=value strings into strategy kwargs (int, float or str values)'''
+    params = {}
+    for item in items or []:
+        key, _, value = item.partition('=')
+        for conv in (int, float, str):
+            try:
+                params[key] = conv(value)
+                break
+            except ValueError:
+                pass
+    return params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several strategies on the same data')
+    parser.add_argument('strategies', nargs='+',
+                        help='%s or module:Class' % ', '.join(STRATEGIES))
+    parser.add_argument('--data', default='daily', help='daily, m1 or a CSV path')
+    parser.add_argument('--dtformat', default=None)
+    parser.add_argument('--resample', default=None, help='%s: run on that level of the M1 data' % ', '.join(Resample.LEVELS))
+    parser.add_argument('--fromdate', default=None)
+    parser.add_argument('--todate', default=None)
+    parser.add_argument('--cash', type=float, default=BROKER['cash'])
+    parser.add_argument('--param', action='append', help='key=value passed to every strategy')
+    parser.add_argument('--csv', action='store_true', help='write <strategy>.csv')
+    parser.add_argument('--plot', action='store_true', help='save <strategy>.png')
+    parser.add_argument('--report', default=None, help='write the Analytics statistics of all runs to this CSV')
+    args = parser.parse_args()
+
+    if args.data in DATA:
+        data_spec = dict(DATA[args.data])
+    else:
+        data_spec = dict(M1, dataname=args.data)
+    if args.dtformat:
+        data_spec['dtformat'] = args.dtformat
+    if args.resample:
+        data_spec['resample'] = args.resample
+    if args.fromdate:
+        data_spec['fromdate'] = datetime.fromisoformat(args.fromdate)
+    if args.todate:
+        data_spec['todate'] = datetime.fromisoformat(args.todate)
+
+    reports = {}
+    for name in args.strategies:
+        strategy_cls = get_strategy(name)
+        result = run_backtest(strategy_cls, data_spec, dict(cash=args.cash),
+                              parse_params(args.param),
+                              csv='%s.csv' % name if args.csv else None,
+                              plot='%s.png' % name if args.plot else None)
+        print('=============== %s ===============' % strategy_cls.__name__)
+        report(result)
+        if args.report:
+            reports[name] = analytics(result)
+    if args.report:
+        Analytics.write_report(reports, args.report)
+        print('Report: %s' % args.report)
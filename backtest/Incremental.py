@@ -0,0 +1,397 @@
+import backtrader as bt
+import numpy as np
+from collections import deque
+import argparse
+import math
+import time
+
+import DataCache
+
+# IndicatorCache used by the batch (runonce) computations, see set_cache()
+cache = None
+
+
+def set_cache(indicator_cache):
+    '''Share the once() results of the indicators below through an IndicatorCache (None: off)'''
+    global cache
+    cache = indicator_cache
+
+
+def cached(name, params, sources, func, end=None):
+    if cache is None:
+        return func()
+    return cache.compute(name, params, sources, func, end)
+
+# ---------------------------------------------------------------- streaming
+# O(1) amortized updates, one value at a time (live feeds, next() mode)
+
+class RollingMax(object):
+    '''Max of the last `period` values with a monotonic deque'''
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.window = deque()  # (index, value), values decreasing
+
+    def _drop(self, old, value):
+        return old <= value
+
+    def update(self, value):
+        i = self.count
+        self.count += 1
+        window = self.window
+        while window and self._drop(window[-1][1], value):
+            window.pop()
+        window.append((i, value))
+        if window[0][0] <= i - self.period:
+            window.popleft()
+        return window[0][1]
+
+
+class RollingMin(RollingMax):
+    '''Min of the last `period` values with a monotonic deque'''
+    def _drop(self, old, value):
+        return old >= value
+
+
+class RunningMean(object):
+    '''
+    Mean of the last `period` values with a running sum. The sum is
+    recomputed with math.fsum every `period` updates so rounding errors
+    never build up (and right away while a NaN is in the window).
+    '''
+    def __init__(self, period):
+        self.period = period
+        self.window = deque(maxlen=period)
+        self.total = 0.0
+        self.updates = 0
+
+    def update(self, value):
+        if len(self.window) == self.period:
+            self.total -= self.window[0]
+        self.window.append(value)
+        self.updates += 1
+        if self.updates % self.period and not math.isnan(self.total):
+            self.total += value
+        else:
+            self.total = math.fsum(self.window)
+        return self.total / len(self.window)
+
+
+class RunningATR(object):
+    '''Average True Range: RunningMean of max(h - l, |h - prev c|, |l - prev c|)'''
+    def __init__(self, period):
+        self.mean = RunningMean(period)
+        self.prev_close = None
+
+    def update(self, high, low, close):
+        prev_close, self.prev_close = self.prev_close, close
+        if prev_close is None:
+            return float('nan')  # no true range without a previous close
+        tr = max(high - low, abs(high - prev_close), abs(low - prev_close))
+        return self.mean.update(tr)
+
+
+# -------------------------------------------------------------------- batch
+# O(n) whatever the period: the van Herk/Gil-Werman block decomposition,
+# each window is the suffix of one block plus the prefix of the next one
+
+def _blocks(values, period, fill):
+    x = np.asarray(values, dtype=np.float64)
+    pad = (-len(x)) % period
+    return np.concatenate([x, np.full(pad, fill)]).reshape(-1, period)
+
+
+def _rolling(values, period, ufunc, fill):
+    n = len(values)
+    out = np.full(n, np.nan)
+    if n < period:
+        return out
+    blocks = _blocks(values, period, fill)
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    out[period - 1:] = ufunc(suffix[:n - period + 1], prefix[period - 1:n])
+    return out
+
+
+def rolling_max(values, period):
+    '''Highest of every `period` values window, NaN before the first full one'''
+    return _rolling(values, period, np.maximum, -np.inf)
+
+
+def rolling_min(values, period):
+    '''Lowest of every `period` values window, NaN before the first full one'''
+    return _rolling(values, period, np.minimum, np.inf)
+
+
+def rolling_mean(values, period):
+    '''Mean of every `period` values window, NaN before the first full one'''
+    n = len(values)
+    out = np.full(n, np.nan)
+    if n < period:
+        return out
+    blocks = _blocks(values, period, 0.0)
+    prefix = np.cumsum(blocks, axis=1).ravel()
+    suffix = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    start = np.arange(n - period + 1)
+    # a window starting on a block boundary is exactly one block prefix
+    total = np.where(start % period == 0, prefix[period - 1:n],
+                     suffix[:n - period + 1] + prefix[period - 1:n])
+    out[period - 1:] = total / period
+    return out
+
+
+def crossover(a, b, seed=0):
+    '''
+    bt.ind.CrossOver of two arrays: 1.0 when a crosses b upwards, -1.0
+    downwards, else 0.0. The last non zero difference a - b is seeded at
+    `seed`, the first crossing can be at seed + 1.
+    '''
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    out = np.full(len(a), np.nan)
+    if len(a) <= seed + 1:
+        return out
+    diff = a - b
+    i = np.arange(len(a))
+    # last non zero difference: index of the latest d != 0 at or after the seed
+    keep = ((diff != 0.0) & (i >= seed)) | (i == seed)
+    nzd = diff[np.maximum.accumulate(np.where(keep, i, seed))]
+    before, up, down = nzd[seed:-1], a[seed + 1:] > b[seed + 1:], a[seed + 1:] < b[seed + 1:]
+    out[seed + 1:] = ((before < 0.0) & up).astype(np.float64) - ((before > 0.0) & down)
+    return out
+
+
+def true_range(high, low, close):
+    '''max(h - l, |h - prev c|, |l - prev c|), NaN on the first bar'''
+    high, low, close = (np.asarray(v, dtype=np.float64) for v in (high, low, close))
+    prev = np.concatenate([[np.nan], close[:-1]])
+    return np.maximum(np.maximum(high - low, np.abs(high - prev)), np.abs(low - prev))
+
+
+def atr(high, low, close, period):
+    '''Mean of the true range over `period` bars, NaN for the first `period` bars'''
+    tr = true_range(high, low, close)
+    out = np.full(len(tr), np.nan)
+    out[1:] = rolling_mean(tr[1:], period)
+    return out
+
+
+# --------------------------------------------------------------- backtrader
+# next() feeds the streaming classes, once() (runonce mode) the batch ones
+
+class StreamingHighest(bt.Indicator):
+    '''
+    Drop-in for bt.ind.Highest: O(1) per bar instead of a max() over the
+    whole window.
+    '''
+    lines = ('highest',)
+    params = (('period', 30),)
+    _window = RollingMax
+    _batch = staticmethod(rolling_max)
+
+    def __init__(self):
+        self.addminperiod(self.p.period)
+        self.rolling = self._window(self.p.period)
+
+    def prenext(self):
+        self.rolling.update(self.data[0])
+
+    def next(self):
+        self.lines[0][0] = self.rolling.update(self.data[0])
+
+    def once(self, start, end):
+        src = np.asarray(self.data.array[:end], dtype=np.float64)
+        values = cached(type(self).__name__, (self.p.period,), (self.data.array,),
+                        lambda: self._batch(src, self.p.period), end)
+        dst = self.lines[0].array
+        for i in range(start, end):
+            dst[i] = values[i]
+
+
+class StreamingLowest(StreamingHighest):
+    '''Drop-in for bt.ind.Lowest'''
+    lines = ('lowest',)
+    _window = RollingMin
+    _batch = staticmethod(rolling_min)
+
+
+class StreamingSMA(StreamingHighest):
+    '''Drop-in for bt.ind.SimpleMovingAverage, running sum per bar'''
+    lines = ('sma',)
+    _window = RunningMean
+    _batch = staticmethod(rolling_mean)
+
+
+class StreamingATR(bt.Indicator):
+    '''
+    Average True Range of the data, the SMA of the true range (not Wilder's
+    smoothing of bt.ind.ATR), like the TR/SMA pair of DemoTurtle.
+    '''
+    lines = ('atr',)
+    params = (('period', 14),)
+
+    def __init__(self):
+        self.addminperiod(self.p.period + 1)  # the true range needs a previous close
+        self.rolling = RunningATR(self.p.period)
+
+    def prenext(self):
+        self.rolling.update(self.data.high[0], self.data.low[0], self.data.close[0])
+
+    def next(self):
+        self.lines.atr[0] = self.rolling.update(self.data.high[0], self.data.low[0], self.data.close[0])
+
+    def once(self, start, end):
+        high, low, close = (np.asarray(line.array[:end]) for line in
+                            (self.data.high, self.data.low, self.data.close))
+        values = cached('StreamingATR', (self.p.period,),
+                        (self.data.high.array, self.data.low.array, self.data.close.array),
+                        lambda: atr(high, low, close, self.p.period), end)
+        dst = self.lines.atr.array
+        for i in range(start, end):
+            dst[i] = values[i]
+
+
+class CrossOver(bt.Indicator):
+    '''
+    Drop-in for bt.ind.CrossOver as a single indicator (bt builds it from
+    five line objects), 1.0/-1.0 on an upwards/downwards cross.
+    '''
+    _mindatas = 2
+    lines = ('crossover',)
+    plotinfo = dict(plotymargin=0.05, plotyhlines=[-1.0, 1.0])
+
+    def __init__(self):
+        self.addminperiod(2)  # the last non zero difference is seeded one bar before
+        self.nzd = None
+
+    def prenext(self):
+        self.nzd = self.data0[0] - self.data1[0]
+
+    def next(self):
+        a, b = self.data0[0], self.data1[0]
+        self.lines.crossover[0] = float(self.nzd < 0.0 and a > b) - float(self.nzd > 0.0 and a < b)
+        diff = a - b
+        if diff:
+            self.nzd = diff
+
+    def once(self, start, end):
+        seed = self._minperiod - 2
+        a = np.asarray(self.data0.array[:end], dtype=np.float64)
+        b = np.asarray(self.data1.array[:end], dtype=np.float64)
+        values = cached('CrossOver', (seed,), (self.data0.array, self.data1.array),
+                        lambda: crossover(a, b, seed), end)
+        dst = self.lines.crossover.array
+        for i in range(start, end):
+            dst[i] = values[i]
+
+
+# -------------------------------------------------------------- precomputed
+# indicators computed once over a whole cached history and replayed on any
+# date window of it (walk-forward folds), warm-up included
+
+def shift(values, lookback):
+    '''values(lookback) of backtrader: values[i + lookback], NaN where undefined'''
+    x = np.asarray(values, dtype=np.float64)
+    if not lookback:
+        return x
+    out = np.full(len(x), np.nan)
+    out[-lookback:] = x[:lookback]
+    return out
+
+
+class IndicatorTable(object):
+    '''
+    Lazily computed indicator arrays over a whole DataCache.MT5Cache, each
+    (kind, period, lookback) is computed once and shared by every run:
+      - sma: mean of the close
+      - highest/lowest: max of the high/min of the low
+      - atr: SMA of the true range (StreamingATR)
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+        self.arrays = {}
+        self._dtnum = {}
+
+    def values(self, kind, period, lookback=0):
+        key = (kind, period, lookback)
+        if key not in self.arrays:
+            c = self.cache
+            if kind == 'sma':
+                sources, func = (c.close,), lambda: rolling_mean(shift(c.close, lookback), period)
+            elif kind == 'highest':
+                sources, func = (c.high,), lambda: rolling_max(shift(c.high, lookback), period)
+            elif kind == 'lowest':
+                sources, func = (c.low,), lambda: rolling_min(shift(c.low, lookback), period)
+            elif kind == 'atr':
+                sources, func = (c.high, c.low, c.close), lambda: atr(c.high, c.low, c.close, period)
+            else:
+                raise ValueError('Unknown indicator: %s' % kind)
+            self.arrays[key] = cached('IndicatorTable', key, sources, func)
+        return self.arrays[key]
+
+    def dtnum(self, data):
+        '''Date numbers of the whole history as an MT5CacheData of it sees them'''
+        eos = data.p.sessionend if data._timeframe >= bt.TimeFrame.Days else None
+        if eos not in self._dtnum:
+            self._dtnum[eos] = DataCache.bt_datenum(self.cache.datetime, eos)
+        return self._dtnum[eos]
+
+    def line(self, data, kind, period, lookback=0, **kwargs):
+        return Precomputed(data, values=self.values(kind, period, lookback),
+                           dtnum=self.dtnum(data), **kwargs)
+
+
+class Precomputed(bt.Indicator):
+    '''Values of an IndicatorTable array at the datetimes of the data'''
+    lines = ('value',)
+    params = (('values', None),
+              ('dtnum', None))
+
+    def next(self):
+        i = np.searchsorted(self.p.dtnum, self.data.datetime[0])
+        self.lines.value[0] = self.p.values[i]
+
+    def once(self, start, end):
+        dts = np.asarray(self.data.datetime.array[start:end], dtype=np.float64)
+        values = self.p.values[np.searchsorted(self.p.dtnum, dts)]
+        dst = self.lines.value.array
+        for i in range(start, end):
+            dst[i] = values[i - start]
+
+
+# ---------------------------------------------------------------- benchmark
+
+def _naive_max(values, period):
+    return np.array([max(values[i - period + 1:i + 1]) for i in range(period - 1, len(values))])
+
+
+def benchmark(n=100000, periods=(10, 100, 1000, 10000), seed=0):
+    '''Cost per bar of the naive window scan and of the incremental versions'''
+    rng = np.random.default_rng(seed)
+    values = 1.1 + np.cumsum(rng.normal(0, 1e-4, n))
+    listed = values.tolist()
+    print('%8s %14s %14s %14s' % ('period', 'naive max', 'RollingMax', 'rolling_max'))
+    for period in periods:
+        m = min(n, max(20 * period, 20000))  # keep the naive scan affordable
+        t = time.perf_counter()
+        naive = _naive_max(listed[:m], period)
+        t_naive = (time.perf_counter() - t) / m
+
+        t = time.perf_counter()
+        rolling = RollingMax(period)
+        stream = [rolling.update(v) for v in listed]
+        t_stream = (time.perf_counter() - t) / n
+
+        t = time.perf_counter()
+        batch = rolling_max(values, period)
+        t_batch = (time.perf_counter() - t) / n
+
+        assert np.array_equal(naive, stream[period - 1:m]) and np.array_equal(naive, batch[period - 1:m])
+        print('%8d %12.3fus %12.3fus %12.3fus' % (period, t_naive * 1e6, t_stream * 1e6, t_batch * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the incremental rolling window indicators')
+    parser.add_argument('--bars', type=int, default=100000)
+    parser.add_argument('--periods', default='10,100,1000,10000')
+    args = parser.parse_args()
+    benchmark(args.bars, [int(p) for p in args.periods.split(',')])
@@ -0,0 +1,162 @@
+import numpy as np
+from collections import OrderedDict
+import argparse
+import hashlib
+import os
+import threading
+import weakref
+
+
+class IndicatorCache(object):
+    '''
+    Indicator outputs keyed by a content hash of the source arrays plus the
+    indicator name and params.
+
+    Lookups go to an in-memory LRU (`memory_size` bytes), then to one .npy
+    file per key in `path` (`disk_size` bytes, least recently used files are
+    removed first). Several processes can share the same directory, files
+    are written atomically. The hash of a source is computed once per source
+    object and length, sources must not be changed in place.
+    '''
+    def __init__(self, path='indicator_cache', memory_size=64 << 20, disk_size=512 << 20):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.hits = self.disk_hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._digests = {}  # id(source) -> (weakref, length, digest)
+        self.disk_used = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.disk_used = sum(e.stat().st_size for e in os.scandir(path) if e.name.endswith('.npy'))
+
+    def key(self, name, params, sources, end=None):
+        '''Key of the indicator over src[:end] of every source'''
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((name, tuple(params))).encode())
+        for src in sources:
+            h.update(self.digest(src, end))
+        return h.hexdigest()
+
+    def digest(self, src, end=None):
+        length = len(src) if end is None else min(end, len(src))
+        entry = self._digests.get(id(src))
+        if entry is not None and entry[0]() is src and entry[1] == length:
+            return entry[2]
+        values = np.ascontiguousarray(np.asarray(src)[:length], dtype=np.float64)  # a view of float arrays
+        h = hashlib.blake2b(str(length).encode(), digest_size=16)
+        h.update(values.data)
+        digest = h.digest()
+        i = id(src)
+        self._digests[i] = (weakref.ref(src, lambda _, i=i: self._digests.pop(i, None)), length, digest)
+        return digest
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        with self._lock:
+            values = self.memory.get(key)
+            if values is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return values
+        if self.path:
+            try:
+                values = np.load(self._file(key))
+                os.utime(self._file(key))  # mtime is the LRU order on disk
+            except (OSError, ValueError):
+                values = None
+            if values is not None:
+                self.disk_hits += 1
+                self._remember(key, values)
+                return values
+        self.misses += 1
+        return None
+
+    def put(self, key, values):
+        values = self._remember(key, np.asarray(values, dtype=np.float64))
+        if self.path:
+            tmp = '%s.%d.tmp' % (self._file(key), os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, values)
+                size = f.tell()
+            try:
+                size -= os.stat(self._file(key)).st_size  # replaced, written by another process
+            except OSError:
+                pass
+            os.replace(tmp, self._file(key))
+            self.disk_used += size
+            if self.disk_used > self.disk_size:
+                self.evict()
+        return values
+
+    def compute(self, name, params, sources, func, end=None):
+        '''Cached func() for these sources (up to `end`) and params'''
+        key = self.key(name, params, sources, end)
+        values = self.get(key)
+        if values is None:
+            values = self.put(key, func())
+        return values
+
+    def _remember(self, key, values):
+        values.flags.writeable = False  # shared by every user of the key
+        with self._lock:
+            if key not in self.memory:
+                self.memory[key] = values
+                self.memory_used += values.nbytes
+            while self.memory_used > self.memory_size and len(self.memory) > 1:
+                _, old = self.memory.popitem(last=False)
+                self.memory_used -= old.nbytes
+        return values
+
+    def evict(self, target=0.9):
+        '''Remove the least recently used files down to `target` of disk_size'''
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.endswith('.npy'):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if used <= self.disk_size * target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # removed by another process
+            used -= size
+        self.disk_used = used
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            self.memory_used = 0
+        if self.path:
+            for e in os.scandir(self.path):
+                if e.name.endswith('.npy'):
+                    os.remove(e.path)
+            self.disk_used = 0
+
+    def stats(self):
+        return ('IndicatorCache: memory hits: %d, disk hits: %d, misses: %d, memory: %.1fMB, disk: %.1fMB'
+                % (self.hits, self.disk_hits, self.misses, self.memory_used / 1e6,
+                   self.disk_used / 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect or clear the on-disk indicator cache')
+    parser.add_argument('--path', default='indicator_cache')
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+    cache = IndicatorCache(args.path)
+    if args.clear:
+        cache.clear()
+    print('%s: %d files, %.1fMB' % (args.path, len([e for e in os.scandir(args.path) if e.name.endswith('.npy')]),
+                                   cache.disk_used / 1e6))
@@ -0,0 +1,80 @@
+import backtrader as bt
+import numpy as np
+import pandas as pd
+import csv
+import os
+
+GROWTH = 2
+# (name, dtype, csv format); 'datetime' columns hold bt date numbers, exported as text
+ACTIVITY = (('datetime', 'f8', '%Y-%m-%d %H:%M:%S'),
+            ('count', 'i8', '%d'),
+            ('price', 'f8', '%.4f'),
+            ('unit', 'i8', '%d'),
+            ('value', 'f8', '%.2f'),
+            ('cash', 'f8', '%.2f'),
+            ('posi_value', 'f8', '%d'),  # position size, the OandaActivity.csv header
+            ('posi_price', 'f8', '%.4f'))
+ORDERS = (('datetime', 'f8', '%Y-%m-%d %H:%M:%S'),
+          ('ref', 'i8', '%d'),
+          ('status', 'i1', '%d'),  # bt.Order status: Completed, Canceled, Margin, Rejected
+          ('size', 'f8', '%d'),  # executed, < 0: sell
+          ('price', 'f8', '%.5f'),
+          ('value', 'f8', '%.2f'),
+          ('commission', 'f8', '%.2f'),
+          ('position', 'f8', '%d'))
+
+
+class Ledger(object):
+    '''
+    Struct-of-arrays record of a run: one preallocated numpy column per
+    field, grown GROWTH times when full. append() stores the values and
+    nothing else; formatting and I/O happen once in export().
+    '''
+    def __init__(self, fields, capacity=1024):
+        self.fields = fields
+        self.names = [f[0] for f in fields]
+        self.columns = [np.empty(capacity, dtype) for _, dtype, _ in fields]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, *values):
+        i = self.size
+        if i == len(self.columns[0]):
+            self.columns = [np.concatenate((c, np.empty(len(c) * (GROWTH - 1), c.dtype)))
+                            for c in self.columns]
+        for column, value in zip(self.columns, values):
+            column[i] = value
+        self.size = i + 1
+
+    def column(self, name):
+        return self.columns[self.names.index(name)][:self.size]
+
+    def frame(self):
+        '''The rows as a DataFrame, datetime columns as datetimes'''
+        data = {}
+        for (name, _, _), column in zip(self.fields, self.columns):
+            column = column[:self.size]
+            data[name] = [bt.num2date(x) for x in column] if name == 'datetime' else column
+        return pd.DataFrame(data, columns=self.names)
+
+    def export(self, path):
+        '''Write the rows to `path`: .csv (formatted like the old per row writer), .parquet or .feather'''
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.parquet':
+            self.frame().to_parquet(path, index=False)
+        elif ext == '.feather':
+            self.frame().to_feather(path)
+        else:
+            cells = []
+            for (name, _, fmt), column in zip(self.fields, self.columns):
+                column = column[:self.size].tolist()
+                if name == 'datetime':
+                    cells.append([bt.num2date(x).strftime(fmt) for x in column])
+                else:
+                    cells.append([fmt % x for x in column])
+            with open(path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(self.names)
+                writer.writerows(zip(*cells))
@@ -0,0 +1,319 @@
+import numpy as np
+from datetime import datetime
+import argparse
+import csv
+import time
+
+import GridEngine
+import Harness
+
+# generated returns, prices and temporaries per path step of a time block
+BYTES_PER_STEP = 48
+MIN_BLOCK = 256  # fewest steps per time block before paths are split in chunks
+
+PATH_COLUMNS = ('path', 'final_value', 'min_value', 'max_drawdown', 'margin_call', 'orders',
+                'rejected', 'max_units', 'min_cash')
+
+
+def path_streams(seed, first, n, kinds=1):
+    '''
+    Random generators of the paths first..first+n-1, `kinds` streams per
+    path (one per kind of draw), each seeded by (seed, path, kind) alone:
+    the numbers of a path do not depend on how the paths are chunked.
+    '''
+    return [[np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed, spawn_key=(p, k))))
+             for k in range(kinds)] for p in range(first, first + n)]
+
+
+class BlockBootstrap(object):
+    '''
+    Log returns drawn as blocks of `block` consecutive historical returns,
+    which keeps the short range volatility clustering of the history.
+    '''
+    streams = 1
+
+    def __init__(self, returns, block=60):
+        self.returns = np.ascontiguousarray(returns, dtype=np.float64)
+        self.block = block
+        if len(self.returns) < block:
+            raise ValueError('%d returns, less than one block of %d' % (len(self.returns), block))
+
+    def source(self, streams, steps):
+        '''draw(t0, n): log returns of steps t0..t0+n-1 of the paths of `streams`'''
+        # block starts drawn once per path, the blocks sit at fixed steps whatever the time blocks
+        hi = len(self.returns) - self.block + 1
+        starts = np.array([s[0].integers(0, hi, -(-steps // self.block)) for s in streams])
+
+        def draw(t0, n):
+            t = np.arange(t0, t0 + n)
+            return self.returns[starts[:, t // self.block] + t % self.block]
+        return draw
+
+
+class JumpGBM(object):
+    '''
+    Per step log returns of a geometric Brownian motion (`mu`, `sigma` per
+    step) with Poisson jumps: `jump_rate` jumps per step on average, each a
+    normal log return (`jump_mean`, `jump_std`).
+    '''
+    def __init__(self, sigma, mu=0.0, jump_rate=0.0, jump_mean=0.0, jump_std=0.0):
+        self.sigma = sigma
+        self.mu = mu
+        self.jump_rate = jump_rate
+        self.jump_mean = jump_mean
+        self.jump_std = jump_std
+        self.streams = 3 if jump_rate else 1  # normals, jump counts, jump sizes
+
+    @classmethod
+    def fit(cls, returns, **jumps):
+        '''sigma (and mu) of historical per step log returns'''
+        return cls(float(np.std(returns)), float(np.mean(returns)), **jumps)
+
+    def source(self, streams, steps):
+        '''draw(t0, n): log returns of steps t0..t0+n-1 of the paths of `streams`, drawn in step order'''
+        def draw(t0, n):
+            r = np.empty((len(streams), n))
+            for row, s in zip(r, streams):
+                s[0].standard_normal(out=row)
+            r *= self.sigma
+            r += self.mu - 0.5 * self.sigma ** 2
+            if self.jump_rate:
+                for row, s in zip(r, streams):
+                    k = s[1].poisson(self.jump_rate, n)
+                    jumps = np.flatnonzero(k)
+                    if len(jumps):
+                        row[jumps] += (k[jumps] * self.jump_mean +
+                                       np.sqrt(k[jumps]) * self.jump_std * s[2].standard_normal(len(jumps)))
+            return r
+        return draw
+
+
+class GridBatch(object):
+    '''
+    GridEngine.run_grid on close prices only, for many paths at once: the
+    state of every path is an array element and a time step updates all
+    paths with a few vectorized operations. Orders fill at the next close
+    (run_grid without open/high/low), path for path the results are the
+    ones of run_grid.
+    '''
+    def __init__(self, paths, price_base=1.0300, price_unit=0.0020, value_unit=600, max_unit=35,
+                 cash=1066.0, margin=0.02):
+        self.price_base = price_base
+        self.price_unit = price_unit
+        self.value_unit = value_unit
+        self.max_unit = max_unit
+        self.margin = margin
+        self.units = np.zeros(paths, dtype=np.int64)
+        self.price_position = np.full(paths, price_base)
+        self.position = np.zeros(paths)
+        self.adjbase = np.zeros(paths)
+        self.cash = np.full(paths, cash)
+        self.pending = np.zeros(paths, dtype=np.int64)  # diff_units of the order sent, 0: none
+        self.peak = np.full(paths, cash)
+        self.min_value = np.full(paths, cash)
+        self.max_drawdown = np.zeros(paths)
+        self.min_cash = np.full(paths, cash)
+        self.orders = np.zeros(paths, dtype=np.int64)
+        self.rejected = np.zeros(paths, dtype=np.int64)
+        self.max_units = np.zeros(paths, dtype=np.int64)
+
+    def _execute(self, i, price):
+        '''BackBroker execution of the pending orders of paths `i` at `price`'''
+        m = self.margin
+        diff = self.pending[i]
+        size = (self.value_unit * diff).astype(np.float64)
+        old = self.position[i]
+        cash = self.cash[i]
+        adjbase = self.adjbase[i]
+
+        # GridEngine._split: (newsize, opened, closed)
+        newsize = old + size
+        same = (old == 0) | ((old > 0) == (size > 0))
+        reduce = (newsize != 0) & ~same & ((newsize > 0) == (old > 0))
+        opened = np.where(newsize == 0, 0.0, np.where(same, size, np.where(reduce, 0.0, newsize)))
+        closed = np.where(newsize == 0, size, np.where(same, 0.0, np.where(reduce, size, -old)))
+
+        ok = cash + np.abs(closed) * m - np.abs(opened) * m >= 0.0
+        cash = np.where(ok, cash + np.abs(closed) * m, cash)
+        cash = np.where(ok, cash + -closed * (price - adjbase), cash)
+        ocash = cash - np.abs(opened) * m
+        opens = ok & (opened != 0) & (ocash >= 0.0)
+        cash = np.where(opens, ocash, cash)
+        grow = opens & (np.abs(newsize) > np.abs(opened))
+        cash = np.where(grow, cash + (newsize - opened) * (price - adjbase), cash)
+        adjbase = np.where(opens, price, adjbase)
+        executed = np.where(ok, closed, 0.0) + np.where(opens, opened, 0.0)
+
+        done = ok & ((opened == 0) | opens)
+        self.position[i] = old + executed
+        self.cash[i] = cash
+        self.adjbase[i] = adjbase
+        self.rejected[i] += ~done
+        units = np.where(done, self.units[i] + diff, self.units[i])
+        self.units[i] = units
+        self.price_position[i] = self.price_base - self.price_unit * units
+        self.pending[i] = 0
+
+    def step(self, close):
+        '''One bar of every path: fills, end of bar cash, statistics, next() decision'''
+        i = np.flatnonzero(self.pending)
+        if len(i):
+            self._execute(i, close[i])
+        held = self.position != 0
+        self.cash += self.position * (close - self.adjbase)
+        self.adjbase = np.where(held, close, self.adjbase)
+
+        value = self.cash + np.abs(self.position) * self.margin
+        np.maximum(self.peak, value, out=self.peak)
+        np.minimum(self.min_value, value, out=self.min_value)
+        np.maximum(self.max_drawdown, (self.peak - value) / self.peak, out=self.max_drawdown)
+        np.minimum(self.min_cash, self.cash, out=self.min_cash)
+        np.maximum(self.max_units, np.abs(self.units), out=self.max_units)
+
+        diff = -1 * np.trunc((close - self.price_position) / self.price_unit)
+        send = (diff != 0) & (np.abs(self.units + diff) <= self.max_unit)
+        self.pending = np.where(send, diff, 0).astype(np.int64)
+        self.orders += send
+        return value
+
+    def result(self, value):
+        return dict(final_value=value, min_value=self.min_value, max_drawdown=self.max_drawdown,
+                    margin_call=self.min_cash < 0.0, orders=self.orders, rejected=self.rejected,
+                    max_units=self.max_units, min_cash=self.min_cash)
+
+
+def plan(paths, steps, memory_mb):
+    '''(paths per chunk, steps per time block) within memory_mb of generated prices'''
+    budget = memory_mb * (1 << 20) // BYTES_PER_STEP
+    chunk = max(1, min(paths, budget // min(steps, MIN_BLOCK)))
+    block = max(1, min(steps, budget // chunk))
+    return chunk, block
+
+
+def simulate(model, paths, steps, start, seed=0, memory_mb=256, keep=0, **grid):
+    '''
+    Run the grid (GridBatch, `grid` params) over `paths` price paths of
+    `steps` steps from `start`, log returns drawn by `model.source()` from
+    the path_streams of each path. Prices are generated in time blocks, and
+    paths in chunks, sized to memory_mb; the results depend on the seed
+    only. Returns ({PATH_COLUMNS: array}, close prices of the first `keep`
+    paths).
+    '''
+    chunk, block = plan(paths, steps, memory_mb)
+    out = dict((name, []) for name in PATH_COLUMNS[1:])
+    kept = []
+    for first in range(0, paths, chunk):
+        n = min(chunk, paths - first)
+        draw = model.source(path_streams(seed, first, n, model.streams), steps)
+        batch = GridBatch(n, **grid)
+        last = np.full(n, np.log(start))
+        keep_n = max(0, min(n, keep - first))
+        chunk_kept = [np.full((keep_n, 1), start)] if keep_n else []
+        value = batch.cash.copy()
+        for t0 in range(0, steps, block):
+            logp = draw(t0, min(block, steps - t0))
+            if t0 == 0:
+                logp[:, 0] = 0.0  # the first bar is `start`
+            np.cumsum(logp, axis=1, out=logp)
+            logp += last[:, None]
+            last = logp[:, -1].copy()
+            prices = np.exp(logp, out=logp)
+            if keep_n:
+                chunk_kept.append(prices[:keep_n].copy())
+            prices = np.ascontiguousarray(prices.T)  # one contiguous row per step
+            for close in prices:
+                value = batch.step(close)
+        kept.extend(np.concatenate(chunk_kept, axis=1)[:, 1:] if chunk_kept else [])
+        for name, values in batch.result(value).items():
+            out[name].append(values)
+    results = dict((name, np.concatenate(values)) for name, values in out.items())
+    results['path'] = np.arange(paths)
+    return results, kept
+
+
+def summarize(results, cash):
+    '''Distribution statistics of the path results'''
+    final, dd = results['final_value'], results['max_drawdown']
+    stats = dict(paths=len(final), cash=cash)
+    for q in (1, 5, 25, 50, 75, 95, 99):
+        stats['final_value_p%d' % q] = np.percentile(final, q)
+    stats['final_value_mean'] = final.mean()
+    tail = final[final <= np.percentile(final, 5)]
+    stats['final_value_es5'] = tail.mean() if len(tail) else float('nan')
+    for q in (50, 95, 99):
+        stats['max_drawdown_p%d' % q] = np.percentile(dd, q)
+    stats['p_loss'] = np.mean(final < cash)
+    stats['p_margin_call'] = np.mean(results['margin_call'])
+    stats['p_rejected_order'] = np.mean(results['rejected'] > 0)
+    stats['max_units_p50'] = np.percentile(results['max_units'], 50)
+    stats['max_units_p99'] = np.percentile(results['max_units'], 99)
+    return stats
+
+
+def write_paths(results, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PATH_COLUMNS)
+        for row in zip(*(results[c] for c in PATH_COLUMNS)):
+            writer.writerow(['%.6f' % v if isinstance(v, float) else int(v) for v in row])
+
+
+def check(kept, results, **grid):
+    '''Compare the first paths with GridEngine.run_grid, path for path'''
+    worst = 0.0
+    for p, close in enumerate(kept):
+        ref = GridEngine.run_grid(close, **grid)
+        worst = max(worst, abs(ref.final_value - results['final_value'][p]))
+        rejected = np.count_nonzero(ref.orders['status'] == GridEngine.Margin)
+        if len(ref.orders) != results['orders'][p] or rejected != results['rejected'][p]:
+            return False, worst
+    return True, worst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Monte Carlo paths of the SeizeVolatility grid')
+    parser.add_argument('--data', default=Harness.M1['dataname'], help='M1 CSV of the historical returns')
+    parser.add_argument('--fromdate', default=None)
+    parser.add_argument('--todate', default=None)
+    parser.add_argument('--model', default='bootstrap', choices=('bootstrap', 'gbm'))
+    parser.add_argument('--block', type=int, default=60, help='bootstrap block length (bars)')
+    parser.add_argument('--jump-rate', type=float, default=0.0, help='gbm: jumps per step')
+    parser.add_argument('--jump-mean', type=float, default=0.0, help='gbm: mean log jump')
+    parser.add_argument('--jump-std', type=float, default=0.0, help='gbm: log jump std')
+    parser.add_argument('--paths', type=int, default=1000)
+    parser.add_argument('--steps', type=int, default=10000)
+    parser.add_argument('--start', type=float, default=None, help='first price (default: first close of the data)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', type=int, default=256, help='MB of generated prices at once')
+    parser.add_argument('--cash', type=float, default=1066.0)
+    parser.add_argument('--out', default='MonteCarlo.csv')
+    parser.add_argument('--check', type=int, default=0, help='compare the first n paths with GridEngine.run_grid')
+    args = parser.parse_args()
+
+    fromdate = datetime.fromisoformat(args.fromdate) if args.fromdate else None
+    todate = datetime.fromisoformat(args.todate) if args.todate else None
+    _, _, _, _, close = GridEngine.load_mt5_csv(args.data, fromdate, todate)
+    returns = np.diff(np.log(np.asarray(close, dtype=np.float64)))
+    if args.model == 'bootstrap':
+        model = BlockBootstrap(returns, args.block)
+    else:
+        model = JumpGBM.fit(returns, jump_rate=args.jump_rate, jump_mean=args.jump_mean,
+                            jump_std=args.jump_std)
+    start_price = args.start or float(close[0])
+
+    chunk, block = plan(args.paths, args.steps, args.memory)
+    print('%d paths x %d steps (%s), %d paths per chunk, %d steps per block'
+          % (args.paths, args.steps, args.model, chunk, block))
+    t0 = time.perf_counter()
+    results, kept = simulate(model, args.paths, args.steps, start_price, args.seed, args.memory,
+                             keep=args.check, cash=args.cash)
+    elapsed = time.perf_counter() - t0
+    print('%.2fs, %.0f path steps/s' % (elapsed, args.paths * args.steps / elapsed))
+
+    for name, value in summarize(results, args.cash).items():
+        print('%-20s %12.4f' % (name, value))
+    write_paths(results, args.out)
+    print('Paths: %s' % args.out)
+    if args.check:
+        same, worst = check(kept, results, cash=args.cash)
+        print('run_grid check (%d paths): orders match: %s, max value diff: %.2e' % (len(kept), same, worst))
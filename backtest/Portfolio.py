@@ -0,0 +1,212 @@
+import backtrader as bt
+import numpy as np
+from datetime import datetime
+import argparse
+import csv
+import time
+
+import Harness
+
+
+class SubAccount(object):
+    '''
+    Capital allocation, position and realized PnL of one strategy of the
+    portfolio. Positions are futures-like (commission `margin`): the
+    equity is allocation + realized + unrealized PnL, the margin held is
+    abs(size) * margin.
+    '''
+    def __init__(self, name, allocation):
+        self.name = name
+        self.allocation = allocation
+        self.position = bt.Position()
+        self.realized = 0.0
+        self.pending = {}  # order ref -> size not executed yet
+        self.filled = {}  # order ref -> (executed size, executed value) already booked
+        self.rejected = 0
+        self.curve = []
+
+    def equity(self, price):
+        return self.allocation + self.realized + self.position.size * (price - self.position.price)
+
+    def book(self, order, comminfo):
+        '''Apply the new part of the order's executions'''
+        size0, value0 = self.filled.get(order.ref, (0.0, 0.0))
+        size, value = order.executed.size, order.executed.size * (order.executed.price or 0.0)
+        if size != size0:
+            price = (value - value0) / (size - size0)
+            old_price = self.position.price
+            _, _, _, closed = self.position.update(size - size0, price)
+            if closed:
+                self.realized += comminfo.profitandloss(-closed, old_price, price)
+            self.filled[order.ref] = (size, value)
+        if not order.alive():
+            self.pending.pop(order.ref, None)
+            self.filled.pop(order.ref, None)
+
+
+class PortfolioMember(object):
+    '''
+    Mixin for a strategy of the portfolio: the strategy sees its own
+    sub-account position (self.position, self.close()) instead of the net
+    position of the shared data.
+    '''
+    account = None
+
+    def getposition(self, data=None, broker=None):
+        return self.account.position
+
+    position = property(getposition)
+
+
+class PortfolioBroker(bt.brokers.BackBroker):
+    '''
+    BackBroker with one SubAccount per strategy. The account level margin
+    check of BackBroker runs on the sum of the allocations, an order is
+    also rejected (Margin) when its own sub-account cannot hold the margin
+    of the resulting position.
+    '''
+    def __init__(self):
+        super(PortfolioBroker, self).__init__()
+        self.accounts = []
+        self.curve = []  # (datetime number, combined value, margin held)
+
+    def add_account(self, account):
+        self.accounts.append(account)
+
+    def submit(self, order, check=True):
+        account = getattr(order.owner, 'account', None)
+        if account is not None:
+            comminfo = self.getcommissioninfo(order.data)
+            size = account.position.size + sum(account.pending.values()) + order.size
+            grows = abs(size) > abs(account.position.size)
+            price = order.data.close[0]
+            if grows and account.equity(price) < abs(size) * comminfo.p.margin:
+                account.rejected += 1
+                order.margin()
+                self.notify(order)
+                return order
+            account.pending[order.ref] = order.size
+        return super(PortfolioBroker, self).submit(order, check)
+
+    def notify(self, order):
+        account = getattr(order.owner, 'account', None)
+        if account is not None:
+            account.book(order, self.getcommissioninfo(order.data))
+        super(PortfolioBroker, self).notify(order)
+
+    def next(self):
+        super(PortfolioBroker, self).next()
+        if not self.accounts:
+            return
+        data = self.accounts[0].data
+        price = data.close[0]
+        margin = 0.0
+        for account in self.accounts:
+            account.curve.append(account.equity(price))
+            margin += abs(account.position.size) * self.getcommissioninfo(data).p.margin
+        self.curve.append((data.datetime[0], self.getvalue(), margin))
+
+
+class PortfolioResult(object):
+    def __init__(self, cerebro, strategies, accounts):
+        self.cerebro = cerebro
+        self.strategies = strategies
+        self.accounts = accounts
+        broker = cerebro.broker
+        curve = np.array(broker.curve, dtype=np.float64).reshape(-1, 3)
+        self.dates = [bt.num2date(d) for d in curve[:, 0]]
+        self.value = curve[:, 1]
+        self.margin = curve[:, 2]
+        self.final_value = broker.getvalue()
+
+
+def run_portfolio(members, data_spec=Harness.DAILY, broker_spec=None):
+    '''
+    Run several strategies in one pass over one data feed.
+      - `members`: [(name, strategy class, allocation, params)]
+    Every strategy trades its own SubAccount, the broker cash is the sum of
+    the allocations and margin is checked per sub-account and on the total.
+    '''
+    cerebro = bt.Cerebro(stdstats=False)
+    data = Harness.load_data(data_spec)
+    cerebro.adddata(data)
+    broker = PortfolioBroker()
+    cerebro.setbroker(broker)
+    Harness.setup_broker(broker, dict(broker_spec or {}, cash=sum(m[2] for m in members)))
+
+    accounts = []
+    for name, strategy_cls, allocation, params in members:
+        account = SubAccount(name, allocation)
+        account.data = data
+        accounts.append(account)
+        broker.add_account(account)
+        member_cls = type('Portfolio' + strategy_cls.__name__, (PortfolioMember, strategy_cls),
+                          dict(account=account))
+        cerebro.addstrategy(member_cls, **(params or {}))
+    return PortfolioResult(cerebro, cerebro.run(), accounts)
+
+
+def write_curves(result, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['datetime'] + [a.name for a in result.accounts] + ['combined', 'margin'])
+        for i, dt in enumerate(result.dates):
+            writer.writerow([dt.strftime('%Y-%m-%d %H:%M:%S')] +
+                            ['%.2f' % a.curve[i] for a in result.accounts] +
+                            ['%.2f' % result.value[i], '%.2f' % result.margin[i]])
+
+
+def report(result):
+    print('%-12s %12s %12s %10s %10s' % ('strategy', 'allocation', 'final', 'return', 'rejected'))
+    for a in result.accounts:
+        final = a.curve[-1] if a.curve else a.allocation
+        print('%-12s %12.2f %12.2f %9.2f%% %10d' % (a.name, a.allocation, final,
+                                                   (final / a.allocation - 1.0) * 100, a.rejected))
+    total = sum(a.allocation for a in result.accounts)
+    print('%-12s %12.2f %12.2f %9.2f%%' % ('combined', total, result.final_value,
+                                         (result.final_value / total - 1.0) * 100))
+    if len(result.margin):
+        print('Max margin held: %.2f' % result.margin.max())
+
+
+def parse_members(items, default_allocation):
+    '''name[=allocation] into (name, strategy class, allocation, params)'''
+    members = []
+    for item in items:
+        name, _, allocation = item.partition('=')
+        members.append((name, Harness.get_strategy(name),
+                        float(allocation) if allocation else default_allocation,
+                        dict(Harness.FIXED.get(name, {}))))
+    return members
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several strategies as one book over one data feed')
+    parser.add_argument('strategies', nargs='+', help='name[=allocation], name: %s' % ', '.join(Harness.STRATEGIES))
+    parser.add_argument('--data', default='daily', help='daily or m1')
+    parser.add_argument('--fromdate', default=None)
+    parser.add_argument('--todate', default=None)
+    parser.add_argument('--allocation', type=float, default=Harness.BROKER['cash'])
+    parser.add_argument('--out', default='Portfolio.csv')
+    parser.add_argument('--compare', action='store_true', help='time the same strategies as separate runs')
+    args = parser.parse_args()
+
+    data_spec = dict(Harness.DATA[args.data])
+    if args.fromdate:
+        data_spec['fromdate'] = datetime.fromisoformat(args.fromdate)
+    if args.todate:
+        data_spec['todate'] = datetime.fromisoformat(args.todate)
+    members = parse_members(args.strategies, args.allocation)
+
+    start = time.perf_counter()
+    result = run_portfolio(members, data_spec)
+    elapsed = time.perf_counter() - start
+    report(result)
+    write_curves(result, args.out)
+    print('One pass: %.2fs, equity curves: %s' % (elapsed, args.out))
+
+    if args.compare:
+        start = time.perf_counter()
+        for name, strategy_cls, allocation, params in members:
+            Harness.run_backtest(strategy_cls, data_spec, dict(cash=allocation), params)
+        print('Separate runs: %.2fs' % (time.perf_counter() - start))
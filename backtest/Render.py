@@ -0,0 +1,125 @@
+import backtrader as bt
+import numpy as np
+import argparse
+import time
+
+import Analytics
+
+
+def ohlc_buckets(o, h, l, c, buckets):
+    '''
+    Aggregate bars into at most `buckets` OHLC bars of (almost) equal bar
+    counts. Returns (first bar index of each bucket, open, high, low, close).
+    '''
+    n = len(c)
+    if n <= buckets:
+        return np.arange(n), o, h, l, c
+    starts = np.unique((np.arange(buckets) * n) // buckets)
+    ends = np.append(starts[1:], n) - 1
+    return (starts, o[starts], np.maximum.reduceat(h, starts), np.minimum.reduceat(l, starts), c[ends])
+
+
+def lttb(x, y, threshold):
+    '''
+    Largest-Triangle-Three-Buckets: indices of `threshold` points keeping
+    the visual shape of the line (first and last points always kept).
+    '''
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    # bucket k of the inner points is [bounds[k], bounds[k + 1])
+    bounds = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    bounds[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for k in range(threshold - 2):
+        lo, hi = bounds[k], bounds[k + 1]
+        nhi = bounds[k + 2] if k + 2 < len(bounds) else n
+        # the average of the next bucket is the third vertex of the triangle
+        avg_x, avg_y = x[hi:nhi].mean(), y[hi:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[k + 1] = a
+    return selected
+
+
+def bucket_x(bars, starts, n):
+    '''x position of bar indices on the axis of the aggregated buckets'''
+    b = np.searchsorted(starts, bars, side='right') - 1
+    sizes = np.diff(np.append(starts, n))
+    return b + (bars - starts[b]) / sizes[b]
+
+
+def render(strategy, path, width=1500, height=800, dpi=100, title=None):
+    '''
+    Save the price (aggregated candles), the BuySell markers of the fills
+    and the equity line of a finished run, drawing about one candle per
+    pixel column on the non-interactive Agg backend.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    record = Analytics.RunRecord(strategy)
+    data = strategy.data
+    n = len(record.close)
+    o, h, l = (np.asarray(line.array[:n], dtype=np.float64) for line in (data.open, data.high, data.low))
+    c = record.close
+    starts, bo, bh, bl, bc = ohlc_buckets(o, h, l, c, max(1, width // 2))
+    x = np.arange(len(starts))
+
+    fig, (ax, axv) = plt.subplots(2, 1, sharex=True, figsize=(width / dpi, height / dpi), dpi=dpi,
+                                  gridspec_kw=dict(height_ratios=(3, 1)))
+    up = bc >= bo
+    colors = np.where(up, '#ff9896', '#98df8a')  # barup/bardown of the demos
+    ax.vlines(x, bl, bh, colors=colors, linewidth=0.6)
+    body = max(0.6, 0.7 * (width / max(1, len(x))) * 72.0 / dpi)
+    ax.vlines(x, np.minimum(bo, bc), np.maximum(bo, bc), colors=colors, linewidth=body)
+
+    fills = record.fills
+    if len(fills):
+        bar = np.clip(np.searchsorted(record.dt, fills['dt'], side='left'), 0, n - 1)
+        fx = np.floor(bucket_x(bar, starts, n))  # on the candle of the bucket
+        buys = fills['size'] > 0
+        ax.scatter(fx[buys], fills['price'][buys], marker='^', color='#2ca02c', s=25, zorder=3, label='buy')
+        ax.scatter(fx[~buys], fills['price'][~buys], marker='v', color='#d62728', s=25, zorder=3, label='sell')
+        ax.legend(loc='upper left')
+
+    # equity: LTTB on the bar index, drawn on the bucket axis
+    keep = lttb(np.arange(n, dtype=np.float64), record.value, 2 * width)
+    axv.plot(bucket_x(keep, starts, n), record.value[keep], color='#1f77b4', linewidth=0.8)
+    axv.set_ylabel('Value')
+
+    ticks = np.linspace(0, len(x) - 1, min(len(x), 8)).astype(np.int64)
+    axv.set_xticks(ticks)
+    axv.set_xticklabels([bt.num2date(record.dt[starts[t]]).strftime('%Y-%m-%d %H:%M') for t in ticks],
+                        rotation=10)
+    ax.set_title(title or '%s, %d bars' % (type(strategy).__name__, n))
+    ax.grid(alpha=0.3)
+    axv.grid(alpha=0.3)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+if __name__ == '__main__':
+    import Harness
+    parser = argparse.ArgumentParser(description='Run a strategy and render its chart')
+    parser.add_argument('strategy', help='%s or module:Class' % ', '.join(Harness.STRATEGIES))
+    parser.add_argument('--data', default='daily', help='daily, m1 or a CSV path')
+    parser.add_argument('--cash', type=float, default=None, help='default: the cash of the demo run')
+    parser.add_argument('--width', type=int, default=1500)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    data_spec = Harness.DATA[args.data] if args.data in Harness.DATA else \
+        dict(Harness.M1, dataname=args.data, fromdate=None, todate=None)
+    broker_spec = dict(Harness.DEMO_BROKER.get(args.strategy, {}))
+    if args.cash:
+        broker_spec['cash'] = args.cash
+    result = Harness.run_backtest(Harness.get_strategy(args.strategy), data_spec, broker_spec)
+    start = time.perf_counter()
+    path = render(result.strategy, args.out or '%s.png' % args.strategy, width=args.width)
+    print('%s: %.2fs' % (path, time.perf_counter() - start))
@@ -0,0 +1,159 @@
+import backtrader as bt
+import numpy as np
+from collections import OrderedDict
+import argparse
+import os
+import time
+
+import DataCache
+
+# the pyramid: level -> (timeframe, compression, level it is built from)
+LEVELS = OrderedDict([
+    ('M5', (bt.TimeFrame.Minutes, 5, 'M1')),
+    ('M15', (bt.TimeFrame.Minutes, 15, 'M5')),
+    ('H1', (bt.TimeFrame.Minutes, 60, 'M15')),
+    ('H4', (bt.TimeFrame.Minutes, 240, 'H1')),
+    ('D1', (bt.TimeFrame.Days, 1, 'M1')),  # calendar days, the 00:00 bar is not in the day before
+])
+
+
+def level_path(csvpath, level):
+    return os.path.splitext(csvpath)[0] + '_%s.bin' % level
+
+
+def bucket_ends(ts, timeframe, compression):
+    '''
+    Bucket of every bar as in bt.resampledata (bar2edge, rightedge): a
+    minutes bar at hh:mm belongs to the bucket ending on the next multiple
+    of `compression` minutes, a bar exactly on a multiple closes its bucket.
+    Days buckets are the calendar days (stored as 00:00 of the day, the
+    feed moves it to sessionend like resampledata).
+    '''
+    ts = np.asarray(ts, dtype=np.int64)
+    if timeframe >= bt.TimeFrame.Days:
+        return ts - ts % 86400
+    if 1440 % compression:
+        raise ValueError('compression must divide a day: %d minutes' % compression)
+    minutes = ts // 60
+    edge = (ts % 60 == 0) & (minutes % compression == 0)
+    return np.where(edge, minutes, (minutes // compression + 1) * compression) * 60
+
+
+def resample(columns, timeframe, compression):
+    '''
+    DataCache COLUMNS arrays (or an MT5Cache) resampled to a larger
+    timeframe. A bucket only holds the bars inside its own time span: bars
+    on both sides of a gap (weekend, missing bars) never share a bar.
+    '''
+    columns = getattr(columns, 'columns', columns)
+    ts = np.asarray(columns['datetime'])
+    if not len(ts):
+        return dict((name, np.empty(0, dtype=np.int64 if name == 'datetime' else np.float64))
+                    for name in DataCache.COLUMNS)
+    ends = bucket_ends(ts, timeframe, compression)
+    starts = np.flatnonzero(np.concatenate(([True], ends[1:] != ends[:-1])))
+    last = np.append(starts[1:], len(ts)) - 1
+    return dict(datetime=ends[starts],
+                open=np.asarray(columns['open'])[starts],
+                high=np.maximum.reduceat(np.asarray(columns['high']), starts),
+                low=np.minimum.reduceat(np.asarray(columns['low']), starts),
+                close=np.asarray(columns['close'])[last],
+                volume=np.add.reduceat(np.asarray(columns['volume']), starts))
+
+
+def build_pyramid(csvpath, dtformat='%Y.%m.%d %H:%M', headers=True, levels=None):
+    '''
+    Write the cache file of every level, each built from its (smaller)
+    parent level in memory. Returns {level: path}.
+    '''
+    base = DataCache.open_cache(csvpath, dtformat=dtformat, headers=headers)
+    built = dict(M1=base.columns)
+    paths = {}
+    for level, (timeframe, compression, parent) in LEVELS.items():
+        if levels is not None and level not in levels:
+            continue
+        if parent not in built:
+            parent = 'M1'
+        # the parent's bars are bucket ends: the same buckets as the M1 bars in them
+        built[level] = resample(built[parent], timeframe, compression)
+        paths[level] = DataCache.write_cache(level_path(csvpath, level), built[level], csvpath,
+                                             dtformat, headers)
+    return paths
+
+
+def open_level(csvpath, level, dtformat='%Y.%m.%d %H:%M', headers=True):
+    '''MT5Cache of one level of the export's pyramid, (re)building the pyramid if stale'''
+    if level not in LEVELS:
+        raise ValueError('unknown level %s, one of %s' % (level, ', '.join(LEVELS)))
+    path = level_path(csvpath, level)
+    if DataCache.is_stale(path, csvpath, dtformat, headers):
+        build_pyramid(csvpath, dtformat, headers)
+    return DataCache.MT5Cache(path)
+
+
+def level_feed(csvpath, level, dtformat='%Y.%m.%d %H:%M', headers=True, **kwargs):
+    '''MT5CacheData over one level, with the level's timeframe and compression'''
+    timeframe, compression, _ = LEVELS[level]
+    return DataCache.MT5CacheData(dataname=csvpath, dtformat=dtformat, headers=headers,
+                                  cache=open_level(csvpath, level, dtformat, headers),
+                                  timeframe=timeframe, compression=compression, **kwargs)
+
+
+def _lines(data):
+    n = len(data)
+    return np.array([getattr(data.lines, name).array[:n] for name in DataCache.COLUMNS],
+                    dtype=np.float64).T
+
+
+def check(csvpath, level, dtformat='%Y.%m.%d %H:%M', headers=True):
+    '''
+    Compare a level with cerebro.resampledata over the M1 CSV. Returns
+    (bars, equal bars, different bars next to a gap, other differences).
+    Backtrader carries an unfinished bucket across a gap (weekend, missing
+    00:00 bar) into the first bucket after it, the pyramid closes it at the
+    gap: only the bars on both sides of a gap may differ.
+    '''
+    timeframe, compression, _ = LEVELS[level]
+    results = []
+    for resampled in (False, True):
+        cerebro = bt.Cerebro(stdstats=False)
+        if resampled:
+            cerebro.adddata(level_feed(csvpath, level, dtformat, headers))
+        else:
+            data = bt.feeds.GenericCSVData(dataname=csvpath, dtformat=dtformat, headers=headers,
+                                           timeframe=bt.TimeFrame.Minutes, compression=1,
+                                           openinterest=-1)
+            cerebro.resampledata(data, timeframe=timeframe, compression=compression)
+        cerebro.addstrategy(bt.Strategy)
+        results.append(_lines(cerebro.run()[0].data))
+    theirs, ours = results
+    _, i, j = np.intersect1d(theirs[:, 0], ours[:, 0], return_indices=True)
+    same = np.zeros(len(ours), dtype=bool)
+    same[j] = np.all(theirs[i] == ours[j], axis=1)
+
+    span = compression / 1440.0 if timeframe < bt.TimeFrame.Days else 1.0
+    gap = np.diff(ours[:, 0]) > span * 1.5
+    near = np.zeros(len(ours), dtype=bool)
+    near[1:] |= gap
+    near[:-1] |= gap
+    at_gaps = int(np.count_nonzero(~same & near))
+    other = int(np.count_nonzero(~same & ~near)) + len(theirs) - len(i)
+    return len(ours), int(np.count_nonzero(same)), at_gaps, other
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the M5/M15/H1/H4/D1 pyramid of M1 MT5 exports')
+    parser.add_argument('csv', nargs='+')
+    parser.add_argument('--dtformat', default='%Y.%m.%d %H:%M')
+    parser.add_argument('--check', action='store_true', help='compare every level with cerebro.resampledata')
+    args = parser.parse_args()
+    for csvpath in args.csv:
+        start = time.perf_counter()
+        paths = build_pyramid(csvpath, args.dtformat)
+        print('%s: pyramid built in %.2fs' % (csvpath, time.perf_counter() - start))
+        for level, path in paths.items():
+            print('  %-4s %8d bars -> %s' % (level, len(DataCache.MT5Cache(path)), path))
+            if args.check:
+                bars, equal, at_gaps, other = check(csvpath, level, args.dtformat)
+                print('       resampledata: %d/%d bars equal, %d different at gaps, %d other differences'
+                      % (equal, bars, at_gaps, other))
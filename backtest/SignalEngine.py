@@ -0,0 +1,537 @@
+import backtrader as bt
+import numpy as np
+from datetime import datetime
+import argparse
+import csv
+import time
+
+import DataCache
+import GridEngine
+import Harness
+import Incremental
+import Resample
+
+# parameter set rows of the gathered indicators, crossover temporaries and signals per bar
+BYTES_PER_CELL = 64
+MARK_CELLS = 1 << 20  # bars x sets marked to market at once between orders
+
+ORDER_DTYPE = np.dtype([('row', 'i8'),       # parameter set
+                        ('created', 'i8'),   # bar of the decision in next()
+                        ('executed', 'i8'),  # bar of the fill (-1: none)
+                        ('size', 'f8'),      # signed order size
+                        ('filled', 'f8'),    # executed size (only the closing part of a Margin order)
+                        ('price', 'f8'),     # execution price
+                        ('status', 'i1')])   # GridEngine.Submitted/Completed/Margin
+
+RESULT_COLUMNS = ('final_value', 'max_drawdown', 'fills', 'rejected')
+# params of the demo classes that are not part of the rules
+NOT_RULES = ('table', 'printlog')
+
+
+def load_bars(data_spec):
+    '''
+    The bars of a Harness data spec as its MT5CacheData feeds them (same
+    fromdate/todate checks, resample level included), as an MT5Cache.
+    '''
+    data = Harness.load_data(data_spec)
+    data.start()
+    lo = -np.inf if data.p.fromdate is None else bt.date2num(data.p.fromdate)
+    hi = np.inf if data.p.todate is None else bt.date2num(data.p.todate)
+    keep = (data._dtnum >= lo) & (data._dtnum <= hi)
+    cache = data._cache
+    return DataCache.MT5Cache(cache.path, dict((k, v[keep]) for k, v in cache.columns.items()))
+
+
+def crossover_rows(a, b, seeds):
+    '''
+    Incremental.crossover of every row of two 2-D arrays (or a 1-D array
+    against the rows), each row with its own seed. 0 up to the seed.
+    '''
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    diff = a - b
+    n = diff.shape[1]
+    i = np.arange(n)
+    seeds = np.asarray(seeds)[:, None]
+    keep = ((diff != 0.0) & (i >= seeds)) | (i == seeds)
+    nzd = np.take_along_axis(diff, np.maximum.accumulate(np.where(keep, i, seeds), axis=1), axis=1)
+    a, b = np.broadcast_to(a, diff.shape), np.broadcast_to(b, diff.shape)
+    out = np.zeros(diff.shape, dtype=np.int8)
+    out[:, 1:] = (nzd[:, :-1] < 0.0) & (a[:, 1:] > b[:, 1:])
+    out[:, 1:] -= ((nzd[:, :-1] > 0.0) & (a[:, 1:] < b[:, 1:])).view(np.int8)
+    out[i <= seeds] = 0
+    return out
+
+
+def split(oldsize, size):
+    '''GridEngine._split of arrays: (newsize, opened, closed)'''
+    newsize = oldsize + size
+    grow = (oldsize == 0) | ((oldsize > 0) == (size > 0))
+    flip = (newsize > 0) != (oldsize > 0)
+    opened = np.where(newsize == 0, 0.0, np.where(grow, size, np.where(flip, newsize, 0.0)))
+    closed = np.where(newsize == 0, size, np.where(grow, 0.0, np.where(flip, -oldsize, size)))
+    return newsize, opened, closed
+
+
+class Rules(object):
+    '''
+    next() of a demo strategy over a block of parameter sets: the signals
+    are computed over the whole history as (bars x sets) arrays from the
+    IndicatorTable. Subclasses define decide(t, close, position): the sizes
+    of the orders next() sends at bar t, one array over the sets per order
+    (None: none).
+    '''
+    strategy = None  # Harness.STRATEGIES name
+
+    def __init__(self, table, params):
+        self.rows = len(params)
+        self.p = dict((name, np.array([p[name] for p in params])) for name in params[0])
+        self.stake = self.p['stake'].astype(np.float64)
+        self.start = np.zeros(self.rows, dtype=np.int64)  # first bar of next()
+
+    def gather(self, table, kind, periods, lookback=0):
+        '''Indicator of every set as a (sets x bars) array, one computation per period'''
+        return np.array([table.values(kind, int(period), lookback) for period in periods])
+
+    def next_event(self, t, position):
+        '''First bar from t where decide() may send orders'''
+        i = np.searchsorted(self.events, t)
+        return int(self.events[i]) if i < len(self.events) else len(self.any)
+
+    def _active(self, signals):
+        '''(bars x sets) copies with nothing before each set's first next()'''
+        out = []
+        for signal in signals:
+            signal[np.arange(signal.shape[1]) < self.start[:, None]] = 0
+            out.append(np.ascontiguousarray(signal.T))
+        return out
+
+
+class DMARules(Rules):
+    '''DemoDMA.DualMovingAverageStrategy: close() then buy/sell on a cross'''
+    strategy = 'dma'
+
+    def __init__(self, table, params):
+        super(DMARules, self).__init__(table, params)
+        short, long = self.p['period_short'], self.p['period_long']
+        self.start = np.maximum(short, long)  # the CrossOver needs one bar of both averages
+        signal = crossover_rows(self.gather(table, 'sma', short), self.gather(table, 'sma', long),
+                                self.start - 1)
+        self.signal, = self._active([signal])
+        self.any = self.signal.any(axis=1)
+        self.events = np.flatnonzero(self.any)
+
+    def decide(self, t, close, position):
+        if not self.any[t]:
+            return None
+        signal = self.signal[t]
+        cross = signal != 0
+        closing = np.where(cross & (position != 0), -position, 0.0)
+        return closing, signal * self.stake
+
+
+class DonchianRules(Rules):
+    '''DemoDonchianChannels.DonchianChannelsStrategy: stake on a break of the channel'''
+    strategy = 'donchian'
+
+    def __init__(self, table, params):
+        super(DonchianRules, self).__init__(table, params)
+        period_h, period_l = self.p['period_h'], self.p['period_l']
+        self.start = np.maximum(period_h, period_l)  # the channels look one bar back
+        close = np.asarray(table.cache.close)
+        dch = self.gather(table, 'highest', period_h, -1)
+        dcl = self.gather(table, 'lowest', period_l, -1)
+        signal = (close > dch).view(np.int8) - (~(close > dch) & (close < dcl)).view(np.int8)
+        self.signal, = self._active([signal])
+        self.any = self.signal.any(axis=1)
+        self.events = np.flatnonzero(self.any)
+
+    def decide(self, t, close, position):
+        if not self.any[t]:
+            return None
+        return self.signal[t] * self.stake,
+
+
+class TurtleRules(Rules):
+    '''
+    DemoTurtle.TurtleStrategy: enter on a channel cross, add a stake every
+    0.5 ATR in favour (3 at most), exit on the opposite cross or 2 ATR
+    against the last entry.
+    '''
+    strategy = 'turtle'
+
+    def __init__(self, table, params):
+        super(TurtleRules, self).__init__(table, params)
+        n1, n2 = self.p['N1'], self.p['N2']
+        self.start = np.maximum(n1, n2) + 1  # the CrossOvers need one bar of the channels
+        close = np.asarray(table.cache.close)
+        cross_h = crossover_rows(close, self.gather(table, 'highest', n1, -1), n1)
+        cross_l = crossover_rows(close, self.gather(table, 'lowest', n2, -1), n2)
+        self.cross_h, self.cross_l = self._active([cross_h, cross_l])
+        self.atr = np.ascontiguousarray(self.gather(table, 'atr', n1).T)
+        self.any = self.cross_h.any(axis=1) | self.cross_l.any(axis=1)
+        self.events = np.flatnonzero(self.any)
+        self.last_price = np.zeros(self.rows)
+        self.count = np.zeros(self.rows, dtype=np.int64)
+
+    def next_event(self, t, position):
+        # a position is managed on every bar (adds and stops)
+        return t if position.any() else super(TurtleRules, self).next_event(t, position)
+
+    def decide(self, t, close, position):
+        if not self.any[t] and not position.any():
+            return None
+        active = t >= self.start
+        up, down = self.cross_h[t] > 0, self.cross_l[t] < 0
+        atr = self.atr[t]
+        flat, long, short = active & (position == 0), active & (position > 0), active & (position < 0)
+
+        enter_long = flat & up
+        enter_short = flat & ~up & down
+        exit_long = long & down
+        add_long = long & ~down & (close > self.last_price + 0.5 * atr) & (self.count < 3)
+        stop_long = long & ~down & ~add_long & (close < self.last_price - 2 * atr)
+        exit_short = short & up
+        add_short = short & ~up & (close < self.last_price - 0.5 * atr) & (self.count < 3)
+        stop_short = short & ~up & ~add_short & (close > self.last_price + 2 * atr)
+
+        size = np.where(enter_long | add_long, self.stake, 0.0)
+        size = np.where(enter_short | add_short, -self.stake, size)
+        size = np.where(exit_long | stop_long | exit_short | stop_short, -position, size)
+        entered, added = enter_long | enter_short, add_long | add_short
+        self.last_price = np.where(entered | added, close, self.last_price)
+        self.count = np.where(entered, 0, self.count + added)
+        return size,
+
+
+RULES = dict((rules.strategy, rules) for rules in (DMARules, DonchianRules, TurtleRules))
+
+
+class BatchResult(object):
+    '''
+    Output of evaluate, one entry per parameter set:
+      - `params`: the parameter dicts
+      - `final_value`, `max_drawdown` (fraction of the peak broker value),
+        `fills` and `rejected` (Margin) order counts
+      - `orders`: ORDER_DTYPE rows of all the sets, by set then time
+      - `value`: broker value of every set at the end of every bar (curve=True)
+    '''
+    def __init__(self, params, columns, orders, value=None):
+        self.params = params
+        for name in RESULT_COLUMNS:
+            setattr(self, name, columns[name])
+        self.orders = orders
+        self.value = value
+
+    def fills_of(self, row):
+        '''(bar, executed size, price) of the fills of one parameter set'''
+        orders = self.orders[(self.orders['row'] == row) & (self.orders['executed'] >= 0)]
+        return [(int(o['executed']), float(o['filled']), float(o['price'])) for o in orders]
+
+    def ranking(self, key='final_value'):
+        '''Row numbers, best first'''
+        return np.argsort(-getattr(self, key), kind='stable')
+
+
+def _run_block(rules, bars, cash, margin, slip_perc, curve):
+    '''
+    The BackBroker of Harness.setup_broker for every set of the block, one
+    bar at a time: submitted orders are checked against the cash with a
+    pseudo-execution (check_submitted), filled at the open (slipped,
+    clamped to high/low) in submission order, then the positions are
+    marked to the close. The strategy decides after the broker. The bars
+    up to the next possible decision are marked at once.
+    '''
+    opens, highs, lows, closes = (np.asarray(getattr(bars, name), dtype=np.float64)
+                                  for name in ('open', 'high', 'low', 'close'))
+    n, rows = len(closes), rules.rows
+    cash = np.full(rows, float(cash))
+    position = np.zeros(rows)
+    adjbase = np.zeros(rows)
+    price_position = np.zeros(rows)  # average price of the position (Position.price)
+    peak = np.full(rows, -np.inf)
+    drawdown = np.zeros(rows)
+    values = np.empty((n, rows)) if curve else None
+    value = cash.copy()
+    orders = []
+    pending = None
+    first = int(rules.start.min())
+
+    def record(index, *fields):
+        orders.append([index] + [np.broadcast_to(f, index.shape) for f in fields])
+
+    def worth(cash, close):
+        # BackBroker._get_value: the margin of a position is unlevered around its
+        # profit and loss, (margin - pnl) + pnl is not always the margin
+        pnl = position * (close - price_position)
+        return np.where(position != 0, cash + ((np.abs(position) * margin - pnl) + pnl), cash + 0.0)
+
+    def mark(t, stop):
+        # end of bar cash adjustments of the bars [t, stop), no order in between:
+        # a cumulative sum adds them in the same order as bar by bar
+        steps = np.empty((stop - t + 1, rows))
+        steps[0] = cash
+        steps[1] = position * (closes[t] - adjbase)
+        steps[2:] = position * np.diff(closes[t:stop])[:, None]
+        marked = np.cumsum(steps, axis=0)[1:]
+        cash[:] = marked[-1]
+        adjbase.fill(closes[stop - 1])
+        marked = worth(marked, closes[t:stop, None])
+        peaks = np.maximum.accumulate(np.vstack([peak, marked]), axis=0)[1:]
+        np.maximum(drawdown, ((peaks - marked) / peaks).max(axis=0), out=drawdown)
+        peak[:] = peaks[-1]
+        value[:] = marked[-1]
+        if curve:
+            values[t:stop] = marked
+
+    stretch = max(2, MARK_CELLS // max(rows, 1))
+    t = 0
+    while t < n:
+        if pending is None:
+            stop = min(n, t + stretch, max(first, rules.next_event(t, position)))
+            if stop > t + 1:
+                mark(t, stop)
+                t = stop
+                continue
+        else:
+            slots, created = pending
+            pending = None
+            # check_submitted: pseudo-executions on a copy of cash and position
+            pcash, pposition = cash.copy(), position.copy()
+            accepted = []
+            for size in slots:
+                index = np.flatnonzero(size)
+                newsize, opened, closed = split(pposition[index], size[index])
+                pcash[index] += np.abs(closed) * margin
+                pcash[index] -= np.abs(opened) * margin
+                pposition[index] = newsize
+                ok = pcash[index] >= 0.0
+                record(index[~ok], created, -1, size[index[~ok]], 0.0, 0.0, GridEngine.Margin)
+                accepted.append(index[ok])
+
+            pbuy, psell = opens[t], opens[t]
+            if slip_perc:
+                pbuy = opens[t] * (1 + slip_perc)
+                pbuy = pbuy if pbuy <= highs[t] else highs[t]
+                psell = opens[t] * (1 - slip_perc)
+                psell = psell if psell >= lows[t] else lows[t]
+            for size, index in zip(slots, accepted):
+                if not index.size:
+                    continue
+                s = size[index]
+                price = np.where(s > 0, pbuy, psell)
+                newsize, opened, closed = split(position[index], s)
+                c, base = cash[index], adjbase[index]
+                c = c + np.abs(closed) * margin
+                c = c + -closed * (price - base)
+                ocash = c - np.abs(opened) * margin
+                opens_ok = (opened != 0) & (ocash >= 0.0)
+                ocash = np.where(opens_ok & (np.abs(newsize) > np.abs(opened)),
+                                 ocash + (newsize - opened) * (price - base), ocash)
+                cash[index] = np.where(opens_ok, ocash, c)
+                adjbase[index] = np.where(opens_ok, price, base)
+                filled = closed + np.where(opens_ok, opened, 0.0)
+                old = position[index]
+                new, _, reduced = split(old, filled)
+                grow = (old != 0) & (new != 0) & (reduced == 0)  # Position.update average price
+                pp = price_position[index]
+                pp[grow] = (pp[grow] * old[grow] + filled[grow] * price[grow]) / new[grow]
+                pp = np.where((old == 0) | ((new > 0) != (old > 0)), price, pp)
+                price_position[index] = np.where(new == 0, 0.0, pp)
+                position[index] = new
+                status = np.where((opened != 0) & ~opens_ok, GridEngine.Margin, GridEngine.Completed)
+                record(index, created, np.where(filled != 0, t, -1), s, filled, price, status)
+
+        # end of bar: futures cash adjustment to the close
+        cash += position * (closes[t] - adjbase)
+        adjbase.fill(closes[t])
+        value[:] = worth(cash, closes[t])
+        np.maximum(peak, value, out=peak)
+        np.maximum(drawdown, (peak - value) / peak, out=drawdown)
+        if curve:
+            values[t] = value
+
+        if t >= first:
+            slots = rules.decide(t, closes[t], position)
+            if slots is not None and any(size.any() for size in slots):
+                pending = (slots, t)
+        t += 1
+
+    if pending is not None:  # sent on the last bar, never executed
+        slots, created = pending
+        for size in slots:
+            index = np.flatnonzero(size)
+            record(index, created, -1, size[index], 0.0, 0.0, GridEngine.Submitted)
+
+    if orders:
+        columns = [np.concatenate(c) for c in zip(*orders)]
+    else:
+        columns = [np.empty(0)] * len(ORDER_DTYPE.names)
+    table = np.empty(len(columns[0]), dtype=ORDER_DTYPE)
+    for name, column in zip(ORDER_DTYPE.names, columns):
+        table[name] = column
+    table = table[np.argsort(table['row'], kind='stable')]
+    fills = np.bincount(table['row'][table['executed'] >= 0], minlength=rows)
+    rejected = np.bincount(table['row'][table['status'] == GridEngine.Margin], minlength=rows)
+    result = dict(final_value=value.copy(), max_drawdown=drawdown, fills=fills, rejected=rejected)
+    return result, table, values
+
+
+def plan(sets, bars, memory_mb):
+    '''Parameter sets per block within memory_mb of signals and temporaries'''
+    return max(1, min(sets, memory_mb * (1 << 20) // (BYTES_PER_CELL * max(bars, 1))))
+
+
+def evaluate(name, bars, params, cash=None, margin=None, slip_perc=None, memory_mb=256, curve=False):
+    '''
+    Run one demo strategy (`name`: dma, donchian or turtle) with every
+    parameter dict of `params` over the bars (an MT5Cache, see load_bars),
+    on the broker of Harness.BROKER. Missing params take the defaults of
+    the demo class. The sets run in blocks sized to memory_mb, every
+    indicator period is computed once for all of them. Returns a BatchResult.
+    '''
+    cash = Harness.BROKER['cash'] if cash is None else cash
+    margin = Harness.BROKER['margin'] if margin is None else margin
+    slip_perc = Harness.BROKER['slippage'] if slip_perc is None else slip_perc
+    if not params:
+        raise ValueError('no parameter set')
+    rules_cls = RULES[name]
+    defaults = [(k, v) for k, v in Harness.get_strategy(name).params._getpairs().items()
+                if k not in NOT_RULES]
+    for p in params:
+        unknown = set(p) - set(k for k, _ in defaults)
+        if unknown:
+            raise ValueError('%s: unknown params %s' % (name, ', '.join(sorted(unknown))))
+    params = [dict((k, p.get(k, v)) for k, v in defaults) for p in params]
+
+    table = Incremental.IndicatorTable(bars)
+    n = len(bars.close)
+    block = plan(len(params), n, memory_mb)
+    columns = dict((key, []) for key in RESULT_COLUMNS)
+    orders, values = [], []
+    for first in range(0, len(params), block):
+        rules = rules_cls(table, params[first:first + block])
+        result, block_orders, block_values = _run_block(rules, bars, cash, margin, slip_perc, curve)
+        for key in RESULT_COLUMNS:
+            columns[key].append(result[key])
+        block_orders['row'] += first
+        orders.append(block_orders)
+        values.append(block_values)
+    columns = dict((key, np.concatenate(v)) for key, v in columns.items())
+    return BatchResult(params, columns, np.concatenate(orders),
+                       np.concatenate(values, axis=1) if curve else None)
+
+
+def parse_grid(items):
+    '''
+    key=values strings into a parameter grid: values are a list (5,10,20)
+    or an inclusive range (5:50 or 5:50:5)
+    '''
+    grid = {}
+    for item in items:
+        key, _, values = item.partition('=')
+        if ':' in values:
+            bounds = [int(v) for v in values.split(':')]
+            step = bounds[2] if len(bounds) > 2 else 1
+            grid[key] = list(range(bounds[0], bounds[1] + 1, step))
+        else:
+            grid[key] = [Harness.parse_params(['%s=%s' % (key, v)])[key] for v in values.split(',')]
+    return grid
+
+
+def _backtrader_fills(name, data_spec, params, broker_spec=None):
+    '''Run the demo strategy through cerebro, its fills as (bar, executed size, price)'''
+    fills = []
+
+    class Recorder(Harness.get_strategy(name)):
+        def notify_order(self, order):
+            if order.status in [order.Partial, order.Completed]:
+                fills.append((len(self.data0) - 1, order.executed.size, order.executed.price))
+            super(Recorder, self).notify_order(order)
+
+    kwargs = dict(Harness.FIXED.get(name, {}), **params)
+    result = Harness.run_backtest(Recorder, data_spec, broker_spec, kwargs, indicator_cache=False)
+    return fills, result.final_value
+
+
+def check(name, data_spec, result, rows, cash=None):
+    '''
+    Compare parameter sets of a BatchResult with backtrader runs of the
+    demo strategy. Returns [(row, fills match, value difference)].
+    '''
+    out = []
+    for row in rows:
+        bt_fills, bt_value = _backtrader_fills(name, data_spec, result.params[row],
+                                               None if cash is None else dict(cash=cash))
+        fills = result.fills_of(row)
+        same = len(fills) == len(bt_fills) and all(
+            a[0] == b[0] and a[1] == b[1] and abs(a[2] - b[2]) < 1e-12
+            for a, b in zip(fills, bt_fills))
+        out.append((row, same, abs(bt_value - result.final_value[row])))
+    return out
+
+
+def write_results(result, path):
+    names = list(result.params[0])
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names + list(RESULT_COLUMNS))
+        for row in result.ranking():
+            writer.writerow([result.params[row][k] for k in names] +
+                            [getattr(result, c)[row] for c in RESULT_COLUMNS])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized DMA/Donchian/Turtle backtests of many parameter sets')
+    parser.add_argument('strategy', choices=sorted(RULES))
+    parser.add_argument('--data', default='daily', help='daily, m1 or a CSV path')
+    parser.add_argument('--resample', default=None, help='%s: run on that level of the M1 data' % ', '.join(Resample.LEVELS))
+    parser.add_argument('--fromdate', default=None)
+    parser.add_argument('--todate', default=None)
+    parser.add_argument('--cash', type=float, default=Harness.BROKER['cash'])
+    parser.add_argument('--grid', action='append',
+                        help='key=v1,v2,... or key=first:last[:step] (default: the Harness grid)')
+    parser.add_argument('--memory', type=int, default=256, help='MB of signals per block of parameter sets')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--out', default=None, help='write every set and its results to this CSV')
+    parser.add_argument('--check', type=int, default=0, help='compare the n best sets with backtrader')
+    args = parser.parse_args()
+
+    if args.data in Harness.DATA:
+        data_spec = dict(Harness.DATA[args.data])
+    else:
+        data_spec = dict(Harness.M1, dataname=args.data)
+    if args.resample:
+        data_spec['resample'] = args.resample
+    if args.fromdate:
+        data_spec['fromdate'] = datetime.fromisoformat(args.fromdate)
+    if args.todate:
+        data_spec['todate'] = datetime.fromisoformat(args.todate)
+
+    grid = parse_grid(args.grid) if args.grid else Harness.GRIDS[args.strategy]
+    params = [p for p in Harness.param_grid(grid) if Harness.valid(args.strategy, p)]
+    bars = load_bars(data_spec)
+
+    t0 = time.perf_counter()
+    result = evaluate(args.strategy, bars, params, cash=args.cash, memory_mb=args.memory)
+    t_engine = time.perf_counter() - t0
+    print('%d parameter sets x %d bars, %d sets per block: %.2fs, %.0f set bars/s'
+          % (len(params), len(bars.close), plan(len(params), len(bars.close), args.memory),
+             t_engine, len(params) * len(bars.close) / t_engine))
+    best = result.ranking()
+    for row in best[:args.top]:
+        print('%-40s value %10.2f  drawdown %6.2f%%  fills %5d  rejected %5d' % (
+            ' '.join('%s=%s' % kv for kv in result.params[row].items()), result.final_value[row],
+            result.max_drawdown[row] * 100, result.fills[row], result.rejected[row]))
+    if args.out:
+        write_results(result, args.out)
+        print('Results: %s' % args.out)
+
+    if args.check:
+        t0 = time.perf_counter()
+        checked = check(args.strategy, data_spec, result, best[:args.check], args.cash)
+        t_bt = time.perf_counter() - t0
+        for row, same, diff in checked:
+            print('backtrader %s: fills match: %s, value diff: %.2e' % (
+                ' '.join('%s=%s' % kv for kv in result.params[row].items()), same, diff))
+        print('backtrader: %.2fs per run, engine: %.4fs per set' % (
+            t_bt / len(checked), t_engine / len(params)))
@@ -0,0 +1,192 @@
+import numpy as np
+from datetime import datetime
+from multiprocessing import Pool, shared_memory
+import itertools
+import argparse
+import csv
+import os
+import random
+import time
+
+import GridEngine
+
+PARAMS = ('price_base', 'price_unit', 'value_unit', 'max_unit')
+DEFAULTS = dict(zip(PARAMS, (1.0300, 0.0020, 600, 35)))  # SeizeVolatilityStrategy.params
+INT_PARAMS = ('value_unit', 'max_unit')
+COLUMNS = ('id',) + PARAMS + ('final_value', 'annual_return', 'max_drawdown', 'trades')
+
+# worker side view of the shared price arrays
+_shared = {}
+
+
+def parse_spec(items):
+    '''
+    Parse `name=v1,v2,...` (grid values) or `name=low:high` (random range)
+    into {name: values}. Unlisted params keep the strategy defaults.
+    '''
+    spec = {}
+    for item in items:
+        name, _, values = item.partition('=')
+        if name not in PARAMS:
+            raise ValueError('Unknown parameter: %s' % name)
+        conv = int if name in INT_PARAMS else float
+        if ':' in values:
+            low, high = values.split(':')
+            spec[name] = (conv(low), conv(high))
+        else:
+            spec[name] = [conv(v) for v in values.split(',')]
+    return spec
+
+
+def grid_configs(spec):
+    names = list(spec)
+    if any(isinstance(spec[n], tuple) for n in names):
+        raise ValueError('Ranges (low:high) need --random')
+    for values in itertools.product(*(spec[n] for n in names)):
+        yield dict(zip(names, values))
+
+
+def random_configs(spec, count, seed=0):
+    '''Random search: ranges are sampled uniformly, lists are sampled by choice'''
+    rng = random.Random(seed)
+    for _ in range(count):
+        params = {}
+        for name, values in spec.items():
+            if isinstance(values, tuple):
+                low, high = values
+                params[name] = rng.randint(low, high) if name in INT_PARAMS else rng.uniform(low, high)
+            else:
+                params[name] = rng.choice(values)
+        yield params
+
+
+def share_arrays(dt, o, h, l, c):
+    '''Copy the price arrays once into a shared memory block for the workers'''
+    n = len(c)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, 5 * n * 8))
+    block = np.ndarray((5, n), dtype=np.float64, buffer=shm.buf)
+    block[0] = dt.astype('datetime64[s]').astype(np.int64)
+    block[1], block[2], block[3], block[4] = o, h, l, c
+    return shm
+
+
+def _init_worker(name, n, broker):
+    shm = shared_memory.SharedMemory(name=name)
+    block = np.ndarray((5, n), dtype=np.float64, buffer=shm.buf)
+    block.flags.writeable = False
+    _shared['shm'] = shm  # keep the mapping alive
+    _shared['block'] = block
+    _shared['broker'] = broker
+
+
+def evaluate(params, dt, o, h, l, c, broker):
+    '''Final value, annual return, max drawdown and trade count of one config (dt: epoch seconds)'''
+    result = GridEngine.run_grid(c, o, h, l, **dict(broker, **params))
+    value = result.value
+    cash = broker.get('cash', 1066.0)
+    final = result.final_value
+    years = (dt[-1] - dt[0]) / (365.25 * 86400.0) if len(dt) > 1 else 0.0
+    if final <= 0.0:
+        annual = -1.0
+    elif years > 0.0:
+        annual = (final / cash) ** (1.0 / years) - 1.0
+    else:
+        annual = final / cash - 1.0
+    peak = np.maximum.accumulate(np.concatenate(([cash], value)))
+    drawdown = float(np.max((peak[1:] - value) / peak[1:])) if len(value) else 0.0
+    return final, annual, drawdown, len(result.fills)
+
+
+def _run(task):
+    cid, params = task
+    block = _shared['block']
+    final, annual, drawdown, trades = evaluate(params, block[0], block[1], block[2],
+                                               block[3], block[4], _shared['broker'])
+    return cid, params, final, annual, drawdown, trades
+
+
+def param_key(params):
+    '''The full parameter tuple of a config (or of a row read back), the resume key'''
+    p = dict(DEFAULTS, **params)
+    return tuple(int(p[k]) if k in INT_PARAMS else float(p[k]) for k in PARAMS)
+
+
+def done_params(path):
+    '''
+    Parameter tuples already written by a previous (possibly interrupted)
+    sweep. A partially written last row is cut off so it gets evaluated again.
+    '''
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+    with open(path, newline='') as f:
+        return set(param_key(dict((k, row[k]) for k in PARAMS)) for row in csv.DictReader(f))
+
+
+def sweep(configs, dt, o, h, l, c, out, broker=None, processes=None, chunksize=8):
+    '''
+    Evaluate the configs on a process pool and append one row per config to
+    `out` as results arrive. Configs whose parameters already have a row in
+    `out` are skipped, so an interrupted sweep resumes where it stopped, also
+    when the config list was changed or reordered since.
+    '''
+    broker = broker or {}
+    skip = done_params(out)
+    configs = list(configs)
+    tasks = [(cid, p) for cid, p in enumerate(configs) if param_key(p) not in skip]
+    print('Configs: %d, already done: %d' % (len(configs), len(configs) - len(tasks)))
+    if not tasks:
+        return
+
+    shm = share_arrays(dt, o, h, l, c)
+    newfile = not os.path.exists(out) or os.path.getsize(out) == 0
+    try:
+        with open(out, 'a', newline='') as csvfile, \
+                Pool(processes or os.cpu_count(), initializer=_init_worker,
+                     initargs=(shm.name, len(c), broker)) as pool:
+            csvwriter = csv.writer(csvfile)
+            if newfile:
+                csvwriter.writerow(COLUMNS)
+            last_flush = time.time()
+            for i, (cid, params, final, annual, drawdown, trades) in enumerate(
+                    pool.imap_unordered(_run, tasks, chunksize=chunksize)):
+                p = dict(DEFAULTS, **params)
+                csvwriter.writerow([cid] + [p[k] for k in PARAMS] +
+                                   ['%.2f' % final, '%.6f' % annual, '%.6f' % drawdown, trades])
+                if time.time() - last_flush > 1.0:
+                    csvfile.flush()
+                    last_flush = time.time()
+                    print('%d/%d' % (i + 1, len(tasks)))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parameter sweep for SeizeVolatilityStrategy')
+    parser.add_argument('params', nargs='+',
+                        help='name=v1,v2,... for a grid, name=low:high for random search')
+    parser.add_argument('--data', default='dataMT5/EURUSDM1_220301.csv')
+    parser.add_argument('--fromdate', default='2023-03-01 09:45')
+    parser.add_argument('--todate', default='2023-04-22 00:00')
+    parser.add_argument('--random', type=int, default=0, help='number of random configs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cash', type=float, default=1066.0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', default='SweepVolatility.csv')
+    args = parser.parse_args()
+
+    spec = parse_spec(args.params)
+    if args.random:
+        configs = list(random_configs(spec, args.random, args.seed))
+    else:
+        configs = list(grid_configs(spec))
+
+    dt, o, h, l, c = GridEngine.load_mt5_csv(args.data, datetime.fromisoformat(args.fromdate),
+                                             datetime.fromisoformat(args.todate))
+    sweep(configs, dt, o, h, l, c, args.out, broker=dict(cash=args.cash),
+          processes=args.processes)
+    print('Results: %s' % args.out)
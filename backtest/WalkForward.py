@@ -0,0 +1,170 @@
+import backtrader as bt
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+import argparse
+import csv
+import os
+import time
+
+import Harness
+import Incremental
+
+FOLD_COLUMNS = ('strategy', 'fold', 'train_from', 'train_to', 'test_from', 'test_to', 'params',
+                'train_value', 'test_value', 'test_return')
+
+# per process: data spec, broker spec and the IndicatorTable of the data
+_worker = {}
+
+
+def make_folds(dates, train_months=36, test_months=12):
+    '''
+    Rolling folds over the bar dates: (train_from, train_to, test_from, test_to),
+    all inclusive dates. The test windows follow each other without overlap.
+    '''
+    first, last = pd.Timestamp(dates[0]).normalize(), pd.Timestamp(dates[-1]).normalize()
+    folds = []
+    start = first
+    while True:
+        test_from = start + pd.DateOffset(months=train_months)
+        test_end = test_from + pd.DateOffset(months=test_months)
+        if test_from > last:
+            break
+        folds.append((start.date(), (test_from - pd.Timedelta(days=1)).date(),
+                      test_from.date(), min(test_end - pd.Timedelta(days=1), last).date()))
+        start += pd.DateOffset(months=test_months)
+    return folds
+
+
+def _init_worker(data_spec, broker_spec):
+    _worker['data'] = data_spec
+    _worker['broker'] = broker_spec
+    # built once per process, its arrays are reused by every fold and config
+    _worker['table'] = Incremental.IndicatorTable(Harness.get_cache(data_spec))
+
+
+def equity(strategy):
+    '''(bar datetimes, broker values) of a finished run'''
+    broker = next(o for o in strategy.observers if isinstance(o, bt.observers.Broker))
+    values = np.asarray(broker.lines.value.array[:len(strategy)], dtype=np.float64)
+    dates = [bt.num2date(d) for d in strategy.data.datetime.array[:len(strategy)]]
+    return dates, values
+
+
+def _run(task):
+    name, fold, params, fromdate, todate, curve = task
+    spec = dict(_worker['data'], fromdate=fromdate, todate=todate)
+    kwargs = dict(Harness.FIXED.get(name, {}), table=_worker['table'], **params)
+    result = Harness.run_backtest(Harness.get_strategy(name), spec, _worker['broker'], kwargs)
+    return name, fold, params, result.final_value, equity(result.strategy) if curve else None
+
+
+def walk_forward(names, data_spec, folds, grids=None, broker_spec=None, processes=None, chunksize=4):
+    '''
+    Optimize every strategy on the train window of every fold (final value),
+    then run the best params on the following test window.
+    Returns ({(name, fold): (params, train_value)}, {(name, fold): (test_value, dates, values)}).
+    '''
+    grids = dict(Harness.GRIDS, **(grids or {}))
+    broker_spec = dict(Harness.BROKER, **(broker_spec or {}))
+    train = [(name, i, params, f[0], f[1], False)
+             for name in names for i, f in enumerate(folds)
+             for params in Harness.param_grid(grids[name]) if Harness.valid(name, params)]
+
+    with Pool(processes or os.cpu_count(), initializer=_init_worker,
+              initargs=(data_spec, broker_spec)) as pool:
+        best = {}
+        start = time.time()
+        for name, fold, params, value, _ in pool.imap_unordered(_run, train, chunksize=chunksize):
+            if (name, fold) not in best or value > best[(name, fold)][1]:
+                best[(name, fold)] = (params, value)
+        print('Train: %d runs in %.1fs' % (len(train), time.time() - start))
+
+        test = [(name, fold, params, folds[fold][2], folds[fold][3], True)
+                for (name, fold), (params, _) in sorted(best.items())]
+        tested = {}
+        for name, fold, params, value, (dates, values) in pool.imap_unordered(_run, test):
+            tested[(name, fold)] = (value, dates, values)
+    return best, tested
+
+
+def stitch(tested, name, nfolds, cash):
+    '''Out-of-sample equity of one strategy: every test window compounded on the previous one'''
+    rows = []
+    level = cash
+    for fold in range(nfolds):
+        if (name, fold) not in tested:
+            continue
+        _, dates, values = tested[(name, fold)]
+        rows.extend((d, fold, level * v / cash) for d, v in zip(dates, values))
+        level = level * values[-1] / cash if len(values) else level
+    return rows
+
+
+def write_results(names, folds, best, tested, cash, out):
+    with open(out, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FOLD_COLUMNS)
+        for name in names:
+            for i, fold in enumerate(folds):
+                if (name, i) not in tested:
+                    continue
+                params, train_value = best[(name, i)]
+                test_value = tested[(name, i)][0]
+                writer.writerow([name, i] + [d.isoformat() for d in fold] +
+                                [' '.join('%s=%s' % kv for kv in sorted(params.items())),
+                                 '%.2f' % train_value, '%.2f' % test_value,
+                                 '%.6f' % (test_value / cash - 1.0)])
+
+    curves = os.path.splitext(out)[0] + '_equity.csv'
+    with open(curves, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(('datetime', 'strategy', 'fold', 'equity'))
+        for name in names:
+            rows = stitch(tested, name, len(folds), cash)
+            for d, fold, value in rows:
+                writer.writerow([d.strftime('%Y-%m-%d'), name, fold, '%.2f' % value])
+            if rows:
+                years = (rows[-1][0] - rows[0][0]).days / 365.25
+                total = rows[-1][2] / cash
+                annual = total ** (1.0 / years) - 1.0 if years > 0 and total > 0 else float('nan')
+                print('%-10s out-of-sample: %d folds, %s -> %s, total return: %.2f%%, annual: %.2f%%' % (
+                    name, len(set(r[1] for r in rows)), rows[0][0].date(), rows[-1][0].date(),
+                    (total - 1.0) * 100, annual * 100))
+    return curves
+
+
+def parse_grid(items):
+    '''name=v1,v2,... into {param: [values]} (int or float values)'''
+    grid = {}
+    for item in items or []:
+        key, _, values = item.partition('=')
+        grid[key] = [int(v) if v.lstrip('-').isdigit() else float(v) for v in values.split(',')]
+    return grid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward optimization of the demo strategies')
+    parser.add_argument('strategies', nargs='*', default=list(Harness.GRIDS), help=', '.join(Harness.GRIDS))
+    parser.add_argument('--train', type=int, default=36, help='in-sample months')
+    parser.add_argument('--test', type=int, default=12, help='out-of-sample months')
+    parser.add_argument('--grid', action='append',
+                        help='name=v1,v2,... replaces that param grid of every strategy having it')
+    parser.add_argument('--cash', type=float, default=Harness.BROKER['cash'])
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--out', default='WalkForward.csv')
+    args = parser.parse_args()
+
+    data_spec = dict(Harness.DAILY, fromdate=None, todate=None)  # the whole 2010-2023 history
+    cache = Harness.get_cache(data_spec)
+    folds = make_folds(cache.datetimes(), args.train, args.test)
+    print('%d folds, train %d months, test %d months' % (len(folds), args.train, args.test))
+
+    override = parse_grid(args.grid)
+    grids = dict((name, dict(grid, **dict((k, v) for k, v in override.items() if k in grid)))
+                 for name, grid in Harness.GRIDS.items())
+    start = time.time()
+    best, tested = walk_forward(args.strategies, data_spec, folds, grids,
+                                dict(cash=args.cash), args.processes)
+    curves = write_results(args.strategies, folds, best, tested, args.cash, args.out)
+    print('Walk-forward done in %.1fs: %s, %s' % (time.time() - start, args.out, curves))